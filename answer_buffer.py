@@ -0,0 +1,149 @@
+# /chatの各ラウンドで発生するUserAnswerの書き込みをまとめて行うライトビハインドバッファ
+# 全セッションの回答をメモリに溜め、件数または経過時間のしきい値に達したらまとめてINSERTする
+# アプリ終了時とsave_conversationの前には必ずフラッシュし、未書き込みの回答が残らないようにする
+# 接続エラーで書き込めなかった回答はそのまま再試行し、特定の行が原因で失敗した場合はその行だけを数回再試行した後、
+# デッドレター（answer_buffer.dead_letterのログ）に移して他の回答の書き込みを止めない
+import asyncio
+import json
+import logging
+import os
+import time
+from sqlalchemy import insert
+from sqlalchemy.exc import InterfaceError, OperationalError
+from db import AsyncSessionLocal
+from models import UserAnswer
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+dead_letter_logger = logging.getLogger(__name__ + ".dead_letter")
+
+ANSWER_BUFFER_MAX_ROWS = int(os.getenv("ANSWER_BUFFER_MAX_ROWS", "100"))
+ANSWER_BUFFER_FLUSH_INTERVAL = float(os.getenv("ANSWER_BUFFER_FLUSH_INTERVAL", "1.0"))
+# 行が原因で書き込めなかった回答を再試行する回数（超えたらデッドレターに移す）
+ANSWER_BUFFER_MAX_ATTEMPTS = int(os.getenv("ANSWER_BUFFER_MAX_ATTEMPTS", "3"))
+
+flush_rows = Histogram(
+    "answer_buffer_flush_rows", "1回のフラッシュで書き込んだUserAnswerの件数",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+flush_lag_seconds = Histogram(
+    "answer_buffer_flush_lag_seconds", "バッファに追加されてからDBに書き込まれるまでの最大遅延（秒）"
+)
+flush_failures = Counter("answer_buffer_flush_failures_total", "UserAnswerのフラッシュに失敗した回数")
+pending_rows = Gauge("answer_buffer_pending_rows", "バッファ内の未書き込みUserAnswer件数")
+dead_letter_rows = Counter("answer_buffer_dead_letter_total", "再試行しても書き込めずデッドレターに移したUserAnswerの件数")
+
+# DBに接続できないなど、行の内容に関係なく起きるエラー（回答の再試行回数に数えない）
+CONNECTION_ERRORS = (OperationalError, InterfaceError, OSError, asyncio.TimeoutError)
+
+
+class AnswerWriteBuffer:
+    def __init__(self, max_rows: int = ANSWER_BUFFER_MAX_ROWS, flush_interval: float = ANSWER_BUFFER_FLUSH_INTERVAL):
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        # (追加時刻, INSERTする値, 行が原因で失敗した回数) のリスト
+        self._rows = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add(self, **values) -> None:
+        """UserAnswerの値をバッファに追加する（DBへの書き込みは後でまとめて行う）"""
+        self._rows.append((time.monotonic(), values, 0))
+        pending_rows.set(len(self._rows))
+        if len(self._rows) >= self.max_rows:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """
+        バッファ内の回答をまとめてINSERTし、書き込んだ件数を返す。
+        書き込めなかった回答はバッファに戻すかデッドレターに移し、例外は送出しない（呼び出し元の保存処理を失敗させない）
+        """
+        async with self._flush_lock:
+            rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+            lag = time.monotonic() - rows[0][0]
+            try:
+                await self._write([values for _, values, _ in rows])
+                written = len(rows)
+            except CONNECTION_ERRORS:
+                # 接続の問題は行の内容に関係ないため、回数に数えずにそのまま次回のフラッシュで再試行する
+                self._rows = rows + self._rows
+                pending_rows.set(len(self._rows))
+                flush_failures.inc()
+                logger.exception("UserAnswerのフラッシュに失敗しました")
+                return 0
+            except Exception:
+                flush_failures.inc()
+                logger.exception("UserAnswerのフラッシュに失敗しました。1件ずつ書き込み直します")
+                written = await self._write_each(rows)
+            pending_rows.set(len(self._rows))
+            if written:
+                flush_rows.observe(written)
+                flush_lag_seconds.observe(lag)
+            logger.info(f"[UserAnswerフラッシュ] rows={written}, lag={lag:.3f}s")
+            return written
+
+    async def _write_each(self, rows: list) -> int:
+        """まとめて書き込めなかった回答を1件ずつ書き込み、原因の行だけをバッファに戻すかデッドレターに移す"""
+        written = 0
+        retry = []
+        for index, (added_at, values, attempts) in enumerate(rows):
+            try:
+                await self._write([values])
+                written += 1
+            except CONNECTION_ERRORS:
+                # 途中で接続できなくなった場合は、残りの回答を回数に数えずに戻す
+                retry.extend(rows[index:])
+                break
+            except Exception:
+                attempts += 1
+                if attempts >= ANSWER_BUFFER_MAX_ATTEMPTS:
+                    dead_letter_rows.inc()
+                    dead_letter_logger.exception(
+                        f"[UserAnswerデッドレター] attempts={attempts} "
+                        f"row={json.dumps(values, ensure_ascii=False, default=str)}"
+                    )
+                else:
+                    retry.append((added_at, values, attempts))
+        self._rows = retry + self._rows
+        return written
+
+    @staticmethod
+    async def _write(rows: list[dict]) -> None:
+        async with AsyncSessionLocal() as db:
+            try:
+                await db.execute(insert(UserAnswer), rows)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # 失敗した回答はバッファに残っているので次回のフラッシュで再試行する
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """定期フラッシュを止め、残っている回答をすべて書き込む"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+answer_buffer = AnswerWriteBuffer()
@@ -0,0 +1,177 @@
+# 役割：全夫婦のベクトル要約・リマインド・対話アドバイスを夜間にまとめて事前計算する
+# 朝の最初のGETでLLMの処理が走らないよう、エンドポイントと同じ処理（services.py）を先に実行して結果を保存しておく。
+# 夫婦ごとの処理をasyncioのワーカーで並行に行い、LLMを呼ぶ処理の同時実行数はセマフォで全体として制限する。
+# 完了した夫婦はチェックポイントファイルに記録し、途中で止まっても--resumeで続きから再開できる
+# LLMの利用量は結果を見るメンバーに計上する（事前計算では利用上限による制限は行わない）
+# 使い方: python batch_precompute.py [--workers 8] [--max-concurrency 4] [--checkpoint precompute_checkpoint.json] [--resume]
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+import orjson
+from sqlalchemy import distinct, select
+import crud
+import services
+from db import AsyncSessionLocal, ReadSessionLocal
+from models import User
+from metrics import Counter, Histogram
+from usage_ledger import billed_to, usage_ledger
+
+logger = logging.getLogger(__name__)
+
+PRECOMPUTE_WORKERS = int(os.getenv("PRECOMPUTE_WORKERS", "8"))
+PRECOMPUTE_MAX_CONCURRENCY = int(os.getenv("PRECOMPUTE_MAX_CONCURRENCY", "4"))
+PRECOMPUTE_CHECKPOINT = os.getenv("PRECOMPUTE_CHECKPOINT", "precompute_checkpoint.json")
+# 進捗をログに出す間隔（秒）
+PROGRESS_INTERVAL = 30.0
+
+couples_processed = Counter("precompute_couples_total", "事前計算を行った夫婦の数", ("result",))
+couple_seconds = Histogram("precompute_couple_seconds", "夫婦1組の事前計算にかかった時間（秒）")
+
+
+class Checkpoint:
+    """完了・失敗した夫婦を記録するJSONファイル（書き込みは一時ファイルからの置き換えで行う）"""
+
+    def __init__(self, path: str, run_id: str, done=(), failed=None):
+        self.path = path
+        self.run_id = run_id
+        self.done = set(done)
+        self.failed = dict(failed or {})
+
+    @classmethod
+    def load(cls, path: str, resume: bool) -> "Checkpoint":
+        if resume and os.path.exists(path):
+            with open(path, "rb") as f:
+                data = orjson.loads(f.read())
+            return cls(path, data["run_id"], data.get("done", ()), data.get("failed"))
+        return cls(path, datetime.utcnow().strftime("%Y%m%dT%H%M%S"))
+
+    def mark(self, couple_id: str, error: str = None) -> None:
+        if error is None:
+            self.done.add(couple_id)
+            self.failed.pop(couple_id, None)
+        else:
+            self.failed[couple_id] = error
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps({
+                "run_id": self.run_id,
+                "updated_at": datetime.utcnow(),
+                "done": sorted(self.done),
+                "failed": self.failed,
+            }))
+        os.replace(tmp_path, self.path)
+
+
+async def all_couple_ids() -> list:
+    async with ReadSessionLocal() as session:
+        return (await session.execute(
+            select(distinct(User.couple_id)).where(User.couple_id.is_not(None)).order_by(User.couple_id)
+        )).scalars().all()
+
+
+async def precompute_couple(couple_id: str, limiter: asyncio.Semaphore) -> None:
+    """1組の夫婦について、要約 → リマインド → 対話アドバイスの順に計算して保存する"""
+    async with AsyncSessionLocal() as session:
+        members = await crud.get_couple_members(session, couple_id)
+        if not members:
+            return
+        partners = {m.user_id: next((p for p in members if p.user_id != m.user_id), None) for m in members}
+
+        # リマインドとアドバイスは要約を元に作るため、先に両方の要約を作る
+        for member in members:
+            async with limiter:
+                with billed_to(member.user_id, couple_id):
+                    await services.compute_vector_summaries(session, member.user_id)
+
+        for member in members:
+            partner = partners[member.user_id]
+            if partner is None:
+                continue
+            versions = await services.recent_summary_versions(session, partner.user_id)
+            validator = services.reminder_validator(partner.user_id, versions)
+            async with limiter:
+                with billed_to(member.user_id, couple_id):
+                    await services.reminder_for(session, partner.user_id, versions, validator.etag)
+
+        for member in members:
+            inputs = await services.dialogue_advice_inputs(session, member, partners[member.user_id])
+            async with limiter:
+                with billed_to(member.user_id, couple_id):
+                    await services.dialogue_advice(session, member, partners[member.user_id], inputs)
+
+
+async def run(workers: int, max_concurrency: int, checkpoint: Checkpoint, limit: int = None) -> dict:
+    couple_ids = [cid for cid in await all_couple_ids() if cid not in checkpoint.done]
+    if limit is not None:
+        couple_ids = couple_ids[:limit]
+    queue = asyncio.Queue()
+    for couple_id in couple_ids:
+        queue.put_nowait(couple_id)
+
+    limiter = asyncio.Semaphore(max_concurrency)
+    stats = {"total": len(couple_ids), "succeeded": 0, "failed": 0}
+    started = time.perf_counter()
+
+    async def worker():
+        while True:
+            try:
+                couple_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            couple_started = time.perf_counter()
+            try:
+                await precompute_couple(couple_id, limiter)
+            except Exception as e:
+                logger.exception(f"[precompute] 失敗: couple_id={couple_id}")
+                checkpoint.mark(couple_id, f"{type(e).__name__}: {e}")
+                stats["failed"] += 1
+                couples_processed.inc(result="failed")
+            else:
+                checkpoint.mark(couple_id)
+                stats["succeeded"] += 1
+                couples_processed.inc(result="succeeded")
+            couple_seconds.observe(time.perf_counter() - couple_started)
+            checkpoint.save()
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            elapsed = time.perf_counter() - started
+            finished = stats["succeeded"] + stats["failed"]
+            logger.info(f"[precompute] {finished}/{stats['total']} 組 "
+                        f"({finished / elapsed * 60:.1f} 組/分, 失敗 {stats['failed']})")
+
+    reporter = asyncio.create_task(report_progress())
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    finally:
+        reporter.cancel()
+        # 集計したLLMの利用量を台帳に書き込む
+        await usage_ledger.flush()
+
+    elapsed = time.perf_counter() - started
+    stats["elapsed_seconds"] = round(elapsed, 1)
+    stats["couples_per_minute"] = round((stats["succeeded"] + stats["failed"]) / elapsed * 60, 2) if elapsed else 0.0
+    stats["failures"] = dict(checkpoint.failed)
+    return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="全夫婦の要約・リマインド・対話アドバイスを事前計算する")
+    parser.add_argument("--workers", type=int, default=PRECOMPUTE_WORKERS, help="並行に処理する夫婦の数")
+    parser.add_argument("--max-concurrency", type=int, default=PRECOMPUTE_MAX_CONCURRENCY,
+                        help="LLMを呼ぶ処理の全体での同時実行数")
+    parser.add_argument("--checkpoint", default=PRECOMPUTE_CHECKPOINT)
+    parser.add_argument("--resume", action="store_true", help="チェックポイントに記録された完了済みの夫婦を飛ばす")
+    parser.add_argument("--limit", type=int, default=None, help="処理する夫婦の数の上限（動作確認用）")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint.load(args.checkpoint, args.resume)
+    result = asyncio.run(run(args.workers, args.max_concurrency, checkpoint, args.limit))
+    print(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
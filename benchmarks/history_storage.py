@@ -0,0 +1,89 @@
+# 会話履歴の保存形式（旧: 結合テキスト / 新: 話者付きターン列のzstd圧縮）を比較する
+# 1セッションあたりの保存バイト数と、DBから読み出して展開するまでのレイテンシを出力する
+# 使い方: python -m benchmarks.history_storage --sessions 2000 --url sqlite:///bench_history.db
+import argparse
+import random
+import statistics
+import time
+from sqlalchemy import Column, Integer, LargeBinary, MetaData, Table, Text, create_engine, insert, select
+from history_codec import LazyHistory, encode_turns
+
+_PHRASES = [
+    "今日は仕事が忙しくて、帰ってからも家事に追われてしまいました。",
+    "パートナーが夕飯を作ってくれていて本当に助かりました。",
+    "子どもの寝かしつけの分担について、そろそろ話し合いたいと思っています。",
+    "本当は疲れていると伝えたかったけれど、言えずに飲み込んでしまいました。",
+    "明日は朝に少しだけ二人で話す時間をとってみたいです。",
+    "それは大変でしたね。そんな中でも感謝の気持ちに気づけたのは素敵なことです。",
+    "もう少し詳しく教えていただけますか？どんな場面でそう感じましたか？",
+]
+
+
+def synthetic_turns(rng: random.Random, rounds: int = 10) -> list[dict]:
+    turns = []
+    for _ in range(rounds):
+        turns.append({"role": "user", "content": "".join(rng.choices(_PHRASES, k=rng.randint(2, 5)))})
+        turns.append({"role": "coach", "content": "".join(rng.choices(_PHRASES, k=rng.randint(3, 6)))})
+    return turns
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会話履歴の保存サイズと読み出しレイテンシを比較する")
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--url", default="sqlite://")
+    parser.add_argument("--reads", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    sessions = [synthetic_turns(rng) for _ in range(args.sessions)]
+    texts = ["\n".join(t["content"] for t in turns) for turns in sessions]
+
+    started = time.perf_counter()
+    blobs = [encode_turns(turns) for turns in sessions]
+    encode_ms = (time.perf_counter() - started) * 1000 / len(sessions)
+
+    text_bytes = [len(t.encode("utf-8")) for t in texts]
+    blob_bytes = [len(b) for b in blobs]
+    print(f"sessions: {len(sessions)}")
+    print(f"text  : mean={statistics.mean(text_bytes):.0f}B total={sum(text_bytes) / 1024:.0f}KiB")
+    print(f"zstd  : mean={statistics.mean(blob_bytes):.0f}B total={sum(blob_bytes) / 1024:.0f}KiB "
+          f"(ratio {sum(blob_bytes) / sum(text_bytes):.2f}, encode {encode_ms:.3f}ms/session)")
+
+    bench_engine = create_engine(args.url)
+    metadata = MetaData()
+    table = Table("history_bench", metadata,
+                  Column("id", Integer, primary_key=True),
+                  Column("chat_history", Text),
+                  Column("chat_turns", LargeBinary))
+    metadata.drop_all(bench_engine)
+    metadata.create_all(bench_engine)
+    with bench_engine.begin() as conn:
+        conn.execute(insert(table), [
+            {"id": i + 1, "chat_history": text, "chat_turns": blob}
+            for i, (text, blob) in enumerate(zip(texts, blobs))
+        ])
+
+    text_ms, blob_ms = [], []
+    with bench_engine.connect() as conn:
+        for _ in range(args.reads):
+            row_id = rng.randint(1, len(sessions))
+            started = time.perf_counter()
+            conn.execute(select(table.c.chat_history).where(table.c.id == row_id)).scalar_one()
+            text_ms.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            blob = conn.execute(select(table.c.chat_turns).where(table.c.id == row_id)).scalar_one()
+            LazyHistory(blob=blob).as_text()
+            blob_ms.append((time.perf_counter() - started) * 1000)
+
+    print(f"read text       : p50={statistics.median(text_ms):.3f}ms p95={percentile(text_ms, 0.95):.3f}ms")
+    print(f"read+decode zstd: p50={statistics.median(blob_ms):.3f}ms p95={percentile(blob_ms, 0.95):.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
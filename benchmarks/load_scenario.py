@@ -0,0 +1,238 @@
+# 実際の利用に近いシナリオでの負荷試験
+# N組の夫婦が同時に、夫婦それぞれで10ラウンドの/chat（conversation_chain.MAX_ROUNDS）→ /save_conversationを行い、
+# 2人とも保存が終わったらレポート系のエンドポイント（fixed_all・/report_reminding・/dialogue_advice）を呼ぶ。
+# 回答の間には考える時間（think time）を挟む。外部サービスはfake_backendsのスタンドインを使う。
+# セッション数/秒、ラウンドごとのレイテンシ、イベントループの遅延、セッションストア（main.sessions）のメモリの推移を出力する
+# 使い方: python -m benchmarks.load_scenario --couples 50 --iterations 2 --think-time lognormal:2000:0.5
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+from pathlib import Path
+from benchmarks.endpoint_bench import configure_environment, percentile
+
+_ANSWERS = (
+    "6点です。仕事が立て込んでいて、家ではほとんど話せませんでした。",
+    "もう少し詳しく言うと、夕食の片付けを一人でしていて寂しかったです。",
+    "本当は、週末くらいは家事を分担してほしいと伝えたかったです。",
+    "言ったら喧嘩になりそうで飲み込んでしまいました。",
+    "子どもの進学のことをそろそろ話し合いたいと思っています。",
+    "スキップ",
+    "昨日、疲れているときにコーヒーを淹れてくれて嬉しかったです。",
+    "ありがとうと言えていなかったので、伝えたいです。",
+    "明日は早めに帰って、一緒に夕食をとるようにしたいです。",
+    "寝る前に少しだけ話す時間を作ってみます。",
+)
+
+
+def _rss_bytes() -> int:
+    """プロセスの常駐メモリ（Linuxは/proc、それ以外は最大常駐メモリで代用）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def session_store_stats(sessions: dict) -> tuple:
+    """セッション数、会話メモリ上のメッセージ数と本文のバイト数"""
+    messages = 0
+    content_bytes = 0
+    for chain in list(sessions.values()):
+        for message in chain.memory.chat_memory.messages:
+            messages += 1
+            content_bytes += len(str(message.content).encode())
+    return len(sessions), messages, content_bytes
+
+
+class LoadStats:
+    def __init__(self):
+        # ラウンド番号（0はセッション開始）-> レイテンシ
+        self.round_latencies = defaultdict(list)
+        self.endpoint_latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sessions_completed = 0
+        self.loop_lags = []
+        self.timeline = []
+        self.elapsed = 0.0
+        self.final_store = (0, 0, 0)
+
+    async def call(self, client, method: str, path: str, key=None, **kwargs):
+        started = time.perf_counter()
+        response = await client.request(method, path, **kwargs)
+        elapsed = time.perf_counter() - started
+        self.endpoint_latencies[path].append(elapsed)
+        if key is not None:
+            self.round_latencies[key].append(elapsed)
+        if response.status_code >= 400:
+            self.errors[path] += 1
+            return None
+        return response.json()
+
+
+async def monitor_loop_lag(stats: LoadStats, interval: float) -> None:
+    """intervalごとにsleepし、予定より起床が遅れた時間をイベントループの遅延として記録する"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        stats.loop_lags.append(max(0.0, loop.time() - started - interval))
+
+
+async def sample_timeline(stats: LoadStats, sessions: dict, interval: float, started: float) -> None:
+    previous_completed, previous_at, lag_index = 0, started, 0
+    while True:
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        count, messages, content_bytes = session_store_stats(sessions)
+        window_lags = stats.loop_lags[lag_index:]
+        lag_index = len(stats.loop_lags)
+        row = {
+            "t": round(now - started, 1),
+            "sessions_completed": stats.sessions_completed,
+            "sessions_per_second": (stats.sessions_completed - previous_completed) / (now - previous_at),
+            "session_store_sessions": count,
+            "session_store_messages": messages,
+            "session_store_bytes": content_bytes,
+            "rss_bytes": _rss_bytes(),
+            "loop_lag_max_ms": max(window_lags, default=0.0) * 1000,
+        }
+        stats.timeline.append(row)
+        previous_completed, previous_at = stats.sessions_completed, now
+        print(f"{row['t']:>7.1f}s  完了 {row['sessions_completed']:>5}  {row['sessions_per_second']:>6.2f} 件/s  "
+              f"ストア {count:>5}件 {messages:>6}メッセージ {content_bytes / 1024:>8.1f} KiB  "
+              f"RSS {row['rss_bytes'] / 2**20:>7.1f} MiB  ループ遅延(最大) {row['loop_lag_max_ms']:>7.1f} ms", flush=True)
+
+
+async def run(args) -> LoadStats:
+    import httpx
+    from sqlalchemy import func, select
+    import db
+    import main as api
+    import migrations
+    from conversation_chain import MAX_ROUNDS
+    from fake_backends import Latency
+    from models import User
+
+    logging.getLogger().setLevel(logging.WARNING)
+    migrations.upgrade(db.engine)
+    with db.engine.connect() as conn:
+        first_user_id = (conn.execute(select(func.max(User.user_id))).scalar() or 0) + 1
+
+    think_time = Latency(args.think_time, args.seed or 0)
+    rounds = min(args.rounds or MAX_ROUNDS, MAX_ROUNDS)
+    stats = LoadStats()
+    rng = random.Random(args.seed)
+
+    async def dialogue(client, user_id: int) -> None:
+        started = await stats.call(client, "POST", "/chat", 0, json={"user_id": user_id})
+        if started is None:
+            return
+        session_id = started["session_id"]
+        for round_number in range(1, rounds + 1):
+            await think_time.asleep()
+            answer = _ANSWERS[(round_number - 1) % len(_ANSWERS)]
+            await stats.call(client, "POST", "/chat", round_number,
+                             json={"user_id": user_id, "session_id": session_id, "answer": answer})
+        if await stats.call(client, "POST", "/save_conversation", None,
+                            params={"session_id": session_id, "user_id": user_id}) is not None:
+            stats.sessions_completed += 1
+
+    async def couple(client, index: int) -> None:
+        # 開始時刻をramp-upの範囲でずらし、全夫婦が同時に始めないようにする
+        await asyncio.sleep(rng.uniform(0, args.ramp_up))
+        user_ids = (first_user_id + index * 2, first_user_id + index * 2 + 1)
+        couple_id = f"load-{first_user_id}-{index}"
+        for user_id in user_ids:
+            await stats.call(client, "POST", "/register", None, json={
+                "user_id": user_id, "name": f"user{user_id}", "gender": "男" if user_id % 2 else "女",
+                "birthday": "1990-01-01T00:00:00", "personality": "ENFJ", "couple_id": couple_id,
+            })
+        for _ in range(args.iterations):
+            await asyncio.gather(*(dialogue(client, user_id) for user_id in user_ids))
+            for path in ("/structured_vector_search/fixed_all", "/report_reminding", "/dialogue_advice"):
+                await think_time.asleep()
+                await asyncio.gather(*(stats.call(client, "GET", path, None, params={"user_id": user_id})
+                                       for user_id in user_ids))
+
+    await api.app.router.startup()
+    started = time.perf_counter()
+    monitors = [
+        asyncio.create_task(monitor_loop_lag(stats, args.lag_interval)),
+        asyncio.create_task(sample_timeline(stats, api.sessions, args.sample_interval, started)),
+    ]
+    try:
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=None) as client:
+            await asyncio.gather(*(couple(client, i) for i in range(args.couples)))
+    finally:
+        stats.elapsed = time.perf_counter() - started
+        for task in monitors:
+            task.cancel()
+        stats.final_store = session_store_stats(api.sessions)
+        await api.app.router.shutdown()
+        await db.async_engine.dispose()
+    return stats
+
+
+def _summary(values: list) -> str:
+    values = sorted(values)
+    if not values:
+        return "-"
+    return (f"{len(values):>6} {percentile(values, 0.5) * 1000:>9.1f} {percentile(values, 0.95) * 1000:>9.1f} "
+            f"{percentile(values, 0.99) * 1000:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="夫婦単位の対話シナリオで負荷をかける")
+    parser.add_argument("--url", default="sqlite:///load_scenario.db")
+    parser.add_argument("--couples", type=int, default=20, help="同時に対話する夫婦の数")
+    parser.add_argument("--iterations", type=int, default=1, help="1組あたりの繰り返し回数（対話→レポート）")
+    parser.add_argument("--rounds", type=int, default=None, help="1セッションの回答数（既定はMAX_ROUNDS）")
+    parser.add_argument("--think-time", default="lognormal:2000:0.5", help="回答までの考える時間の分布（ミリ秒）")
+    parser.add_argument("--ramp-up", type=float, default=10.0, help="夫婦の開始時刻をずらす範囲（秒）")
+    parser.add_argument("--sample-interval", type=float, default=5.0, help="推移を出力する間隔（秒）")
+    parser.add_argument("--lag-interval", type=float, default=0.05, help="イベントループの遅延を測る間隔（秒）")
+    parser.add_argument("--llm-latency", default=None, help="例: fixed:50 / uniform:20:80 / lognormal:800:0.4")
+    parser.add_argument("--embeddings-latency", default=None)
+    parser.add_argument("--nlp-latency", default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--keep-db", action="store_true", help="SQLiteのファイルを削除せずに続けて使う")
+    args = parser.parse_args()
+
+    if args.url.startswith("sqlite:///") and not args.keep_db:
+        Path(args.url[len("sqlite:///"):]).unlink(missing_ok=True)
+    configure_environment(args)
+
+    stats = asyncio.run(run(args))
+
+    print(f"\n所要時間 {stats.elapsed:.1f}s / 完了セッション {stats.sessions_completed} 件 "
+          f"({stats.sessions_completed / stats.elapsed:.2f} 件/s)")
+    print(f"\n{'round':<38} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for round_number in sorted(stats.round_latencies):
+        label = "開始（/chat）" if round_number == 0 else f"ラウンド{round_number}（/chat）"
+        print(f"{label:<38} {_summary(stats.round_latencies[round_number])}")
+    print(f"\n{'endpoint':<38} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>6}")
+    for path, values in stats.endpoint_latencies.items():
+        print(f"{path:<38} {_summary(values)} {stats.errors[path]:>6}")
+
+    lags = sorted(stats.loop_lags)
+    if lags:
+        print(f"\nイベントループの遅延: p50 {percentile(lags, 0.5) * 1000:.1f} ms / "
+              f"p99 {percentile(lags, 0.99) * 1000:.1f} ms / 最大 {lags[-1] * 1000:.1f} ms")
+    if stats.timeline:
+        first, last = stats.timeline[0], stats.timeline[-1]
+        print(f"RSS: {first['rss_bytes'] / 2**20:.1f} MiB → {last['rss_bytes'] / 2**20:.1f} MiB")
+    count, messages, content_bytes = stats.final_store
+    print(f"終了時のセッションストア: {count} 件 / {messages} メッセージ / {content_bytes / 1024:.1f} KiB"
+          f"（保存済みのセッションも含む）")
+    failures = {path: count for path, count in stats.errors.items() if count}
+    print("エラー: " + (", ".join(f"{k} {v}" for k, v in failures.items()) if failures else "なし"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# main.pyの読み込み（コールドスタート）にかかる時間を計測する
+# 新しいプロセスで`import main`を繰り返し実行して所要時間の中央値を求め、-X importtimeの結果から時間のかかったモジュールを表示する。
+# 読み込み時にLangChain・FAISS・Google NLPのクライアントなど重いモジュールがimportされていないことも確認する
+# 使い方: python -m benchmarks.startup_bench [--runs 5] [--top 15] [--budget-ms 1500]
+#         中央値が--budget-msを超えた場合、または重いモジュールが読み込まれた場合は終了コード1を返す
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# main.pyの読み込み時にimportされてはいけないモジュール（初回利用時またはウォームアップで読み込む）
+LAZY_MODULES = ("langchain", "langchain_community", "langchain_core", "faiss", "google.cloud.language_v1", "openai", "tiktoken")
+
+_CHILD = """
+import sys, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+loaded = [m for m in {lazy!r} if m in sys.modules]
+print(f"STARTUP {{elapsed:.6f}} {{','.join(loaded)}}", file=sys.stderr)
+"""
+
+
+def run_once(importtime: bool = False) -> tuple:
+    """新しいプロセスでmainを読み込み、(所要秒数, 読み込まれた重いモジュール, stderr)を返す"""
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ["-X", "importtime"]
+    cmd += ["-c", _CHILD.format(lazy=LAZY_MODULES)]
+    result = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True, env=os.environ.copy())
+    if result.returncode != 0:
+        raise RuntimeError(f"mainの読み込みに失敗しました:\n{result.stderr}")
+    line = next(l for l in result.stderr.splitlines() if l.startswith("STARTUP "))
+    parts = line.split(" ")
+    loaded = [m for m in parts[2].split(",") if m] if len(parts) > 2 else []
+    return float(parts[1]), loaded, result.stderr
+
+
+def top_imports(stderr: str, top: int) -> list:
+    """-X importtimeの出力から、累積時間の長いモジュールを返す（(累積マイクロ秒, 自身のマイクロ秒, モジュール名)）"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        rows.append((int(cumulative_us), int(self_us), name))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="main.pyの読み込み時間を計測する")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="表示する時間のかかったモジュールの数")
+    parser.add_argument("--budget-ms", type=float, default=None, help="読み込み時間の中央値の上限（ミリ秒）")
+    args = parser.parse_args()
+
+    # 1回目はバイトコードのキャッシュ作成を含むため捨てる
+    run_once()
+    timings = []
+    loaded = []
+    for _ in range(max(1, args.runs)):
+        seconds, loaded, _ = run_once()
+        timings.append(seconds * 1000)
+
+    median_ms = statistics.median(timings)
+    print(f"import main: median {median_ms:.1f} ms / min {min(timings):.1f} ms / max {max(timings):.1f} ms"
+          f" ({len(timings)} runs)")
+
+    _, _, stderr = run_once(importtime=True)
+    print(f"\n累積時間の長いモジュール（上位{args.top}件）")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative_us, self_us, name in top_imports(stderr, args.top):
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}")
+
+    failed = False
+    if loaded:
+        print(f"\n読み込み時にimportされた重いモジュール: {', '.join(loaded)}")
+        failed = True
+    if args.budget_ms is not None and median_ms > args.budget_ms:
+        print(f"\n読み込み時間の中央値 {median_ms:.1f} ms が上限 {args.budget_ms:.1f} ms を超えています")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
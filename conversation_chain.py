@@ -1,22 +1,63 @@
 ### conversation_chain.py ###
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
-from langchain.chat_models import ChatOpenAI
+# LangChainは読み込みに時間がかかるため、モジュールの読み込み時ではなく初回利用時にimportする
+# （アプリの起動を速くするため。ウォームアップはwarmup.pyがバックグラウンドで行う）
 from datetime import date
+from functools import lru_cache
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-llm = ChatOpenAI(openai_api_key=OPENAI_API_KEY, model_name="gpt-4o-mini", temperature=0.7)
-today = date.today().strftime("%Y年%m月%d日")
+# "fake"の場合はOpenAIを呼ばず、fake_backendsの決定的な応答を返すモデルを使う（ベンチマーク・ローカル開発用）
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+
+
+@lru_cache(maxsize=None)
+def get_llm():
+    """
+    アプリ全体で共有するChatOpenAIクライアント（初回呼び出し時に生成する）。
+    トークン数はコールバックで、呼び出し元（telemetry.stage()で指定した用途）ごとに集計する
+    """
+    from llm_callbacks import TokenUsageHandler
+    if LLM_BACKEND == "fake":
+        from fake_backends import FakeChatModel
+        return FakeChatModel(callbacks=[TokenUsageHandler()])
+    from langchain.chat_models import ChatOpenAI
+    return ChatOpenAI(openai_api_key=OPENAI_API_KEY, model_name="gpt-4o-mini", temperature=0.7,
+                      callbacks=[TokenUsageHandler()])
+
+
+def current_date() -> str:
+    """プロンプトに埋め込む今日の日付（プロセスの起動日ではなく、呼び出した日の日付）"""
+    return date.today().strftime("%Y年%m月%d日")
+
+# セッション冒頭のねぎらいの言葉（{name}はユーザー名に置換される）
+OPENING_GREETING = """{name}さん、今日も一日、お疲れさまでした。
+これから5つの質問をしますね。
+ときどき深掘りの質問もしますが、次に進みたいときは『スキップ』と気軽に伝えてください。
+それでは、最初の質問にいきましょう。"""
+
+# 順番に行う5つの質問（{partner_name}はパートナー名に置換される）
+QUESTIONS = [
+    "今日の満足度は10点満点中何点ですか？その点数に影響したことを思いつくままに書いてみてください。",
+    "{partner_name}さんに「本当は伝えたかったけれど、言えなかったこと」や「ちょっと飲み込んだ気持ち」はありますか？",
+    "最近、「{partner_name}さんとそろそろ話しておいた方がいいかも」「今のうちに向き合っておきたいな」と思っているテーマや気がかりなことはありますか？",
+    "{partner_name}さんとの関係の中で「助かったな」「嬉しかったな」と思ったことはありますか？日常の中の小さなことでもOKです！",
+    "明日の満足度を「今日より上げる」としたら、どんなことを意識したり、工夫したいと思いますか？具体的でも、ふわっとしたイメージでも大丈夫です。",
+]
+QUESTION_LIST = "\n".join(f"{i}. {q}" for i, q in enumerate(QUESTIONS, start=1))
+
+# 対話ラウンドの上限（system_promptの対話ルールと合わせる）
+MAX_ROUNDS = 10
+
+# セッション開始時にLLMへ渡していた入力（メモリ上の1ラウンド目のユーザー発言として残す）
+SESSION_START_INPUT = "セッション開始"
 
 # プロンプトテンプレート：partial_variablesでユーザー・パートナー情報を注入
 system_prompt = f"""
 あなたは夫婦やカップル向けにコーチングを実施する、家庭と夫婦の関係性を専門とする優秀なコーチです。
-現在の日付：{today}
+現在の日付：{{today}}
 
 【ユーザー情報】
 ユーザーID:{{user_id}}
@@ -34,28 +75,25 @@ system_prompt = f"""
 性格:{{partner_personality}}
 
 まずはねぎらいの言葉からスタートしましょう：
-「{{name}}さん、今日も一日、お疲れさまでした。
-これから5つの質問をしますね。
-ときどき深掘りの質問もしますが、次に進みたいときは『スキップ』と気軽に伝えてください。
-それでは、最初の質問にいきましょう。」
+「{OPENING_GREETING}」
 
-以下の5つの質問を順番に行います。全体の対話ラウンドは最大10回とし、10回に達した場合はこれまでの回答を踏まえて、約200文字程度の要約とポジティブな一言を添えて対話を締めくくります。
+以下の5つの質問を順番に行います。全体の対話ラウンドは最大{MAX_ROUNDS}回とし、{MAX_ROUNDS}回に達した場合はこれまでの回答を踏まえて、約200文字程度の要約とポジティブな一言を添えて対話を締めくくります。
 
-1. 今日の満足度は10点満点中何点ですか？その点数に影響したことを思いつくままに書いてみてください。
-2. {{partner_name}}さんに「本当は伝えたかったけれど、言えなかったこと」や「ちょっと飲み込んだ気持ち」はありますか？
-3. 最近、「{{partner_name}}さんとそろそろ話しておいた方がいいかも」「今のうちに向き合っておきたいな」と思っているテーマや気がかりなことはありますか？
-4. {{partner_name}}さんとの関係の中で「助かったな」「嬉しかったな」と思ったことはありますか？日常の中の小さなことでもOKです！
-5. 明日の満足度を「今日より上げる」としたら、どんなことを意識したり、工夫したいと思いますか？具体的でも、ふわっとしたイメージでも大丈夫です。
+{QUESTION_LIST}
 
 
 【対話ルール】
 ・各質問に対して、ユーザーの回答に対し温かく共感的なフィードバック（約100文字）を提供してください。
 ・回答内容が十分でない場合は、内容を掘り下げるための追加質問を行いますが、各質問につき追加質問は最大2回までとします。
 ・ユーザーが「スキップ」と回答した場合は、その質問の追加掘り下げを中断し、次の質問へ進んでください。
-・全体のラウンドは10回までとし、10回に到達した時点でこれまでの回答を総合して、約200文字程度のサマリーとポジティブな一言を添えて対話を締めくくってください。
+・全体のラウンドは{MAX_ROUNDS}回までとし、{MAX_ROUNDS}回に到達した時点でこれまでの回答を総合して、約200文字程度のサマリーとポジティブな一言を添えて対話を締めくくってください。
 """
 
 def create_conversation_chain(user,partner):
+    from langchain.chains import ConversationChain
+    from langchain.memory import ConversationBufferMemory
+    from langchain.prompts import PromptTemplate
+
     # partnerが見つからなかった場合は「情報なし」を設定
     partner_data = {
         "partner_user_id":partner.user_id if partner else "情報なし",
@@ -69,7 +107,7 @@ def create_conversation_chain(user,partner):
     prompt_template = PromptTemplate(
         input_variables=["input","chat_history"],
         partial_variables={
-            "today": today,
+            "today": current_date(),
             "user_id": user.user_id,
             "name": user.name,
             "gender": user.gender,
@@ -82,8 +120,27 @@ def create_conversation_chain(user,partner):
     )
 
     chain = ConversationChain(
-        llm=llm,
+        llm=get_llm(),
         memory=memory,
         prompt=prompt_template
     )
-    return chain
\ No newline at end of file
+    return chain
+
+def render_opening_message(user, partner) -> str:
+    """
+    セッション冒頭のコーチ発言（ねぎらいの言葉＋最初の質問）をテンプレートから生成する。
+    LLMを呼ばずにsystem_promptと同じ文面を返す。
+    """
+    partner_name = partner.name if partner else "情報なし"
+    greeting = OPENING_GREETING.format(name=user.name)
+    first_question = QUESTIONS[0].format(partner_name=partner_name)
+    return f"{greeting}\n\n1. {first_question}"
+
+def start_conversation(chain, user, partner) -> str:
+    """
+    テンプレートで生成した冒頭メッセージをコーチの最初の発言としてメモリに登録し、その文面を返す。
+    以降のラウンドは従来通りchain.predictで継続できる。
+    """
+    opening = render_opening_message(user, partner)
+    chain.memory.save_context({"input": SESSION_START_INPUT}, {"response": opening})
+    return opening
@@ -0,0 +1,81 @@
+# ユーザーとパートナーのプロフィールをプロセス内でキャッシュする
+# 夫婦の組み合わせはほとんど変わらないため、ほぼ全エンドポイントで行っていたパートナー検索をキャッシュから返す
+# 件数上限（LRU）とTTLを持ち、/registerで夫婦の構成が変わったときは明示的に無効化する
+import os
+import time
+from collections import OrderedDict
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud
+from metrics import Counter, Gauge
+
+COUPLE_CACHE_MAX_SIZE = int(os.getenv("COUPLE_CACHE_MAX_SIZE", "10000"))
+COUPLE_CACHE_TTL = float(os.getenv("COUPLE_CACHE_TTL", "600"))
+# パートナーが未登録のユーザーのTTL（秒）。パートナーの登録を別のワーカーが受け付けた場合、
+# このワーカーのキャッシュは無効化されないため、数秒で取り直してパートナーが見えるようにする
+COUPLE_CACHE_SOLO_TTL = float(os.getenv("COUPLE_CACHE_SOLO_TTL", "5"))
+
+cache_requests = Counter("couple_cache_requests_total", "夫婦キャッシュの参照回数", ("result",))
+cache_size = Gauge("couple_cache_size", "夫婦キャッシュに保持しているユーザー数")
+
+
+class CoupleCache:
+    def __init__(self, max_size: int = COUPLE_CACHE_MAX_SIZE, ttl: float = COUPLE_CACHE_TTL,
+                 solo_ttl: float = COUPLE_CACHE_SOLO_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.solo_ttl = solo_ttl
+        # user_id -> (有効期限, UserProfile, パートナーのUserProfileまたはNone)
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _key(user_id) -> str:
+        return str(user_id)
+
+    async def get(self, session: AsyncSession, user_id):
+        """
+        crud.get_user_and_partnerと同じ(user, partner)を返す。
+        キャッシュに有効なエントリがあればDBを参照しない。
+        """
+        key = self._key(user_id)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            cache_requests.inc(result="hit")
+            return entry[1], entry[2]
+
+        cache_requests.inc(result="miss")
+        user, partner = await crud.get_user_and_partner(session, user_id)
+        # 存在しないユーザーはキャッシュしない（登録直後に参照できるようにするため）
+        if user is not None:
+            self.put(user, partner)
+        return user, partner
+
+    def put(self, user, partner) -> None:
+        key = self._key(user.user_id)
+        ttl = self.ttl if partner is not None else min(self.ttl, self.solo_ttl)
+        if ttl <= 0:
+            self._entries.pop(key, None)
+            cache_size.set(len(self._entries))
+            return
+        self._entries[key] = (time.monotonic() + ttl, user, partner)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        cache_size.set(len(self._entries))
+
+    def invalidate(self, user_id=None, couple_id: str = None) -> None:
+        """指定したユーザー、または指定した夫婦に属するユーザーのエントリを削除する"""
+        if user_id is not None:
+            self._entries.pop(self._key(user_id), None)
+        if couple_id is not None:
+            for key, (_, user, partner) in list(self._entries.items()):
+                if user.couple_id == couple_id or (partner is not None and partner.couple_id == couple_id):
+                    self._entries.pop(key, None)
+        cache_size.set(len(self._entries))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        cache_size.set(0)
+
+
+couple_cache = CoupleCache()
@@ -1,85 +1,132 @@
-from sqlalchemy import create_engine, insert, delete, update, select
-from sqlalchemy.orm import sessionmaker
+# 役割：エンドポイントから使うDBアクセス（リポジトリ層）をまとめる
+# セッションはdb.pyのファクトリから依存関数経由で受け取り、ORMオブジェクトではなく軽量なdataclassを返す
+# JSONへの変換はHTTPレスポンスを返す時点で一度だけ行う（ここではシリアライズしない）
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import insert, select, and_, func
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
-import json
-from datetime import datetime
-from typing import Any, Dict, List
-
-from db import engine
-from models import UserReflections, User  # Userモデルも追加でインポート
-
-def myinsert(mymodel: Any, values: Dict[str, Any]) -> str:
-    """データ挿入関数（変更なし）"""
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    
+from sqlalchemy.orm import aliased
+
+from models import UserReflections, User, GenderEnum
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UserProfile:
+    """チェーンの生成やパートナー判定に使うユーザー情報"""
+    user_id: int
+    name: str
+    gender: GenderEnum
+    birthday: Optional[date]
+    personality: str
+    couple_id: Optional[str]
+
+
+@dataclass(frozen=True)
+class ReflectionRow:
+    reflection_id: str
+    user_id: str
+    future_plans: str
+    want_to_discuss: str
+    created_at: Optional[datetime]
+
+
+_PROFILE_FIELDS = ("user_id", "name", "gender", "birthday", "personality", "couple_id")
+_REFLECTION_COLUMNS = (
+    UserReflections.reflection_id,
+    UserReflections.user_id,
+    UserReflections.future_plans,
+    UserReflections.want_to_discuss,
+    UserReflections.created_at,
+)
+
+
+async def myinsert(session: AsyncSession, mymodel: Any, values: Dict[str, Any]) -> str:
+    """データ挿入関数"""
     try:
         query = insert(mymodel).values(values)
-        session.execute(query)
-        session.commit()
+        await session.execute(query)
+        await session.commit()
         return "inserted"
     except SQLAlchemyError as e:
-        session.rollback()
-        print(f"Insert error: {str(e)}")
+        await session.rollback()
+        logger.error(f"Insert error: {str(e)}")
         return f"insert failed: {str(e)}"
-    finally:
-        session.close()
-
-def myselect(mymodel: Any, user_id: str) -> str:
-    """ユーザーIDに基づく振り返りデータ取得関数（変更なし）"""
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    
-    try:
-        query = session.query(mymodel).filter(mymodel.user_id == user_id)
-        results = query.all()
-        
-        result_list = []
-        for reflection in results:
-            result_list.append({
-                "reflection_id": reflection.reflection_id,
-                "user_id": reflection.user_id,
-                "future_plans": reflection.future_plans,
-                "want_to_discuss": reflection.want_to_discuss,
-                "created_at": reflection.created_at.isoformat() if reflection.created_at else None
-            })
-        
-        return json.dumps(result_list, ensure_ascii=False)
-    
-    except SQLAlchemyError as e:
-        print(f"Database error: {str(e)}")
-        return json.dumps({"error": str(e)}, ensure_ascii=False)
-    
-    finally:
-        session.close()
 
-def get_user_by_id(user_id: str) -> User:
+
+async def list_reflections(session: AsyncSession, user_id: str, limit: Optional[int] = None) -> List[ReflectionRow]:
+    """ユーザーIDに基づく振り返りデータを取得する（limitを指定した場合は新しい順にlimit件）"""
+    stmt = select(*_REFLECTION_COLUMNS).where(UserReflections.user_id == str(user_id))
+    if limit is not None:
+        stmt = stmt.order_by(UserReflections.created_at.desc()).limit(limit)
+    result = await session.execute(stmt)
+    return [ReflectionRow(*row) for row in result.all()]
+
+
+async def reflections_version(session: AsyncSession, user_id: str) -> Tuple[int, Optional[datetime]]:
+    """振り返りの件数と最新の作成日時（HTTPキャッシュの検証子に使う。インデックスだけで求まる）"""
+    result = await session.execute(
+        select(func.count(), func.max(UserReflections.created_at)).where(UserReflections.user_id == str(user_id))
+    )
+    count, latest = result.one()
+    return count, latest
+
+
+async def get_reflection(session: AsyncSession, reflection_id: str) -> Optional[ReflectionRow]:
+    """振り返りIDから1件の振り返りデータを取得する"""
+    result = await session.execute(
+        select(*_REFLECTION_COLUMNS).where(UserReflections.reflection_id == reflection_id)
+    )
+    row = result.first()
+    return ReflectionRow(*row) if row else None
+
+
+async def get_user_by_id(session: AsyncSession, user_id: int) -> Optional[UserProfile]:
     """ユーザーIDからユーザー情報を取得する"""
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    
-    try:
-        user = session.query(User).filter(User.user_id == user_id).first()
-        return user
-    except SQLAlchemyError as e:
-        print(f"Error in get_user_by_id: {str(e)}")
-        return None
-    finally:
-        session.close()
-
-def get_partner(couple_id: str, user_id: str) -> User:
-    """同じcouple_idを持つパートナーを取得する"""
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    
-    try:
-        partner = session.query(User).filter(
-            User.couple_id == couple_id,
-            User.user_id != user_id
-        ).first()
-        return partner
-    except SQLAlchemyError as e:
-        print(f"Error in get_partner: {str(e)}")
-        return None
-    finally:
-        session.close()
+    result = await session.execute(
+        select(*(getattr(User, field) for field in _PROFILE_FIELDS)).where(User.user_id == user_id)
+    )
+    row = result.first()
+    return UserProfile(*row) if row else None
+
+
+def user_and_partner_query(user_id: int):
+    """ユーザーとパートナーを自己結合で取得するSELECT文"""
+    Partner = aliased(User)
+    return (
+        select(
+            *(getattr(User, field) for field in _PROFILE_FIELDS),
+            *(getattr(Partner, field) for field in _PROFILE_FIELDS),
+        )
+        .outerjoin(Partner, and_(Partner.couple_id == User.couple_id, Partner.user_id != User.user_id))
+        .where(User.user_id == user_id)
+        .limit(1)
+    )
+
+
+async def get_user_and_partner(session: AsyncSession, user_id: int) -> Tuple[Optional[UserProfile], Optional[UserProfile]]:
+    """
+    ユーザーと、同じcouple_idを持つパートナーを1回のクエリで取得する。
+    ユーザーが存在しない場合は(None, None)、パートナーがいない場合は(user, None)を返す。
+    """
+    row = (await session.execute(user_and_partner_query(user_id))).first()
+    if not row:
+        return None, None
+    size = len(_PROFILE_FIELDS)
+    user = UserProfile(*row[:size])
+    partner = UserProfile(*row[size:]) if row[size] is not None else None
+    return user, partner
+
+
+async def get_couple_members(session: AsyncSession, couple_id: str) -> List[UserProfile]:
+    """couple_idに属するユーザーを取得する（users.couple_idのインデックスを使う）"""
+    result = await session.execute(
+        select(*(getattr(User, field) for field in _PROFILE_FIELDS))
+        .where(User.couple_id == couple_id)
+        .order_by(User.user_id)
+    )
+    return [UserProfile(*row) for row in result.all()]
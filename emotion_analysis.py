@@ -1,14 +1,43 @@
 ## emotion_analysis.py
 import logging
-from google.cloud import language_v1
-from langchain_core.output_parsers import JsonOutputParser
-from langchain.prompts import PromptTemplate
-from conversation_chain import llm
+import os
+import threading
+from conversation_chain import get_llm
+from telemetry import stage
+from token_budget import fit
+
+# "fake"の場合はGoogle NLPを呼ばず、fake_backendsの決定的なスコアを使う（ベンチマーク・ローカル開発用）
+NLP_BACKEND = os.getenv("NLP_BACKEND", "google")
 
 logging.basicConfig(level=logging.INFO)
 
+# Google NLPのクライアント（生成時に認証情報の読み込みとgRPCチャネルの準備が走るため、プロセスで1つだけ作って使い回す）
+_language_client = None
+_language_client_lock = threading.Lock()
+
+def get_language_client():
+    """Google NLPのクライアントを返す（初回呼び出し時にライブラリを読み込んで生成する）"""
+    global _language_client
+    if _language_client is None:
+        with _language_client_lock:
+            if _language_client is None:
+                if NLP_BACKEND == "fake":
+                    from fake_backends import FakeLanguageClient
+                    _language_client = FakeLanguageClient()
+                else:
+                    from google.cloud import language_v1
+                    _language_client = language_v1.LanguageServiceClient()
+    return _language_client
+
 # 1. ユーザー発言のみ抽出（JsonOutputParser使用）
-def extract_partner_mentions_llm(chat_history: str, partner_name: str = None) -> list:
+def extract_partner_mentions_llm(chat_history: str, partner_name: str = None, raise_errors: bool = False) -> list:
+    """
+    パートナーへの言及を抽出する。失敗した場合は空のリストを返す
+    （raise_errors=Trueなら例外を送出し、言及がなかった場合と区別できるようにする）
+    """
+    from langchain_core.output_parsers import JsonOutputParser
+    from langchain.prompts import PromptTemplate
+
     parser = JsonOutputParser()
     if partner_name:
         instruction = (
@@ -26,13 +55,19 @@ def extract_partner_mentions_llm(chat_history: str, partner_name: str = None) ->
         "\n出力は**文字列のJSONリスト**として、余計な説明や装飾を含めず返してください。"
         "\n{format_instructions}\n\n会話履歴:\n{chat_history}"
     )
+    # 長いセッションはトークン予算に収まるよう先に要約する（パートナーへの言及は原文のまま残す）
+    chat_history = fit(chat_history, "mentions", (
+        "ユーザーがパートナーについて述べた発言は「ユーザー:」の話者ラベルを付けて原文のまま残し、"
+        "それ以外の発言は短く要約してください。"
+    ))
     prompt = prompt_template.format(
         chat_history=chat_history,
         format_instructions=parser.get_format_instructions()
     )
     logging.info("パートナーへの言及部分をLLMで抽出中")
     try:
-        result = llm.invoke(prompt)
+        with stage("llm", "mentions"):
+            result = get_llm().invoke(prompt)
         if hasattr(result, "content"):
             result = result.content
         logging.info(f"LLM raw output:\n{result}")
@@ -42,13 +77,20 @@ def extract_partner_mentions_llm(chat_history: str, partner_name: str = None) ->
         return mentions
     except Exception as e:
         logging.error("LLM抽出中にエラーが発生しました: " + str(e))
+        if raise_errors:
+            raise
         return []
 
 # 2. 感情分析（Google NLP）
 def analyze_sentiment(text: str):
-    client = language_v1.LanguageServiceClient()
-    document = language_v1.Document(content=text, type_=language_v1.Document.Type.PLAIN_TEXT)
-    response = client.analyze_sentiment(document=document)
+    client = get_language_client()
+    if NLP_BACKEND == "fake":
+        document = {"content": text}
+    else:
+        from google.cloud import language_v1
+        document = language_v1.Document(content=text, type_=language_v1.Document.Type.PLAIN_TEXT)
+    with stage("nlp", "sentiment"):
+        response = client.analyze_sentiment(document=document)
     sentiment = response.document_sentiment
     return sentiment.score, sentiment.magnitude
 
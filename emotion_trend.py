@@ -0,0 +1,139 @@
+# 感情アラートのユーザー別・日別／週別の集計（emotion_trend_buckets）
+# save_conversationでアラートを保存するとき、同じトランザクションで該当する日と週のバケットに加算する。
+# 推移の表示はバケットを読むだけで済み、生のアラートの走査や感情分析のやり直しは行わない
+# （保持期間を過ぎて退避されたアラートの分も集計に残る）
+from datetime import date, datetime, timedelta
+from sqlalchemy import delete, distinct, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import upsert
+from models import EmotionAlert, EmotionTrendBucket
+
+GRANULARITIES = ("day", "week")
+_STEPS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+
+def bucket_start(granularity: str, day: date) -> date:
+    """dayを含むバケットの開始日（週は月曜始まり）"""
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def mean_score(weight_sum: float, weighted_score_sum: float, score_sum: float, count: int):
+    """感情強度で重み付けした平均スコア（強度がすべて0なら単純平均）"""
+    if weight_sum > 0:
+        return weighted_score_sum / weight_sum
+    if count:
+        return score_sum / count
+    return None
+
+
+async def record_alert(session: AsyncSession, user_id: int, score: float, magnitude: float, label: str,
+                       created_at: datetime) -> None:
+    """
+    アラート1件分を日と週のバケットに加算する。コミットは呼び出し側でアラートの保存と一緒に行う。
+    バケットの作成と加算は1文のupsertで行う（同じバケットを同時に更新しても、行ロック後の作成のようにデッドロックしない）。
+    """
+    dialect = session.bind.dialect.name
+    greatest = func.greatest if dialect == "mysql" else func.max
+    label_path = f'$."{label}"'
+    table = EmotionTrendBucket.__table__
+    for granularity in GRANULARITIES:
+        values = {
+            "user_id": user_id, "granularity": granularity,
+            "bucket_start": bucket_start(granularity, created_at.date()),
+            "alert_count": 1, "weight_sum": magnitude, "weighted_score_sum": score * magnitude, "score_sum": score,
+            "max_magnitude": magnitude, "label_counts": {label: 1}, "updated_at": datetime.utcnow(),
+        }
+        updates = {
+            "alert_count": table.c.alert_count + 1,
+            "weight_sum": table.c.weight_sum + magnitude,
+            "weighted_score_sum": table.c.weighted_score_sum + score * magnitude,
+            "score_sum": table.c.score_sum + score,
+            "max_magnitude": greatest(table.c.max_magnitude, magnitude),
+            "label_counts": func.json_set(
+                table.c.label_counts, label_path, func.coalesce(func.json_extract(table.c.label_counts, label_path), 0) + 1
+            ),
+            "updated_at": values["updated_at"],
+        }
+        await session.execute(upsert(dialect, table, values, ("user_id", "granularity", "bucket_start"), updates))
+
+
+async def emotion_trend(session: AsyncSession, user_id: int, granularity: str, buckets: int) -> list[dict]:
+    """
+    直近buckets個の期間の集計を古い順に返す（アラートのない期間はcount=0で埋める）。
+    (user_id, granularity, bucket_start)の一意インデックスの範囲読み取りだけで済む。
+    """
+    step = _STEPS[granularity]
+    latest = bucket_start(granularity, datetime.utcnow().date())
+    starts = [latest - step * i for i in reversed(range(buckets))]
+    rows = (await session.execute(
+        select(EmotionTrendBucket)
+        .where(EmotionTrendBucket.user_id == user_id,
+               EmotionTrendBucket.granularity == granularity,
+               EmotionTrendBucket.bucket_start >= starts[0])
+        .order_by(EmotionTrendBucket.bucket_start)
+    )).scalars().all()
+    by_start = {row.bucket_start: row for row in rows}
+
+    series = []
+    for start in starts:
+        row = by_start.get(start)
+        if row is None:
+            series.append({"start": start.isoformat(), "count": 0, "mean_score": None,
+                           "max_magnitude": None, "labels": {}, "dominant_label": None})
+            continue
+        score = mean_score(row.weight_sum, row.weighted_score_sum, row.score_sum, row.alert_count)
+        labels = row.label_counts or {}
+        series.append({
+            "start": start.isoformat(),
+            "count": row.alert_count,
+            "mean_score": None if score is None else round(score, 3),
+            "max_magnitude": round(row.max_magnitude, 3),
+            "labels": labels,
+            "dominant_label": max(labels, key=labels.get) if labels else None,
+        })
+    return series
+
+
+def backfill(conn, batch_size: int = 1000) -> None:
+    """
+    既存の感情アラートから集計を作り直す（マイグレーション用、同期接続）。
+    ユーザーをbatch_size人ずつ処理し、対象ユーザーの既存バケットを置き換えてからコミットする。
+    """
+    user_ids = conn.execute(select(distinct(EmotionAlert.user_id)).order_by(EmotionAlert.user_id)).scalars().all()
+    day = func.date(EmotionAlert.created_at).label("day")
+    for i in range(0, len(user_ids), batch_size):
+        chunk = user_ids[i:i + batch_size]
+        rows = conn.execute(
+            select(
+                EmotionAlert.user_id, day, EmotionAlert.label,
+                func.count(), func.sum(EmotionAlert.magnitude), func.sum(EmotionAlert.score * EmotionAlert.magnitude),
+                func.sum(EmotionAlert.score), func.max(EmotionAlert.magnitude),
+            )
+            .where(EmotionAlert.user_id.in_(chunk), EmotionAlert.created_at.is_not(None))
+            .group_by(EmotionAlert.user_id, day, EmotionAlert.label)
+        ).all()
+
+        buckets = {}
+        for user_id, row_day, label, count, weight, weighted, score_sum, max_magnitude in rows:
+            # MySQLはdate型、SQLiteは文字列で返るため揃える
+            row_day = row_day if isinstance(row_day, date) else date.fromisoformat(str(row_day))
+            for granularity in GRANULARITIES:
+                key = (user_id, granularity, bucket_start(granularity, row_day))
+                bucket = buckets.setdefault(key, {
+                    "user_id": key[0], "granularity": key[1], "bucket_start": key[2], "alert_count": 0,
+                    "weight_sum": 0.0, "weighted_score_sum": 0.0, "score_sum": 0.0, "max_magnitude": 0.0,
+                    "label_counts": {}, "updated_at": datetime.utcnow(),
+                })
+                bucket["alert_count"] += count
+                bucket["weight_sum"] += weight or 0.0
+                bucket["weighted_score_sum"] += weighted or 0.0
+                bucket["score_sum"] += score_sum or 0.0
+                bucket["max_magnitude"] = max(bucket["max_magnitude"], max_magnitude or 0.0)
+                bucket["label_counts"][label] = bucket["label_counts"].get(label, 0) + count
+
+        conn.execute(delete(EmotionTrendBucket).where(EmotionTrendBucket.user_id.in_(chunk)))
+        if buckets:
+            conn.execute(insert(EmotionTrendBucket), list(buckets.values()))
+        conn.commit()
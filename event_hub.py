@@ -0,0 +1,293 @@
+# ユーザーごとのServer-Sent Events配信
+# 新しい感情アラート・ベクトル要約・対話アドバイスがコミットされた時点でイベントを発行し、
+# /events/streamで接続中のクライアントへ送る（クライアントは初回だけGETで状態を取得し、以降はポーリングしない）
+# ワーカー間の配送とイベントIDの採番はPubSubBackendに任せる。既定のLocalPubSubは同一プロセス内だけで配送するスタンドインで、
+# 複数ワーカー構成ではEVENT_PUBSUB_BACKEND=databaseにし、eventsテーブルを介して全ワーカーへ配送する
+# （Redisなどのpub/subを使う場合も同じインターフェースで実装して差し替える）
+import abc
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+import orjson
+from sqlalchemy import delete, func, select
+from metrics import Counter, Gauge
+from models import EventLog
+
+logger = logging.getLogger(__name__)
+
+EVENT_PUBSUB_BACKEND = os.getenv("EVENT_PUBSUB_BACKEND", "local")
+EVENT_CHANNEL = os.getenv("EVENT_CHANNEL", "futari-events")
+# 接続がないときに送るコメント行の間隔（秒）。プロキシのアイドルタイムアウトで切断されないようにする
+EVENTS_HEARTBEAT_INTERVAL = float(os.getenv("EVENTS_HEARTBEAT_INTERVAL", "15"))
+# 1接続あたりの未送信イベントの上限。超えた場合は古いものから捨てる
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+# 再接続時（Last-Event-ID）に再送するため、ユーザーごとに保持する直近のイベント数と保持するユーザー数
+EVENTS_REPLAY_SIZE = int(os.getenv("EVENTS_REPLAY_SIZE", "20"))
+EVENTS_REPLAY_USERS = int(os.getenv("EVENTS_REPLAY_USERS", "10000"))
+# クライアントの再接続までの待ち時間（ミリ秒）
+EVENTS_RETRY_MS = 5000
+# databaseバックエンドの設定：eventsテーブルをポーリングする間隔（秒）、1回に読む行数、
+# idの欠番が埋まるのを待つ時間の上限（秒。発行は1行のINSERTだけの短いトランザクションのため短くてよい）、起動時に読み直す直近のイベントの範囲（秒）、行を残す時間（秒）
+EVENTS_DB_POLL_INTERVAL = float(os.getenv("EVENTS_DB_POLL_INTERVAL", "0.5"))
+EVENTS_DB_BATCH_SIZE = int(os.getenv("EVENTS_DB_BATCH_SIZE", "500"))
+EVENTS_DB_GAP_SECONDS = float(os.getenv("EVENTS_DB_GAP_SECONDS", "1"))
+EVENTS_DB_REPLAY_SECONDS = float(os.getenv("EVENTS_DB_REPLAY_SECONDS", "300"))
+EVENTS_DB_KEEP_SECONDS = float(os.getenv("EVENTS_DB_KEEP_SECONDS", "3600"))
+EVENTS_DB_PRUNE_INTERVAL = 60.0
+
+sse_connections = Gauge("sse_connections", "接続中のSSEクライアント数")
+events_published = Counter("events_published_total", "発行したイベント数", ("event",))
+events_dropped = Counter("events_dropped_total", "送信待ちの上限を超えて捨てたイベント数")
+
+
+class PubSubBackend(abc.ABC):
+    """ワーカー間でイベントを配送するバックエンドのインターフェース（イベントIDの採番もバックエンドが行う）"""
+
+    @abc.abstractmethod
+    async def publish(self, channel: str, message: bytes) -> None:
+        ...
+
+    @abc.abstractmethod
+    def subscribe(self, channel: str) -> AsyncIterator[tuple]:
+        """
+        channelに発行されたメッセージを(イベントID, メッセージ)の組でIDの昇順に返す非同期イテレータ。
+        イベントIDは購読している全ワーカーで同じ値になること（Last-Event-IDでの再送に使う）
+        """
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalPubSub(PubSubBackend):
+    """同一プロセス内だけで配送するpub/sub（単一ワーカーと開発環境向けのスタンドイン）"""
+
+    def __init__(self):
+        self._queues = {}
+        # 再起動後もIDが前のプロセスより大きくなるよう、起動時刻（ナノ秒）から採番する
+        self._ids = itertools.count(time.time_ns())
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        event_id = next(self._ids)
+        for queue in self._queues.get(channel, ()):
+            queue.put_nowait((event_id, message))
+
+    async def subscribe(self, channel: str):
+        queue = asyncio.Queue()
+        self._queues.setdefault(channel, set()).add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._queues[channel].discard(queue)
+
+
+class DatabasePubSub(PubSubBackend):
+    """
+    eventsテーブルを介して、同じDBを使う全ワーカー（別プロセス・別ホスト）へ配送するpub/sub。
+    発行は1行のINSERTで、自動採番のidがそのままイベントIDになる。各ワーカーは前回より大きいidの行をポーリングで読む。
+    MySQLの自動採番はコミット順と一致しないため、idに欠番があれば先に採番された行がまだコミットされうる間だけ待つ。
+    欠番の直後の行が作られてからEVENTS_DB_GAP_SECONDS以上経っていれば、欠番の行はロールバックか削除済みとみなしてすぐに先へ進む
+    """
+
+    def __init__(self, session_factory=None):
+        if session_factory is None:
+            from db import AsyncSessionLocal
+            session_factory = AsyncSessionLocal
+        self._session_factory = session_factory
+        # 配送済みの最大id（購読が切れて再接続した場合はここから続きを読む）
+        self._last_id = None
+        self._pruned_at = 0.0
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        async with self._session_factory() as session:
+            session.add(EventLog(channel=channel, payload=message))
+            await session.commit()
+
+    async def _start_id(self, session) -> int:
+        # 再起動したワーカーでも再送できるよう、直近EVENTS_DB_REPLAY_SECONDS分のイベントから読み始める
+        cutoff = datetime.utcnow() - timedelta(seconds=EVENTS_DB_REPLAY_SECONDS)
+        return await session.scalar(select(func.coalesce(func.max(EventLog.id), 0)).where(EventLog.created_at < cutoff))
+
+    async def _prune(self, session) -> None:
+        # 古い行は全ワーカーが配送済みのため削除する（どのワーカーが行っても同じ結果になる）
+        if time.monotonic() - self._pruned_at < EVENTS_DB_PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.monotonic()
+        cutoff = datetime.utcnow() - timedelta(seconds=EVENTS_DB_KEEP_SECONDS)
+        await session.execute(delete(EventLog).where(EventLog.created_at < cutoff))
+        await session.commit()
+
+    @staticmethod
+    def _may_fill(row, gap_since: float) -> bool:
+        """欠番の直後のrowより前に採番された行が、まだコミットされる可能性があるか"""
+        # 欠番の行はrowより先に採番されているため、rowが作られてから時間が経っていればトランザクションは終わっている
+        if row.created_at is not None and datetime.utcnow() - row.created_at >= timedelta(seconds=EVENTS_DB_GAP_SECONDS):
+            return False
+        # ワーカー間の時計のずれがあっても、このワーカーで待つのはEVENTS_DB_GAP_SECONDSまでにする
+        return time.monotonic() - gap_since < EVENTS_DB_GAP_SECONDS
+
+    async def subscribe(self, channel: str):
+        gap_since = None
+        while True:
+            async with self._session_factory() as session:
+                if self._last_id is None:
+                    self._last_id = await self._start_id(session)
+                rows = (await session.execute(
+                    select(EventLog.id, EventLog.channel, EventLog.payload, EventLog.created_at)
+                    .where(EventLog.id > self._last_id).order_by(EventLog.id).limit(EVENTS_DB_BATCH_SIZE)
+                )).all()
+                await session.rollback()
+                await self._prune(session)
+            waiting = False
+            for row in rows:
+                if row.id != self._last_id + 1:
+                    # 先に採番された行がまだコミットされていない可能性がある間だけ待ち、それ以外は欠番とみなす
+                    gap_since = gap_since or time.monotonic()
+                    if self._may_fill(row, gap_since):
+                        waiting = True
+                        break
+                gap_since = None
+                self._last_id = row.id
+                # チャンネルが異なる行もidは共通のため、読み飛ばして進める
+                if row.channel == channel:
+                    yield row.id, row.payload
+            if waiting or len(rows) < EVENTS_DB_BATCH_SIZE:
+                await asyncio.sleep(EVENTS_DB_POLL_INTERVAL)
+
+
+def create_backend(name: str = EVENT_PUBSUB_BACKEND) -> PubSubBackend:
+    if name == "local":
+        return LocalPubSub()
+    if name == "database":
+        return DatabasePubSub()
+    raise ValueError(f"未対応のpub/subバックエンドです: {name}")
+
+
+def format_sse(message: dict) -> bytes:
+    data = orjson.dumps(message["data"]).decode()
+    return f"id: {message['id']}\nevent: {message['event']}\ndata: {data}\n\n".encode()
+
+
+class EventHub:
+    """
+    バックエンドのチャンネルを1ワーカーにつき1回だけ購読し、受け取ったイベントを宛先ユーザーの接続へ振り分ける。
+    """
+
+    def __init__(self, backend: PubSubBackend, channel: str = EVENT_CHANNEL):
+        self.backend = backend
+        self.channel = channel
+        # user_id -> 接続ごとのキューの集合
+        self._subscribers = {}
+        # user_id -> 直近のイベント（再接続時の再送用）
+        self._recent = OrderedDict()
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._pump())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.backend.close()
+
+    async def publish(self, user_ids, event: str, data: dict) -> None:
+        """
+        user_idsのユーザーへイベントを発行する。コミット後に呼ぶこと。
+        配信に失敗しても呼び出し元の処理（保存）は成功しているため、例外は送出せずログに残す。
+        """
+        # イベントIDはバックエンドが採番し、購読側で付ける
+        message = {
+            "user_ids": [int(uid) for uid in user_ids if uid is not None],
+            "event": event,
+            "data": data,
+        }
+        try:
+            await self.backend.publish(self.channel, orjson.dumps(message))
+            events_published.inc(event=event)
+        except Exception as e:
+            logger.warning(f"[event_hub] イベントの発行に失敗: {event} {e}")
+
+    async def _pump(self) -> None:
+        while True:
+            try:
+                async for event_id, raw in self.backend.subscribe(self.channel):
+                    message = orjson.loads(raw)
+                    message["id"] = event_id
+                    self._dispatch(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[event_hub] 購読が切断されたため再接続します: {e}")
+                await asyncio.sleep(1)
+
+    def _dispatch(self, message: dict) -> None:
+        for user_id in message["user_ids"]:
+            recent = self._recent.get(user_id)
+            if recent is None:
+                recent = self._recent[user_id] = deque(maxlen=EVENTS_REPLAY_SIZE)
+                while len(self._recent) > EVENTS_REPLAY_USERS:
+                    self._recent.popitem(last=False)
+            self._recent.move_to_end(user_id)
+            recent.append(message)
+
+            for queue in self._subscribers.get(user_id, ()):
+                if queue.full():
+                    queue.get_nowait()
+                    events_dropped.inc()
+                queue.put_nowait(message)
+
+    def _replay(self, user_id: int, last_event_id) -> list:
+        try:
+            last_id = int(last_event_id)
+        except (TypeError, ValueError):
+            return []
+        return [m for m in self._recent.get(user_id, ()) if m["id"] > last_id]
+
+    async def stream(self, user_id: int, request, last_event_id: str = None):
+        """
+        1接続分のSSEストリーム（StreamingResponseに渡す非同期ジェネレータ）。
+        Last-Event-IDがあれば、このワーカーが保持している以降のイベントを先に再送する。
+        """
+        queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        sse_connections.inc()
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n".encode()
+            sent_id = 0
+            for message in self._replay(user_id, last_event_id):
+                sent_id = message["id"]
+                yield format_sse(message)
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=EVENTS_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield b": keepalive\n\n"
+                    continue
+                # 再送済みのイベントがキューにも入っている場合は送らない
+                if message["id"] <= sent_id:
+                    continue
+                sent_id = message["id"]
+                yield format_sse(message)
+        finally:
+            queues = self._subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    self._subscribers.pop(user_id, None)
+            sse_connections.dec()
+
+
+event_hub = EventHub(create_backend())
@@ -0,0 +1,199 @@
+# 役割：ベンチマーク・ローカル開発用の外部サービスのスタンドイン（OpenAI・埋め込み・Google NLP）
+# LLM_BACKEND / EMBEDDINGS_BACKEND / NLP_BACKEND に"fake"を指定すると、各モジュールのクライアント生成処理がこちらを返す。
+# 応答は入力のハッシュから決定的に作り、structured_parser・reminder_perser・emotion_analysisがそのまま解析できる形に揃える。
+# 応答までの待ち時間は分布で指定する（"fixed:50"、"uniform:20:80"、"lognormal:800:0.4"（中央値のミリ秒:σ））
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import time
+from types import SimpleNamespace
+from typing import Any, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+FAKE_LLM_LATENCY = os.getenv("FAKE_LLM_LATENCY", "lognormal:800:0.4")
+FAKE_EMBEDDINGS_LATENCY = os.getenv("FAKE_EMBEDDINGS_LATENCY", "fixed:30")
+FAKE_NLP_LATENCY = os.getenv("FAKE_NLP_LATENCY", "fixed:60")
+# 待ち時間の乱数のシード（応答の内容は入力だけで決まり、シードには依存しない）
+FAKE_SEED = int(os.getenv("FAKE_SEED", "0"))
+EMBEDDING_DIM = 256
+
+# StructuredOutputParserのフォーマット指示に含まれるフィールド定義（"name": string  // 説明）
+_FORMAT_FIELD = re.compile(r'"(\w+)": string\s+//')
+
+_PHRASES = (
+    "仕事が忙しく、家のことに手が回らなかった",
+    "週末に一緒に出かけられたのが嬉しかった",
+    "子どもの寝かしつけを代わってもらえて助かった",
+    "家計のことを一度ゆっくり話したい",
+    "疲れていて素っ気ない返事をしてしまった",
+    "感謝の気持ちをもっと言葉で伝えたい",
+    "朝の支度の分担を見直したい",
+    "最近ゆっくり話す時間が取れていない",
+)
+
+
+class Latency:
+    """応答までの待ち時間の分布"""
+
+    def __init__(self, spec: str, seed: int = FAKE_SEED):
+        kind, *params = spec.split(":")
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"未対応の待ち時間の分布です: {spec}")
+        self.kind = kind
+        self.params = [float(p) for p in params]
+        self._rng = random.Random(seed)
+
+    def sample(self) -> float:
+        """待ち時間（秒）"""
+        if self.kind == "fixed":
+            ms = self.params[0]
+        elif self.kind == "uniform":
+            ms = self._rng.uniform(self.params[0], self.params[1])
+        else:
+            median, sigma = self.params
+            ms = self._rng.lognormvariate(math.log(median), sigma)
+        return max(ms, 0.0) / 1000
+
+    def sleep(self) -> None:
+        time.sleep(self.sample())
+
+    async def asleep(self) -> None:
+        await asyncio.sleep(self.sample())
+
+
+llm_latency = Latency(FAKE_LLM_LATENCY)
+embeddings_latency = Latency(FAKE_EMBEDDINGS_LATENCY, FAKE_SEED + 1)
+nlp_latency = Latency(FAKE_NLP_LATENCY, FAKE_SEED + 2)
+
+
+def _digest(*parts: str) -> int:
+    return int.from_bytes(hashlib.blake2b("\x00".join(parts).encode(), digest_size=8).digest(), "big")
+
+
+def _phrase(*parts: str) -> str:
+    return _PHRASES[_digest(*parts) % len(_PHRASES)]
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（日本語は1文字あたり約1トークン）"""
+    return max(1, len(text))
+
+
+def fake_completion(prompt: str) -> str:
+    """
+    プロンプトに応じた決定的な応答を返す。
+    - StructuredOutputParserのフォーマット指示があれば、そのフィールドを埋めたJSONのコードブロック
+    - パートナーへの言及の抽出（文字列のJSONリスト）であれば、プロンプト中のユーザーの発言
+    - それ以外はコーチの返答やレポートとしての短い文章
+    """
+    fields = _FORMAT_FIELD.findall(prompt)
+    if fields:
+        values = {}
+        for name in dict.fromkeys(fields):
+            if name == "satisfaction_score":
+                values[name] = str(_digest(prompt, name) % 11)
+            elif name == "question_number":
+                values[name] = str(_digest(prompt, name) % 5 + 1)
+            else:
+                values[name] = f"{_phrase(prompt, name)}。"
+        return "```json\n" + json.dumps(values, ensure_ascii=False, indent=4) + "\n```"
+    if "JSONリスト" in prompt:
+        mentions = [line.split(":", 1)[1].strip() for line in prompt.splitlines() if line.startswith("ユーザー:")]
+        return json.dumps(mentions[-5:], ensure_ascii=False)
+    return f"お話ししてくださってありがとうございます。{_phrase(prompt)}のですね。もう少し詳しく教えていただけますか？"
+
+
+def _prompt_text(messages) -> str:
+    return "\n".join(m.content if isinstance(m.content, str) else json.dumps(m.content, ensure_ascii=False)
+                     for m in messages)
+
+
+class FakeChatModel(BaseChatModel):
+    """ChatOpenAIの代わりに使うチャットモデル（ConversationChainやinvokeからそのまま呼べる）"""
+
+    model_name: str = "fake-gpt-4o-mini"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _result(self, messages) -> ChatResult:
+        prompt = _prompt_text(messages)
+        content = fake_completion(prompt)
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt),
+            "completion_tokens": estimate_tokens(content),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))],
+            llm_output={"token_usage": usage, "model_name": self.model_name},
+        )
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        llm_latency.sleep()
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        await llm_latency.asleep()
+        return self._result(messages)
+
+
+class _FakeChatCompletion:
+    """openai.ChatCompletion（0.x）のうち、summarizer.gpt4o_mini_callが使うacreateだけを実装する"""
+
+    @staticmethod
+    async def acreate(model: str, messages: list, **kwargs):
+        await llm_latency.asleep()
+        prompt = "\n".join(m.get("content") or "" for m in messages)
+        content = fake_completion(prompt)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=estimate_tokens(prompt), completion_tokens=estimate_tokens(content)),
+            model=model,
+        )
+
+
+# summarizer.get_openai()がopenaiモジュールの代わりに返すオブジェクト
+fake_openai = SimpleNamespace(ChatCompletion=_FakeChatCompletion)
+
+
+class FakeEmbeddings(Embeddings):
+    """テキストのハッシュから作る決定的な正規化ベクトル（同じテキストは同じベクトルになる）"""
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+
+    def _vector(self, text: str) -> list:
+        vector = np.random.default_rng(_digest(text)).standard_normal(self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        embeddings_latency.sleep()
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        embeddings_latency.sleep()
+        return self._vector(text)
+
+
+class FakeLanguageClient:
+    """google.cloud.language_v1.LanguageServiceClientのうち、analyze_sentimentだけを実装する"""
+
+    def analyze_sentiment(self, document):
+        nlp_latency.sleep()
+        text = document["content"] if isinstance(document, dict) else document.content
+        digest = _digest(text)
+        # スコアは-1.0〜1.0、強度は0.0〜3.0の範囲に決定的に割り当てる
+        score = round((digest % 2001) / 1000 - 1.0, 3)
+        magnitude = round((digest >> 16) % 3001 / 1000, 3)
+        return SimpleNamespace(document_sentiment=SimpleNamespace(score=score, magnitude=magnitude))
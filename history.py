@@ -0,0 +1,100 @@
+# ユーザーの履歴データ（会話履歴・構造化データ・感情アラート・振り返り）の一覧取得とエクスポート
+# 一覧はpagination.fetch_pageによるキーセットページネーション、
+# エクスポートはサーバーサイドカーソル（yield_per）でNDJSONをストリーミングし、長期利用ユーザーでもメモリを一定に保つ
+from dataclasses import dataclass
+import orjson
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import ReadSessionLocal
+from models import ConversationHistory, StructuredAnswer, EmotionAlert, UserReflections
+from pagination import fetch_page
+from history_codec import LazyHistory
+
+# エクスポート時にDBから1回に取得する行数
+EXPORT_BATCH_SIZE = 500
+
+
+@dataclass(frozen=True)
+class HistorySource:
+    columns: tuple
+    user_col: object
+    created_col: object
+    id_col: object
+    # user_idの列が文字列型のテーブル（reflections）はTrue
+    user_id_as_str: bool = False
+    # 取得した行(dict)をレスポンス用に変換する関数
+    transform: object = None
+
+    def select_for(self, user_ids: list):
+        ids = [str(uid) for uid in user_ids] if self.user_id_as_str else user_ids
+        return select(*self.columns).where(self.user_col.in_(ids))
+
+
+def _decode_conversation(row: dict) -> dict:
+    """圧縮されたターン列（または旧形式のテキスト）を展開してturnsとして返す"""
+    record = LazyHistory(blob=row.pop("chat_turns"), legacy_text=row.pop("chat_history"))
+    row["turns"] = record.turns
+    return row
+
+
+SOURCES = {
+    "conversations": HistorySource(
+        columns=(ConversationHistory.id, ConversationHistory.user_id, ConversationHistory.session_id,
+                 ConversationHistory.chat_turns, ConversationHistory.chat_history, ConversationHistory.created_at),
+        user_col=ConversationHistory.user_id,
+        created_col=ConversationHistory.created_at,
+        id_col=ConversationHistory.id,
+        transform=_decode_conversation,
+    ),
+    "structured_answers": HistorySource(
+        columns=(StructuredAnswer.id, StructuredAnswer.user_id, StructuredAnswer.conversation_history_id,
+                 StructuredAnswer.answer_summary, StructuredAnswer.satisfaction_score, StructuredAnswer.created_at),
+        user_col=StructuredAnswer.user_id,
+        created_col=StructuredAnswer.created_at,
+        id_col=StructuredAnswer.id,
+    ),
+    "emotion_alerts": HistorySource(
+        columns=(EmotionAlert.id, EmotionAlert.user_id, EmotionAlert.conversation_history_id, EmotionAlert.label,
+                 EmotionAlert.emoji, EmotionAlert.message, EmotionAlert.score, EmotionAlert.magnitude,
+                 EmotionAlert.most_negative_mention, EmotionAlert.created_at),
+        user_col=EmotionAlert.user_id,
+        created_col=EmotionAlert.created_at,
+        id_col=EmotionAlert.id,
+    ),
+    "reflections": HistorySource(
+        columns=(UserReflections.reflection_id, UserReflections.user_id, UserReflections.future_plans,
+                 UserReflections.want_to_discuss, UserReflections.created_at),
+        user_col=UserReflections.user_id,
+        created_col=UserReflections.created_at,
+        id_col=UserReflections.reflection_id,
+        user_id_as_str=True,
+    ),
+}
+
+
+async def history_page(session: AsyncSession, kind: str, user_id, limit: int, cursor: str = None) -> dict:
+    """指定した種類の履歴を新しい順に1ページ分返す"""
+    source = SOURCES[kind]
+    page = await fetch_page(session, source.select_for([user_id]), source.created_col, source.id_col, limit, cursor)
+    if source.transform:
+        page["items"] = [source.transform(item) for item in page["items"]]
+    return page
+
+
+async def stream_ndjson(user_ids: list):
+    """
+    指定したユーザーの全履歴を1行1レコードのNDJSONとして順に返す非同期ジェネレータ。
+    レスポンスのストリーミング中もセッションを保持するため、リクエストの依存関数ではなく自前でセッションを開く。
+    """
+    async with ReadSessionLocal() as session:
+        for kind, source in SOURCES.items():
+            stmt = (source.select_for(user_ids)
+                    .order_by(source.user_col, source.created_col, source.id_col)
+                    .execution_options(yield_per=EXPORT_BATCH_SIZE))
+            result = await session.stream(stmt)
+            async for partition in result.partitions():
+                # 会話履歴はこの時点で1行ずつ展開する（全件を展開してから書き出さない）
+                rows = (dict(row._mapping) for row in partition)
+                if source.transform:
+                    rows = (source.transform(row) for row in rows)
+                yield b"".join(orjson.dumps({"type": kind, **row}) + b"\n" for row in rows)
@@ -0,0 +1,70 @@
+# 会話履歴を話者（ユーザー／コーチ）付きのターン列として、zstdで圧縮して保存・復元する
+# 保存形式: zstd圧縮した {"v": 1, "turns": [{"role": "user" | "coach", "content": "..."}]} のJSON
+# 読み出し側はLazyHistoryを受け取り、ターンやテキストが必要になった時点で初めて展開する
+from functools import cached_property
+import orjson
+import zstandard
+
+FORMAT_VERSION = 1
+COMPRESSION_LEVEL = 3
+
+# LangChainのメッセージ種別 -> 保存するロール名
+_ROLE_BY_MESSAGE_TYPE = {"human": "user", "ai": "coach"}
+
+# テキストに変換するときの話者ラベル
+ROLE_LABELS = {"user": "ユーザー", "coach": "コーチ"}
+
+
+def turns_from_messages(messages) -> list[dict]:
+    """ConversationBufferMemoryのメッセージ列をターンのリストに変換する"""
+    return [
+        {"role": _ROLE_BY_MESSAGE_TYPE.get(msg.type, msg.type), "content": msg.content}
+        for msg in messages
+    ]
+
+
+def encode_turns(turns: list[dict]) -> bytes:
+    payload = orjson.dumps({"v": FORMAT_VERSION, "turns": turns})
+    return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(payload)
+
+
+def decode_turns(blob: bytes) -> list[dict]:
+    payload = orjson.loads(zstandard.ZstdDecompressor().decompress(blob))
+    return payload["turns"]
+
+
+class LazyHistory:
+    """
+    保存された会話履歴のラッパー。turnsやas_textにアクセスするまで展開しない。
+    圧縮形式に移行する前の行（chat_historyのテキストのみ）も1つのターンとして扱う。
+    """
+
+    def __init__(self, blob: bytes = None, legacy_text: str = None, turns: list[dict] = None):
+        self._blob = blob
+        self._legacy_text = legacy_text
+        if turns is not None:
+            self.__dict__["turns"] = turns
+
+    @classmethod
+    def from_turns(cls, turns: list[dict]) -> "LazyHistory":
+        return cls(turns=turns)
+
+    @cached_property
+    def turns(self) -> list[dict]:
+        if self._blob is not None:
+            return decode_turns(self._blob)
+        if self._legacy_text:
+            return [{"role": "unknown", "content": self._legacy_text}]
+        return []
+
+    def as_text(self, with_roles: bool = True) -> str:
+        """LLMに渡すためのテキスト。with_rolesがTrueなら各行に話者ラベルを付ける"""
+        if with_roles:
+            return "\n".join(
+                f"{ROLE_LABELS[t['role']]}: {t['content']}" if t["role"] in ROLE_LABELS else t["content"]
+                for t in self.turns
+            )
+        return "\n".join(t["content"] for t in self.turns)
+
+    def encode(self) -> bytes:
+        return self._blob if self._blob is not None else encode_turns(self.turns)
@@ -0,0 +1,166 @@
+# 読み取り系エンドポイントのHTTPキャッシュ（ETag / Last-Modified / 304 Not Modified）
+# レスポンスの元になる行のidや作成日時から検証子（ETag）を作り、
+# クライアントのIf-None-Matchと一致すれば本文を作らずに304を返す。
+# 一致しない場合も、同じ検証子のレスポンスをプロセス内にキャッシュしておき、DB本体の取得やLLM呼び出しを省く
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import orjson
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse
+from metrics import Counter, Gauge
+
+RESPONSE_CACHE_MAX_SIZE = int(os.getenv("RESPONSE_CACHE_MAX_SIZE", "5000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+
+# ポーリングされるエンドポイントの既定値：ブラウザ/アプリ側に保存してよいが、毎回検証子で再検証させる
+DEFAULT_CACHE_CONTROL = "private, no-cache"
+
+cache_requests = Counter("http_cache_requests_total", "条件付きGETの結果", ("route", "result"))
+cache_size = Gauge("http_response_cache_size", "サーバー側レスポンスキャッシュの件数")
+
+
+@dataclass(frozen=True)
+class Validator:
+    etag: str
+    last_modified: datetime = None
+
+    def headers(self, cache_control: str = DEFAULT_CACHE_CONTROL) -> dict:
+        headers = {"ETag": self.etag, "Cache-Control": cache_control}
+        if self.last_modified is not None:
+            last_modified = self.last_modified
+            if last_modified.tzinfo is None:
+                # DBの日時はUTCのnaive datetimeで保存している
+                last_modified = last_modified.replace(tzinfo=timezone.utc)
+            headers["Last-Modified"] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+        return headers
+
+
+def make_validator(namespace: str, *parts, last_modified: datetime = None) -> Validator:
+    """
+    namespace（エンドポイント名）とレスポンスを決める値（リクエストの引数・行のid・更新日時など）からETagを作る。
+    同じ入力からは常に同じETagになるため、複数ワーカー間でも304の判定が一致する。
+    """
+    payload = orjson.dumps([namespace, *parts], option=orjson.OPT_NON_STR_KEYS, default=str)
+    digest = hashlib.blake2b(payload, digest_size=12).hexdigest()
+    return Validator(etag=f'"{digest}"', last_modified=last_modified)
+
+
+def is_not_modified(request: Request, validator: Validator) -> bool:
+    """If-None-Match（優先）またはIf-Modified-Sinceから、クライアントの保持している内容が最新かを判定する"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return validator.etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and validator.last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        last_modified = validator.last_modified
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        # HTTPの日時は秒単位のため、秒未満を切り捨てて比較する
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+class ResponseCache:
+    """ETagをキーに、JSONに変換済みのレスポンス本文を保持するLRU + TTLキャッシュ"""
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_MAX_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # etag -> (有効期限, 本文のbytes)
+        self._entries = OrderedDict()
+        # 同じETagの本文を作成中のリクエストがあれば、その結果を待つ（LLMの同時重複呼び出しを防ぐ）
+        self._inflight = {}
+
+    def get(self, etag: str):
+        entry = self._entries.get(etag)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._entries.pop(etag, None)
+            cache_size.set(len(self._entries))
+            return None
+        self._entries.move_to_end(etag)
+        return entry[1]
+
+    def put(self, etag: str, body: bytes) -> None:
+        self._entries[etag] = (time.monotonic() + self.ttl, body)
+        self._entries.move_to_end(etag)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        cache_size.set(len(self._entries))
+
+    async def _produce(self, etag: str, produce) -> bytes:
+        try:
+            body = orjson.dumps(await produce())
+            self.put(etag, body)
+            return body
+        finally:
+            self._inflight.pop(etag, None)
+
+    async def get_or_create(self, etag: str, produce) -> tuple:
+        """
+        (本文, キャッシュから返したかどうか) を返す。produceは本文（JSONに変換できる値）を返すコルーチン関数。
+        produceは呼び出したリクエストより長く動くことがあるため、リクエストのDBセッションを使わず自分でセッションを開くこと
+        """
+        body = self.get(etag)
+        if body is not None:
+            return body, True
+        task = self._inflight.get(etag)
+        hit = task is not None
+        if task is None:
+            # 最初のリクエストが切断されてキャンセルされても、待っている他のリクエストには結果を返せるよう、
+            # 本文の作成は独立したタスクで行い、各リクエストはshieldして待つ
+            task = asyncio.create_task(self._produce(etag, produce))
+            # 待っているリクエストがなくなっても「例外が取得されなかった」警告を出さない
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[etag] = task
+        return await asyncio.shield(task), hit
+
+    def clear(self) -> None:
+        self._entries.clear()
+        cache_size.set(0)
+
+
+response_cache = ResponseCache()
+
+
+async def conditional_response(
+    request: Request,
+    validator: Validator,
+    produce,
+    use_cache: bool = True,
+    cache_control: str = DEFAULT_CACHE_CONTROL,
+) -> Response:
+    """
+    検証子に基づいてレスポンスを返す。
+    - クライアントのキャッシュが最新なら304（produceは呼ばない）
+    - use_cacheがTrueならサーバー側のキャッシュを参照し、なければproduceを呼んで保存する
+    produceが例外を送出した場合はキャッシュせずにそのまま送出する。
+    """
+    route = request.url.path
+    headers = validator.headers(cache_control)
+    if is_not_modified(request, validator):
+        cache_requests.inc(route=route, result="not_modified")
+        return Response(status_code=304, headers=headers)
+
+    if use_cache:
+        body, hit = await response_cache.get_or_create(validator.etag, produce)
+        cache_requests.inc(route=route, result="hit" if hit else "miss")
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    cache_requests.inc(route=route, result="miss")
+    return ORJSONResponse(await produce(), headers=headers)
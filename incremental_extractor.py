@@ -0,0 +1,144 @@
+# 対話の各ラウンドで回答が届くたびに、その回答が対応する質問のフィールドだけをバックグラウンドで抽出する
+# どの質問への回答かはコーチの言い回し（深掘り・言い換え）ではなく、抽出と同じLLM呼び出しで発言の内容から判定し、
+# 質問ごとに対応するフィールド（structured_parser.QUESTION_FIELDS）へまとめる。
+# パートナーへの言及は最後のラウンドで全回答から1回だけ抽出する。
+# 10ラウンドに到達し、全ラウンドの抽出が成功して全質問の回答が揃った（またはスキップされた）場合だけ記録が揃ったとみなす
+import asyncio
+import logging
+from conversation_chain import MAX_ROUNDS
+from structured_parser import extract_round_answer, parse_satisfaction_score, FIELD_NAMES, QUESTION_FIELDS
+from emotion_analysis import extract_partner_mentions_llm
+
+logger = logging.getLogger(__name__)
+
+# 次の質問へ進むときにユーザーが送る言葉（OPENING_GREETINGで案内している）
+SKIP_ANSWER = "スキップ"
+
+# セッションIDごとの抽出状態
+_extractions = {}
+
+
+def is_skip(answer: str) -> bool:
+    return answer.strip().rstrip("。！!").lower() in (SKIP_ANSWER, "skip")
+
+
+class IncrementalExtraction:
+    """1セッション分の抽出状態。ラウンドごとの抽出結果を保持し、最後に1件の記録へまとめる"""
+
+    def __init__(self, partner_name: str = None):
+        self.partner_name = partner_name
+        self.last_round = 0
+        self.failed = False
+        self._answers = {}
+        self._round_fields = {}
+        self._skipped = set()
+        self._mentions = None
+        self._tasks = []
+
+    def schedule(self, round_number: int, coach_message: str, answer: str) -> None:
+        """回答が届いたラウンドの抽出をバックグラウンドタスクとして登録する（最後のラウンドでは言及の抽出も登録する）"""
+        self.last_round = max(self.last_round, round_number)
+        self._answers[round_number] = answer
+        self._tasks.append(asyncio.create_task(self._extract_round(round_number, coach_message, answer)))
+        if round_number >= MAX_ROUNDS:
+            self._tasks.append(asyncio.create_task(self._extract_mentions()))
+
+    async def _extract_round(self, round_number: int, coach_message: str, answer: str):
+        try:
+            # LLM呼び出しは同期処理のため、イベントループを塞がないようスレッドで実行する
+            result = await asyncio.to_thread(extract_round_answer, coach_message, answer)
+            if result is None:
+                raise ValueError("構造化データを抽出できませんでした")
+            question_number, fields = result
+            self._round_fields[round_number] = (question_number, fields)
+            if is_skip(answer):
+                self._skipped.add(question_number)
+        except Exception:
+            logger.exception(f"ラウンド{round_number}の逐次抽出に失敗しました")
+            self.failed = True
+
+    async def _extract_mentions(self):
+        chat_history = "\n".join(f"ユーザー: {self._answers[n]}" for n in sorted(self._answers))
+        try:
+            self._mentions = await asyncio.to_thread(
+                extract_partner_mentions_llm, chat_history, self.partner_name, True
+            )
+        except Exception:
+            logger.exception("パートナーへの言及の逐次抽出に失敗しました")
+            self.failed = True
+
+    async def wait(self) -> bool:
+        """
+        登録済みの抽出タスクの完了を待ち、記録が揃っていればTrueを返す。
+        途中で終了したセッション、抽出に失敗したラウンドがあるセッション、
+        スキップされていない質問のフィールドが空のまま残るセッション、
+        満足度の点数がラウンドによって食い違うセッションはFalse（従来の一括抽出に切り替える）。
+        """
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        if self.last_round < MAX_ROUNDS or self.failed or self._mentions is None:
+            return False
+        if len(self._scores()) > 1:
+            return False
+        data = self.structured_data()
+        return all(
+            data[name] or question_number in self._skipped
+            for question_number, names in QUESTION_FIELDS.items()
+            for name in names
+        )
+
+    def cancel(self) -> None:
+        """実行中の抽出タスクを取り消す（保存されずに破棄されたセッション用）"""
+        for task in self._tasks:
+            task.cancel()
+
+    def _scores(self) -> set:
+        """各ラウンドで読み取れた満足度の点数（数値に変換したもの）"""
+        scores = set()
+        for _, fields in self._round_fields.values():
+            score = parse_satisfaction_score(fields.get("satisfaction_score") or None)
+            if score is not None:
+                scores.add(score)
+        return scores
+
+    def structured_data(self) -> dict:
+        """質問ごとのフィールドにラウンド順で回答をまとめ、extract_structured_dataと同じ形のdictを返す"""
+        merged = {name: [] for name in FIELD_NAMES}
+        for round_number in sorted(self._round_fields):
+            question_number, fields = self._round_fields[round_number]
+            for name in QUESTION_FIELDS[question_number]:
+                value = str(fields.get(name) or "").strip()
+                if value and name != "satisfaction_score":
+                    merged[name].append(value)
+        result = {name: "\n".join(values) for name, values in merged.items()}
+        # 満足度は点数として読み取れた値が1つに定まる場合だけ採用する（食い違う場合はwait()が一括抽出に切り替える）
+        scores = self._scores()
+        if len(scores) == 1:
+            score = scores.pop()
+            result["satisfaction_score"] = str(int(score) if score.is_integer() else score)
+        return result
+
+    def mentions(self) -> list:
+        """最後のラウンドで抽出したパートナーへの言及を返す"""
+        return list(self._mentions or [])
+
+
+def start(session_id: str, partner_name: str = None) -> IncrementalExtraction:
+    extraction = IncrementalExtraction(partner_name)
+    _extractions[session_id] = extraction
+    return extraction
+
+
+def get(session_id: str):
+    return _extractions.get(session_id)
+
+
+def pop(session_id: str):
+    return _extractions.pop(session_id, None)
+
+
+def discard(session_id: str) -> None:
+    """保存されないまま破棄されたセッションの抽出状態を削除する"""
+    extraction = _extractions.pop(session_id, None)
+    if extraction is not None:
+        extraction.cancel()
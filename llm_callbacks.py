@@ -0,0 +1,15 @@
+# LangChain経由のLLM呼び出しのトークン数を集計するコールバック
+# conversation_chain.get_llm()で生成するモデルに登録する（LangChainの読み込み後にimportされる）
+from langchain_core.callbacks import BaseCallbackHandler
+import telemetry
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """応答のtoken_usageを、実行中のtelemetry.stage()の呼び出し元ごとに記録する"""
+
+    # 呼び出し元のコンテキスト（telemetry.current_site）をそのまま参照できるよう、スレッドに移さず実行する
+    run_inline = True
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        telemetry.record_tokens(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
@@ -0,0 +1,128 @@
+# イベントループの遅延の監視と、ループを止めている同期処理の検出
+# LoopMonitorはintervalごとにsleepし、予定より起床が遅れた時間をイベントループの遅延として常時記録する。
+# BLOCKING_DETECTOR=trueのときは監視スレッドも起動し、ループがBLOCKING_THRESHOLD_MS以上応答しなければ
+# その時点のループスレッドのスタックと処理中のルートを記録する（同期のLLM呼び出し・DBのcommit・gRPCなどの特定用）。
+# どちらもメトリクス（/metrics）と、1行のJSONのログ（[loop_monitor] {...}）として出力する
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import orjson
+from metrics import Counter, Histogram
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+# 遅延を測る間隔（秒）。0なら監視しない
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+# この遅延を超えたらログに出す（秒）
+LOOP_LAG_WARN_SECONDS = float(os.getenv("LOOP_LAG_WARN_SECONDS", "0.25"))
+# 同期処理の検出（デバッグ用。監視スレッドがループスレッドのスタックを取得するため、本番では必要なときだけ有効にする）
+BLOCKING_DETECTOR = os.getenv("BLOCKING_DETECTOR", "false").lower() in ("1", "true", "yes")
+BLOCKING_THRESHOLD_MS = float(os.getenv("BLOCKING_THRESHOLD_MS", "100"))
+# ログに出すスタックの深さ（呼び出し元に近い側から）
+BLOCKING_STACK_DEPTH = int(os.getenv("BLOCKING_STACK_DEPTH", "30"))
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+loop_lag = Histogram("event_loop_lag_seconds", "イベントループの起床の遅れ（秒）", buckets=LAG_BUCKETS)
+blocking_calls = Counter("event_loop_blocking_calls_total", "しきい値以上ループを止めた同期処理の回数", ("route",))
+blocking_seconds = Histogram(
+    "event_loop_blocking_seconds", "同期処理がループを止めた時間（秒）", ("route",), buckets=LAG_BUCKETS
+)
+
+
+def _log(event: str, **fields) -> None:
+    logger.warning(f"[loop_monitor] {orjson.dumps({'event': event, **fields}).decode()}")
+
+
+def _request_route(frame) -> str:
+    """スタックをたどり、RequestMetricsMiddlewareが処理中のルートを探す（リクエスト外ならbackground）"""
+    middleware_code = telemetry.RequestMetricsMiddleware.__call__.__code__
+    while frame is not None:
+        if frame.f_code is middleware_code:
+            return frame.f_locals.get("route", "unmatched")
+        frame = frame.f_back
+    return "background"
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, detect_blocking: bool = BLOCKING_DETECTOR,
+                 threshold: float = BLOCKING_THRESHOLD_MS / 1000):
+        self.detect_blocking = detect_blocking
+        self.threshold = threshold
+        # 検出を有効にした場合は、しきい値より短い間隔で起床して生存を知らせる
+        self.interval = min(interval, threshold / 2) if detect_blocking else interval
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._loop_thread_id = None
+        # ループが最後に起床した時刻（監視スレッドが参照する）
+        self._last_beat = time.monotonic()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self._last_beat = time.monotonic()
+            lag = max(0.0, loop.time() - started - self.interval)
+            loop_lag.observe(lag)
+            if lag >= LOOP_LAG_WARN_SECONDS:
+                _log("loop_lag", lag_ms=round(lag * 1000, 1))
+
+    def _watch(self) -> None:
+        """監視スレッド：ループの起床が途絶えたら、その時点のループスレッドのスタックを記録する"""
+        poll = self.threshold / 4
+        stalled = None  # (止まった時点のbeat, ルート)
+        while not self._stopped.wait(poll):
+            beat = self._last_beat
+            if stalled is not None and beat != stalled[0]:
+                # ループが再開した。止まっていた時間を記録する
+                blocking_seconds.observe(max(0.0, beat - stalled[0] - self.interval), route=stalled[1])
+                stalled = None
+            if stalled is None and time.monotonic() - beat - self.interval >= self.threshold:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                route = _request_route(frame)
+                stalled = (beat, route)
+                blocking_calls.inc(route=route)
+                _log(
+                    "blocking_call",
+                    route=route,
+                    blocked_ms=round((time.monotonic() - beat - self.interval) * 1000, 1),
+                    stack=[line.rstrip() for line in traceback.format_stack(frame)[-BLOCKING_STACK_DEPTH:]],
+                )
+                del frame
+
+    def start(self) -> None:
+        """ループのスレッドから呼ぶ"""
+        if self.interval <= 0 or self._task is not None:
+            return
+        self._last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+        if self.detect_blocking:
+            self._loop_thread_id = threading.get_ident()
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-monitor-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self) -> None:
+        if self._watchdog is not None:
+            self._stopped.set()
+            self._watchdog.join()
+            self._watchdog = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+loop_monitor = LoopMonitor()
@@ -5,41 +5,98 @@ import os
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "/home/site/wwwroot/gcp-credentials.json"
 
 # 各種エンドポイントを定義
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Depends, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 import uuid
 import json
 import logging
 import asyncio
+import time
 import crud
 import models
+import incremental_extractor
+import history
+import retention
+import services
+import emotion_trend
+import telemetry
+import profiler
+from metrics import render_all
+from history_codec import LazyHistory, turns_from_messages
+from pagination import InvalidCursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from answer_buffer import answer_buffer
+from loop_monitor import loop_monitor
+from usage_ledger import billed_to, degraded_response, usage_ledger
+from couple_cache import couple_cache
+from http_cache import make_validator, conditional_response
+from event_hub import event_hub
+from warmup import readiness
 from pydantic import BaseModel
 from datetime import datetime, timedelta
-from db import SessionLocal, engine, Base
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_db, get_read_db, AsyncSessionLocal, ReadSessionLocal
 from models import User, UserAnswer, ConversationHistory, StructuredAnswer,GenderEnum ,EmotionAlert,DialogueAdvice
-from summarizer import summarize_answer
-from summarizer import generate_couple_conversation_advice
-from summarizer import summarize_multiple_docs
-from summarizer_rag import generate_report_with_rag
-from conversation_chain import create_conversation_chain
-from structured_parser import extract_structured_data
-from reminder_perser import extract_structured_data_reminder
-from structured_vector import (
-    build_structured_vector_store,
-    search_all_predefined_queries,
-    PREDEFINED_QUERIES
-)
+from conversation_chain import create_conversation_chain, start_conversation
+from structured_parser import extract_structured_data, parse_satisfaction_score
+from satisfaction_trend import satisfaction_trend
 
-from models import VectorSummary
 from emotion_analysis import (extract_partner_mentions_llm, 
                               classify_partner_emotion,
                               analyze_sentiment,
 )
 from typing import Optional
 
-app = FastAPI()
+# レスポンスのJSON変換は高速なorjsonで一度だけ行う
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# スキーマのマイグレーション・DB接続の確認・LLMクライアントの生成は読み込み時に行わず、
+# 起動後にバックグラウンドで行う（完了するまで/readyzは503を返す）
+@app.on_event("startup")
+async def start_loop_monitor():
+    # イベントループの遅延を常時計測する（BLOCKING_DETECTOR=trueならループを止めた同期処理のスタックも記録する）
+    loop_monitor.start()
+
+@app.on_event("shutdown")
+async def stop_loop_monitor():
+    await loop_monitor.stop()
+
+@app.on_event("startup")
+async def start_warmup():
+    app.state.warmup = asyncio.create_task(readiness.run())
+
+@app.on_event("startup")
+async def start_answer_buffer():
+    answer_buffer.start()
+
+@app.on_event("startup")
+async def start_table_size_monitor():
+    # ホットテーブルの行数・サイズのゲージを定期的に更新する（保持期間ジョブ自体はretention.pyを別途実行）
+    if retention.TABLE_STATS_INTERVAL > 0:
+        app.state.table_size_monitor = asyncio.create_task(retention.monitor_table_sizes())
 
-Base.metadata.create_all(bind=engine)
+@app.on_event("shutdown")
+async def stop_answer_buffer():
+    # 終了時にバッファ内の回答をすべて書き込む
+    await answer_buffer.stop()
+
+@app.on_event("startup")
+async def start_usage_ledger():
+    # LLMの利用量はメモリ上で集計し、定期的にllm_usage_dailyへ書き込む
+    usage_ledger.start()
+
+@app.on_event("shutdown")
+async def stop_usage_ledger():
+    await usage_ledger.stop()
+
+@app.on_event("startup")
+async def start_event_hub():
+    event_hub.start()
+
+@app.on_event("shutdown")
+async def stop_event_hub():
+    await event_hub.stop()
 
 # CORSミドルウェアの設定
 app.add_middleware(
@@ -50,11 +107,46 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 署名付きのX-Profileヘッダー・サンプリングで選んだリクエストのプロファイルを保存する（設定しなければ何もしない）
+app.add_middleware(profiler.ProfilingMiddleware)
+
+# ルートごとのレイテンシを記録する（後から追加したミドルウェアほど外側になるため、CORSの処理時間も含む）
+app.add_middleware(telemetry.RequestMetricsMiddleware)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # In-memoryセッション管理（プロトタイプ用）
 sessions = {}
+# セッションIDごとの最終利用時刻（time.monotonic()）
+session_last_used = {}
+# 最後の利用からこの秒数が過ぎたセッションは、保存されていなくても破棄する
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "3600"))
+SESSION_SWEEP_INTERVAL = 60.0
+
+
+def evict_idle_sessions(now: float = None) -> int:
+    """一定時間使われていないセッションと、その逐次抽出の状態を破棄する"""
+    now = time.monotonic() if now is None else now
+    expired = [sid for sid, last_used in session_last_used.items() if now - last_used > SESSION_IDLE_TTL]
+    for session_id in expired:
+        sessions.pop(session_id, None)
+        session_last_used.pop(session_id, None)
+        incremental_extractor.discard(session_id)
+    return len(expired)
+
+
+async def sweep_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        evicted = evict_idle_sessions()
+        if evicted:
+            logger.info(f"[sessions] 使われていないセッションを{evicted}件破棄しました")
+
+
+@app.on_event("startup")
+async def start_session_sweeper():
+    app.state.session_sweeper = asyncio.create_task(sweep_sessions())
 
 # --- エンドポイント用のPydanticスキーマ ---
 
@@ -100,28 +192,62 @@ class SentimentTestInput(BaseModel):
 
 # --- エンドポイント ---
 
+# 死活確認（プロセスが応答できればよいため、DBや外部APIには触れない）
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+# 準備状態の確認（起動後のウォームアップで必須の手順が終わるまで503を返す）
+@app.get("/readyz")
+async def readyz():
+    snapshot = readiness.snapshot()
+    return ORJSONResponse(snapshot, status_code=200 if snapshot["ready"] else 503)
+
+# メトリクス（Prometheusのテキスト形式）
+@app.get("/metrics")
+async def metrics_endpoint():
+    telemetry.live_sessions.set(len(sessions))
+    return PlainTextResponse(render_all(), media_type="text/plain; version=0.0.4")
+
+# 保存済みのリクエストのプロファイルの一覧と取得（ADMIN_TOKENをX-Admin-Tokenヘッダーで渡す）
+@app.get("/admin/profiles")
+async def list_request_profiles(x_admin_token: Optional[str] = Header(None)):
+    if not profiler.is_admin(x_admin_token):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return {"profiles": await asyncio.to_thread(profiler.list_profiles)}
+
+@app.get("/admin/profiles/{profile_id}")
+async def download_request_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    if not profiler.is_admin(x_admin_token):
+        raise HTTPException(status_code=404, detail="Not Found")
+    path = profiler.profile_file(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="プロファイルが見つかりません。")
+    # collapsed形式（flamegraph.pl・speedscopeでそのまま読める）
+    return FileResponse(path, media_type="text/plain", filename=f"{profile_id}.collapsed")
+
 # 一問一答機能：会話セッションの開始または継続の処理
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
-    db = SessionLocal()
+async def chat_endpoint(request: ChatRequest, db: AsyncSession = Depends(get_db)):
     try:
         if not request.session_id:
             # 新規セッション開始時にユーザー情報・パートナー情報を取得
-            user = db.query(User).filter(User.user_id == request.user_id).first()
+            # 自分と、自分以外で同じcouple_idのユーザーを取得（キャッシュがあればDBを参照しない）
+            user, partner = await couple_cache.get(db, request.user_id)
             if not user:
                 raise HTTPException(status_code=404, detail="ユーザー情報が見つかりません。")
-            # 自分以外で同じcouple_idのユーザーを取得
-            partner = db.query(User).filter(
-                User.couple_id == user.couple_id,
-                User.user_id != user.user_id
-            ).first()  
+            # 利用上限を超えている場合は新しいセッションを始めない（開始済みのセッションは保存まで続けられる）
+            if await usage_ledger.over_quota(user.user_id, user.couple_id):
+                degraded_response(None)
 
             # パートナーが見つからない場合はNone（create_conversation_chain内で「情報なし」に置換）
             session_id = str(uuid.uuid4())
             chain = create_conversation_chain(user,partner)
             sessions[session_id] = chain
-            initial_input = "セッション開始"
-            response = chain.predict(input=initial_input)
+            session_last_used[session_id] = time.monotonic()
+            incremental_extractor.start(session_id, partner_name="パートナー")
+            # 冒頭のあいさつと最初の質問は定型文のため、LLMを呼ばずにテンプレートから生成する
+            response = start_conversation(chain, user, partner)
             return ChatResponse(
                 session_id=session_id,
                 feedback=response,
@@ -134,78 +260,103 @@ async def chat_endpoint(request: ChatRequest):
             if session_id not in sessions:
                 raise HTTPException(status_code=400, detail="セッションが存在しません。")
             chain = sessions[session_id]
+            session_last_used[session_id] = time.monotonic()
             if not request.answer:
                 raise HTTPException(status_code=400, detail="回答が入力されていません。")
             # ラウンド番号を会話履歴から計算（例：単純にメッセージ数から算出）
             round_number = len(chain.memory.chat_memory.messages) // 2 + 1
-            user_answer = UserAnswer(
+            # 回答の保存はライトビハインドバッファに任せ、リクエスト中はDBに書き込まない
+            answer_buffer.add(
                 user_id=request.user_id,
                 session_id=session_id,
                 round_number=round_number,
                 user_question=request.answer
             )
-            db.add(user_answer)
-            db.commit()
-            response = chain.predict(input=request.answer)
+            # この回答が答えているコーチの直前の発言
+            coach_message = chain.memory.chat_memory.messages[-1].content
+            # 応答の生成と、バックグラウンドで行う抽出のLLM利用を回答したユーザーに計上する
+            with billed_to(request.user_id):
+                with telemetry.stage("llm", "chat"):
+                    response = await chain.apredict(input=request.answer)
+                # 回答に対応する構造化データとパートナーへの言及をバックグラウンドで抽出しておく
+                extraction = incremental_extractor.get(session_id)
+                if extraction:
+                    extraction.schedule(round_number, coach_message, request.answer)
             return ChatResponse(
                 session_id=session_id,
                 feedback=response,
                 round=round_number,
                 message=""
             )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Error in chat endpoint")
         raise HTTPException(status_code=500, detail="チャット処理中にエラーが発生しました。")
-    finally:
-        db.close()
 
 @app.post("/save_conversation")
-async def save_conversation(session_id: str, user_id: int):
-    db = SessionLocal()
+async def save_conversation(session_id: str, user_id: int, db: AsyncSession = Depends(get_db)):
     try:
         # セッションの存在確認
         if session_id not in sessions:
             raise HTTPException(status_code=400, detail="セッションが存在しません。")
         chain = sessions[session_id]
 
-        # 会話履歴の連結
-        chat_history = "\n".join([msg.content for msg in chain.memory.chat_memory.messages])
-        # ConversationHistory に保存
+        # バッファに残っている回答を先に書き込んでおく（書き込めなかった回答があっても会話の保存は続ける）
+        await answer_buffer.flush()
+
+        # 会話履歴を話者付きのターン列にし、抽出用には話者ラベル付きのテキストに変換する
+        history_record = LazyHistory.from_turns(turns_from_messages(chain.memory.chat_memory.messages))
+        chat_history = history_record.as_text()
+
+        # 対話中に逐次抽出した結果が揃っていればそれを使い、揃っていなければ従来通り一括抽出する
+        # 一括抽出はスレッドで先に走らせておき、その間に会話履歴の保存とパートナーの取得を行う
+        extraction = incremental_extractor.pop(session_id)
+        extraction_task = None
+        if not (extraction and await extraction.wait()):
+            extraction = None
+            with billed_to(user_id):
+                extraction_task = asyncio.gather(
+                    asyncio.to_thread(extract_structured_data, chat_history),
+                    asyncio.to_thread(extract_partner_mentions_llm, chat_history, "パートナー"),
+                )
+
+        # ConversationHistory に保存（ターン列をzstdで圧縮して保存する）
         conv_history = ConversationHistory(
             user_id=user_id,
             session_id=session_id,
-            chat_history=chat_history
+            chat_turns=history_record.encode()
         )
         db.add(conv_history)
-        db.commit()
-        db.refresh(conv_history)
+        await db.commit()
+        await db.refresh(conv_history)
+
+        # 感情アラートの送り先（パートナーのuser_id）を取得
+        user, partner = await couple_cache.get(db, user_id)
+
+        if extraction:
+            structured_data = extraction.structured_data()
+            mentions = extraction.mentions()
+        else:
+            structured_data, mentions = await extraction_task
 
         # 既存の構造化データ保存処理
-        structured_data = extract_structured_data(chat_history)
         structured_answer = StructuredAnswer(
             conversation_history_id=conv_history.id,
             user_id=user_id, 
-            answer_summary=json.dumps(structured_data, ensure_ascii=False)
+            answer_summary=structured_data,
+            satisfaction_score=parse_satisfaction_score(structured_data.get("satisfaction_score"))
         )
         db.add(structured_answer)
-        db.commit()
+        await db.commit()
 
         # 感情分析処理
-        # ユーザー発言のみを抽出
-        mentions = extract_partner_mentions_llm(chat_history, partner_name="パートナー")
         # すべての発言を集約して5段階に分類
-        emotion_alert = classify_partner_emotion(mentions)
+        emotion_alert = await asyncio.to_thread(classify_partner_emotion, mentions)
         logging.info(f"[集約感情判定結果] {emotion_alert}")
         analysis_result = emotion_alert
 
-        # 感情アラートをDBに保存（パートナーのuser_idを取得）
-        user = db.query(User).filter(User.user_id == user_id).first()
-
-        partner = db.query(User).filter(
-            User.couple_id == user.couple_id,
-            User.user_id != user_id
-        ).first()
-
+        # 感情アラートをDBに保存
         if partner:
             alert_record = EmotionAlert(
                 user_id=partner.user_id,
@@ -215,11 +366,17 @@ async def save_conversation(session_id: str, user_id: int):
                 magnitude=emotion_alert["max_magnitude"],
                 label=emotion_alert["label"],
                 emoji=emotion_alert["emoji"],
-                message=emotion_alert["message"]
+                message=emotion_alert["message"],
+                created_at=datetime.utcnow()
             )
             db.add(alert_record)
-            db.commit()
+            # 推移表示用の日別・週別集計にも同じトランザクションで加算する
+            await emotion_trend.record_alert(db, partner.user_id, alert_record.score, alert_record.magnitude,
+                                             alert_record.label, alert_record.created_at)
+            await db.commit()
             logging.info(f"[感情アラート保存済] partner_id={partner.user_id}, label={alert_record.label}")
+            # パートナーへ新しい感情アラートを通知する（/emotion_alert/latestと同じ形）
+            await event_hub.publish([partner.user_id], "emotion_alert", services.emotion_alert_payload(alert_record))
 
         return {
             "message": "会話履歴と構造化データの保存に成功しました。",
@@ -228,17 +385,14 @@ async def save_conversation(session_id: str, user_id: int):
     
     except Exception as e:
         logger.exception("エラー内容:")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="保存中にエラーが発生しました")
-    finally:
-        db.close()
 
 @app.post("/register")
-async def register_user(user: UserCreate):
-    db = SessionLocal()
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     try:
         # 同じユーザーIDでの重複登録を防ぐためのチェック
-        existing_user = db.query(User).filter(User.user_id == user.user_id).first()
+        existing_user = await crud.get_user_by_id(db, user.user_id)
         if existing_user:
             raise HTTPException(status_code=400, detail="このユーザーIDは既に登録されています。")
         
@@ -251,8 +405,10 @@ async def register_user(user: UserCreate):
             couple_id=user.couple_id
         )
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
+        # 同じ夫婦のユーザーのキャッシュ（パートナー未登録の状態）を破棄する
+        couple_cache.invalidate(user_id=new_user.user_id, couple_id=new_user.couple_id)
         return {
             "message": "ユーザー登録が完了しました",
             "user": {
@@ -265,120 +421,236 @@ async def register_user(user: UserCreate):
             }
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"ユーザー登録中にエラーが発生しました: {str(e)}")
-    finally:
-        db.close()
 
 @app.get("/structured_vector_search/fixed_all")
-async def fixed_structured_vector_search_all(user_id: int):
+async def fixed_structured_vector_search_all(user_id: int, db: AsyncSession = Depends(get_db)):
     """
     直近days日分の構造化データを抽出し、PREDEFINED_QUERIESに定義されたクエリを
     すべてベクトル検索。クエリごとの検索結果をまとめて返す。
     """
-    db = SessionLocal()
-    try:
-        # -- ユーザー名を取得して"さん"付けする --
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="該当するユーザーが見つかりません。")
-
-        user_name_with_suffix = f"{user.name}さん"
-
-        # 1) 指定日数分遡るため、days引いた日時を計算
-        cutoff_date = datetime.utcnow() - timedelta(days=4)
-
-        async def process_user_data(target_user_id: int):
-            answers = (db.query(StructuredAnswer)
-                       .filter(StructuredAnswer.user_id == target_user_id)
-                       .filter(StructuredAnswer.created_at >= cutoff_date)
-                       .all())
-            if not answers:
-                return None
-
-            # 3) JSON文字列をPythonの辞書として読み込む
-            structured_data_list = [json.loads(ans.answer_summary) for ans in answers]
+    # -- ユーザー名を取得して"さん"付けする --
+    user, partner = await couple_cache.get(db, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="該当するユーザーが見つかりません。")
 
-            # 4) ベクトルストアを構築
-            vector_store = build_structured_vector_store(structured_data_list)
+    user_name_with_suffix = f"{user.name}さん"
+    partner_name_with_suffix = f"{partner.name}さん" if partner else None
 
-            # 5) 全クエリ一括検索
-            all_results = search_all_predefined_queries(vector_store, k=3)
-
-            saved_summaries =[]
-            for query_key, doc_texts in all_results.items():
-                #doc_textsは要約前のベクトルストアから検索したn件のテキスト
-                #これを1つの文字列にまとめる
-                merged_text = "\n\n".join(doc_texts)
-                
-                #LLMに要約
-                summary_text = await summarize_multiple_docs([merged_text])
-
-                #DBに保存
-                new_summary = VectorSummary(
-                    user_id=user_id,
-                    query_key = query_key,
-                    summary_text=summary_text
-                )
-                db.add(new_summary)
-                db.commit()
-                db.refresh(new_summary)
-                saved_summaries.append({
-                    "query_key": query_key,
-                    "merged_documents": merged_text,
-                    "summay_text": summary_text
-                })
+    # 利用上限を超えている場合は要約を作り直さず、保存済みの最新の要約を返す
+    if await usage_ledger.over_quota(user.user_id, user.couple_id):
+        return degraded_response({
+            "user_id": user_id,
+            "user_name": user_name_with_suffix,
+            "partner_user_id": partner.user_id if partner else None,
+            "partner_name": partner_name_with_suffix,
+            "user_summaries": await services.latest_vector_summaries(db, user_id) or None,
+            "partner_summaries": (await services.latest_vector_summaries(db, partner.user_id) or None) if partner else None,
+        })
+
+    async def process_user_data(target_user_id: int):
+        # 直近の構造化データをベクトル検索して要約し、保存する（夜間の事前計算と共通。入力が同じなら保存済みの要約を返す）
+        saved_summaries, created = await services.compute_vector_summaries(db, target_user_id)
+        if not created:
             return saved_summaries
+        # 要約は本人とパートナーの両方の画面（レポート・リマインド）で使うため夫婦の両方へ通知する
+        await event_hub.publish([user.user_id, partner.user_id if partner else None], "vector_summaries", {
+            "user_id": target_user_id,
+            "summaries": [{"query_key": s["query_key"], "summay_text": s["summay_text"]} for s in saved_summaries],
+        })
+        return saved_summaries
+    # パートナーの分も含め、LLMの利用はリクエストしたユーザーに計上する
+    with billed_to(user.user_id, user.couple_id):
         # 自分の処理
         user_summaries = await process_user_data(user_id)
 
         # パートナーが存在する場合の処理
-        partner = db.query(User).filter(
-            User.couple_id == user.couple_id,
-            User.user_id != user.user_id
-        ).first()
-
         partner_summaries = None
-        partner_name_with_suffix = None
         if partner:
-            partner_name_with_suffix = f"{partner.name}さん"
             partner_summaries = await process_user_data(partner.user_id)
 
-        return{
-            "user_id": user_id,
-            "user_name": user_name_with_suffix,
-            "partner_user_id": partner.user_id if partner else None,
-            "partner_name": partner_name_with_suffix,
-            "user_summaries": user_summaries,
-            "partner_summaries": partner_summaries
-        }
-    finally:
-        db.close()
+    return{
+        "user_id": user_id,
+        "user_name": user_name_with_suffix,
+        "partner_user_id": partner.user_id if partner else None,
+        "partner_name": partner_name_with_suffix,
+        "user_summaries": user_summaries,
+        "partner_summaries": partner_summaries
+    }
 
 @app.get("/emotion_alert/latest")
-async def get_latest_emotion_alert(user_id: int):
-    db = SessionLocal()
+async def get_latest_emotion_alert(user_id: int, request: Request, db: AsyncSession = Depends(get_read_db)):
+    alert = await services.latest_emotion_alert(db, user_id)
+    if not alert:
+        raise HTTPException(status_code=404, detail="最新の感情アラートは見つかりません。")
+
+    async def produce():
+        return services.emotion_alert_payload(alert)
+    # 最新のアラートが変わらない限り304を返す（本文は小さいためサーバー側ではキャッシュしない）
+    validator = make_validator("emotion_alert/latest", user_id, alert.id, last_modified=alert.created_at)
+    return await conditional_response(request, validator, produce, use_cache=False)
+
+
+@app.get("/emotion_alert/trend")
+async def get_emotion_alert_trend(
+    user_id: int,
+    granularity: str = Query("day", pattern="^(day|week)$", description="集計の単位（day / week）"),
+    buckets: int = Query(28, ge=1, le=366, description="返す期間の数"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    ユーザーが受け取った感情アラート（＝パートナーの気持ち）の推移を、日別または週別の集計から返す。
+    各期間の重み付き平均スコア・最大強度・ラベルごとの件数を含む。
+    """
+    return {
+        "user_id": user_id,
+        "granularity": granularity,
+        "buckets": await emotion_trend.emotion_trend(db, user_id, granularity, buckets),
+    }
+
+
+@app.get("/couple/{couple_id}/dashboard")
+async def couple_dashboard(
+    couple_id: str,
+    timeout_scale: float = Query(1.0, gt=0, le=5, description="各セクションのタイムアウトの倍率"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    ホーム画面用に、夫婦それぞれの最新の感情アラート・リマインド・対話アドバイス・振り返り・要約をまとめて返す。
+    夫婦の解決は1回だけ行い、各セクションは並行に取得する。
+    タイムアウトしたセクションはstatusが"timeout"になり、それ以外のセクションだけを返す（partial=True）。
+    """
+    members = await crud.get_couple_members(db, couple_id)
+    if not members:
+        raise HTTPException(status_code=404, detail="該当する夫婦が見つかりません。")
+    # 個別エンドポイントでのパートナー検索もキャッシュから返せるようにしておく
+    if len(members) == 2:
+        couple_cache.put(members[0], members[1])
+        couple_cache.put(members[1], members[0])
+    return await services.couple_dashboard(couple_id, members, timeout_scale)
+
+
+@app.get("/events/stream")
+async def stream_events(
+    user_id: int,
+    request: Request,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """
+    ユーザー宛てのイベント（emotion_alert / vector_summaries / dialogue_advice）をServer-Sent Eventsで送る。
+    接続直後の状態は各GETエンドポイントで取得し、以降の更新はこのストリームで受け取る。
+    """
+    return StreamingResponse(
+        event_hub.stream(user_id, request, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/structured_answers/satisfaction_trend")
+async def get_satisfaction_trend(
+    user_id: int,
+    days: int = Query(28, ge=1, le=366, description="集計する日数"),
+    window: int = Query(7, ge=1, le=90, description="移動平均の日数"),
+    include_partner: bool = Query(True, description="パートナーと夫婦合算の推移も返す場合はTrue"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    満足度の日別平均と移動平均を返す。
+    集計はSQLと数値配列で行い、構造化データのJSONは読み込まない。
+    """
+    user, partner = await couple_cache.get(db, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="該当するユーザーが見つかりません。")
+
+    user_ids = [user.user_id]
+    if include_partner and partner:
+        user_ids.append(partner.user_id)
+
+    trend = await satisfaction_trend(db, user_ids, days, window)
+    return {
+        "user_id": user.user_id,
+        "partner_user_id": partner.user_id if include_partner and partner else None,
+        "days": days,
+        "window": window,
+        "user_trend": trend["users"][user.user_id],
+        "partner_trend": trend["users"].get(partner.user_id) if include_partner and partner else None,
+        "couple_trend": trend["combined"] if len(user_ids) > 1 else None,
+    }
+
+
+async def _history_page(db: AsyncSession, kind: str, user_id, limit: int, cursor: Optional[str]):
     try:
-        alert = (db.query(EmotionAlert)
-                   .filter(EmotionAlert.user_id == user_id)
-                   .order_by(EmotionAlert.created_at.desc())
-                   .first())
-        if not alert:
-            raise HTTPException(status_code=404, detail="最新の感情アラートは見つかりません。")
-        return {
-            "label": alert.label,
-            "emoji": alert.emoji,
-            "message": alert.message,
-            "score": alert.score,
-            "magnitude": alert.magnitude,
-            "created_at": alert.created_at.isoformat()
-        }
-    finally:
-        db.close()
+        return await history.history_page(db, kind, user_id, limit, cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/history/conversations")
+async def list_conversation_history(
+    user_id: int,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="前のレスポンスのnext_cursor"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """会話履歴を新しい順にページ単位で返す"""
+    return await _history_page(db, "conversations", user_id, limit, cursor)
+
+@app.get("/history/structured_answers")
+async def list_structured_answers(
+    user_id: int,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="前のレスポンスのnext_cursor"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """構造化データを新しい順にページ単位で返す"""
+    return await _history_page(db, "structured_answers", user_id, limit, cursor)
+
+@app.get("/history/emotion_alerts")
+async def list_emotion_alerts(
+    user_id: int,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="前のレスポンスのnext_cursor"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """受信した感情アラートを新しい順にページ単位で返す"""
+    return await _history_page(db, "emotion_alerts", user_id, limit, cursor)
+
+@app.get("/history/reflections")
+async def list_reflections(
+    user_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="前のレスポンスのnext_cursor"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """振り返りを新しい順にページ単位で返す（/reflectionsの全件取得の代わりに使う）"""
+    return await _history_page(db, "reflections", user_id, limit, cursor)
+
+@app.get("/export/ndjson")
+async def export_history_ndjson(
+    user_id: int,
+    scope: str = Query("user", pattern="^(user|couple)$", description="userは自分のみ、coupleは夫婦2人分"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    会話履歴・構造化データ・感情アラート・振り返りをNDJSONでストリーミングする。
+    各行は{"type": 種類, ...列の値}の形式。
+    """
+    user, partner = await couple_cache.get(db, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="該当するユーザーが見つかりません。")
+    user_ids = [user.user_id]
+    if scope == "couple" and partner:
+        user_ids.append(partner.user_id)
+    return StreamingResponse(
+        history.stream_ndjson(user_ids),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="futari_export_{user_id}_{scope}.ndjson"'},
+    )
 
 
 @app.post("/reflections")
-def create_reflection(reflection: UserReflection):
+async def create_reflection(reflection: UserReflection, db: AsyncSession = Depends(get_db)):
     values = reflection.dict()
     
     # IDが指定されていない場合は自動生成
@@ -389,18 +661,35 @@ def create_reflection(reflection: UserReflection):
     if not values.get("created_at"):
         values["created_at"] = datetime.now()
     
-    tmp = crud.myinsert(models.UserReflections, values)
-    result = crud.myselect(models.UserReflections, values.get("reflection_id"))
+    tmp = await crud.myinsert(db, models.UserReflections, values)
+    result = await crud.get_reflection(db, values.get("reflection_id"))
 
     if result:
-        result_obj = json.loads(result)
-        return result_obj if result_obj else None
+        return ORJSONResponse([result])
     return None
 
+async def _reflections_response(request: Request, db: AsyncSession, target_user_id, view: str, not_found: dict):
+    """
+    対象ユーザーの振り返り一覧を、件数と最新の作成日時を検証子として返す。
+    viewは"own"（自分の振り返り）か"partner"で、0件のときのメッセージが異なるため検証子にも含める
+    """
+    count, latest = await crud.reflections_version(db, target_user_id)
+
+    async def produce():
+        # 最初のリクエストが切断されても作成は続くため、リクエストのセッション（db）は使わない
+        async with ReadSessionLocal() as session:
+            result = await crud.list_reflections(session, target_user_id)
+        # dataclassのリストはそのままJSONに変換される
+        return result if result else not_found
+    validator = make_validator("reflections", view, str(target_user_id), count, latest, last_modified=latest)
+    return await conditional_response(request, validator, produce)
+
 @app.get("/reflections")
-def read_one_reflection(
+async def read_one_reflection(
+    request: Request,
     user_id: str = Query(...),
-    include_partner: bool = Query(False, description="パートナーの振り返りを取得する場合はTrue")
+    include_partner: bool = Query(False, description="パートナーの振り返りを取得する場合はTrue"),
+    db: AsyncSession = Depends(get_read_db)
 ):
     """
     ユーザーIDに基づいてリフレクションを取得する。
@@ -409,101 +698,64 @@ def read_one_reflection(
     try:
         if not include_partner:
             # 自分の振り返りを取得
-            result = crud.myselect(models.UserReflections, user_id)
-            
-            # 結果がない場合のハンドリング
-            if not result or result == "[]":
-                return {"message": "No reflections found for this user"}
-            
-            # 文字列形式のJSONをPythonオブジェクトに変換
-            result_list = json.loads(result)
-            return result_list
+            return await _reflections_response(
+                request, db, user_id, "own", {"message": "No reflections found for this user"}
+            )
         else:
             # パートナーの振り返りを取得
             try:
-                # ユーザー情報を取得してcouple_idを確認
-                user = crud.get_user_by_id(user_id)
+                # ユーザー情報を取得してcouple_idを確認（同じcouple_idで自分以外のユーザー＝パートナーも合わせて取得）
+                user, partner = await couple_cache.get(db, user_id)
                 if not user or not user.couple_id:
                     return {"message": "User has no partner"}
                 
-                # 同じcouple_idで自分以外のユーザー（パートナー）を取得
-                partner = crud.get_partner(user.couple_id, user_id)
                 if not partner:
                     return {"message": "Partner not found"}
                 
-                # パートナーの振り返りを取得
-                partner_result = crud.myselect(models.UserReflections, partner.user_id)
-                if not partner_result or partner_result == "[]":
-                    return {"message": "No reflections found for partner"}
-                
                 # パートナーの振り返りを返す
-                return json.loads(partner_result)
+                return await _reflections_response(
+                    request, db, partner.user_id, "partner", {"message": "No reflections found for partner"}
+                )
             except Exception as e:
-                print(f"Error fetching partner reflections: {str(e)}")
+                logger.exception("Error fetching partner reflections")
                 raise HTTPException(status_code=500, detail="Error fetching partner reflections")
     except Exception as e:
         # エラーログを出力
-        print(f"Error in read_one_reflection: {str(e)}")
+        logger.exception("Error in read_one_reflection")
         # HTTPエラーを返す
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
 
 @app.get("/report_reminding")
-async def report_reminding(user_id: int):
+async def report_reminding(user_id: int, request: Request, db: AsyncSession = Depends(get_read_db)):
     """
     パートナーの直近3件のレポートを分析し、Goodthing_remindとBadthing_remindを返す
     """
-    db = SessionLocal()
-    try:
-        # ユーザー情報取得
-        user = db.query(User).get(user_id)
-        if not user:
-            raise HTTPException(status_code=404, detail="該当するユーザーが見つかりません。")
-
-        # パートナー情報の取得ロジック追加
-        if not user.couple_id:
-            raise HTTPException(status_code=400, detail="ユーザーに紐づくカップルIDが存在しません。")
-
-        # 同じcouple_idで自分以外のユーザー（パートナー）を取得
-        partner = db.query(User).filter(
-            User.couple_id == user.couple_id,
-            User.user_id != user_id
-        ).first()
-
-        if not partner:
-            raise HTTPException(status_code=404, detail="パートナーが見つかりません。")
-
-        async def process_user_data(target_user_id: int) -> dict:
-            # 直近3件のレポートを取得（作成日時の降順）
-            recent_summaries = db.query(VectorSummary).filter(
-                VectorSummary.user_id == target_user_id
-            ).order_by(VectorSummary.created_at.desc()).limit(3).all()
-
-            if not recent_summaries:
-                return {"Goodthing_remind": "該当する情報がありません", "Badthing_remind": "該当する情報がありません"}
-
-            # 有効な要約テキストを結合
-            combined_text = "\n\n".join([s.summary_text for s in recent_summaries if s.summary_text])
-            
-            if not combined_text:
-                return {"Goodthing_remind": "該当する情報がありません", "Badthing_remind": "該当する情報がありません"}
-
-            # 全レポートをまとめて分析
-            analysis_results = extract_structured_data_reminder(combined_text)
-
-            # Good/Badを抽出して返却
-            good_summary = analysis_results.get("Goodthing_remind", "該当する情報がありません")
-            bad_summary = analysis_results.get("Badthing_remind", "該当する情報がありません")
-
-            return {
-                "Goodthing_remind": good_summary,
-                "Badthing_remind": bad_summary
-            }
-  # パートナーのuser_idを渡す
-        return await process_user_data(partner.user_id)
-    finally:
-        db.close()
+    # ユーザー情報と、同じcouple_idで自分以外のユーザー（パートナー）を取得
+    user, partner = await couple_cache.get(db, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="該当するユーザーが見つかりません。")
+
+    # パートナー情報の取得ロジック追加
+    if not user.couple_id:
+        raise HTTPException(status_code=400, detail="ユーザーに紐づくカップルIDが存在しません。")
+
+    if not partner:
+        raise HTTPException(status_code=404, detail="パートナーが見つかりません。")
+
+    # 直近3件のレポートのidと作成日時を検証子にする（同じレポートに対する分析はLLMを呼ばずにキャッシュから返す）
+    # 分析処理と検証子はダッシュボードと共通（services.py）
+    recent = await services.recent_summary_versions(db, partner.user_id)
+    validator = services.reminder_validator(partner.user_id, recent)
+    # 利用上限を超えていて、このレポートに対するリマインドがまだなければ、保存済みの最新のリマインドを返す
+    degraded, fallback = await services.reminder_quota_fallback(db, user, partner.user_id, validator.etag)
+    if degraded:
+        return degraded_response(fallback)
+    with billed_to(user.user_id, user.couple_id):
+        return await conditional_response(
+            request, validator, lambda: services.reminder_in_own_session(partner.user_id, recent, validator.etag)
+        )
 
 
 # 感情分析確認用エンドポイント
@@ -522,66 +774,38 @@ async def test_emotion_endpoint(input_data: SentimentTestInput):
         raise HTTPException(status_code=500, detail=f"GCP感情分析APIエラー: {str(e)}")
     
 @app.get("/dialogue_advice")
-async def get_dialogue_advice(user_id: int):
-    db = SessionLocal()
+async def get_dialogue_advice(user_id: int, request: Request, db: AsyncSession = Depends(get_db)):
     try:
-        # 最新の要約データを取得
-        cutoff_date = datetime.utcnow()-timedelta(days=4)
-        def fetch_latest_summaries(uid):
-            return(db.query(VectorSummary)
-                    .filter(VectorSummary.user_id == uid)
-                    .filter(VectorSummary.created_at >= cutoff_date)
-                    .all())
-        user_summaries = fetch_latest_summaries(user_id)
-
-        user = db.query(User).filter(User.user_id == user_id).first()
+        user, partner = await couple_cache.get(db, user_id)
         if not user:
             raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
-        
-        partner = db.query(User).filter(
-            User.couple_id == user.couple_id,
-            User.user_id != user.user_id
-        ).first()
-
-        partner_summaries = fetch_latest_summaries(partner.user_id) if partner else []
-        # ユーザーとパートナーのMBTIを取得
-        user_mbti = user.personality
-        partner_mbti = partner.personality if partner else "不明"
-        #ユーザーとパートナーの名前を取得
-        user_name = user.name
-        partner_name = partner.name if partner else "不明"
-
-        # 対話アドバイスを生成
-        advice_text = await generate_couple_conversation_advice(
-            user_summary_blocks=[
-                {"query_key":s.query_key, "summay_text":s.summary_text}
-                for s in user_summaries
-            ],
-            partner_summary_blocks=[
-                {"query_key": s.query_key, "summay_text": s.summary_text}
-                for s in partner_summaries
-            ],
-            user_mbti=user_mbti,
-            partner_mbti=partner_mbti,
-            user_name=user.name,
-            partner_name=partner.name
-        )
-        ## デバックコード
-        print("=====LLM出力=====")
-        print(advice_text)
-        # 対話アドバイスをDBに保存
-        advice_record = DialogueAdvice(
-            couple_id = user.couple_id,
-            user_id = user.user_id,
-            advice_text=advice_text
-        )
-        db.add(advice_record)
-        db.commit()
 
-        return {"advice":advice_text}
+        # 最新の要約データのidと作成日時、プロフィールからキャッシュの検証子を作る
+        # 入力が前回と同じなら、LLM呼び出しと保存を行わずに同じアドバイスを返す
+        inputs = await services.dialogue_advice_inputs(db, user, partner)
+
+        # 利用上限を超えていて、同じ入力のアドバイスがまだなければ、保存済みの最新のアドバイスを返す
+        if await usage_ledger.over_quota(user.user_id, user.couple_id) \
+                and await services.stored_dialogue_advice(db, user.user_id, inputs[0].etag) is None:
+            return degraded_response(await services.latest_dialogue_advice(db, user.user_id))
+
+        async def generate_advice():
+            # 最初のリクエストが切断されても作成は続くため、リクエストのセッション（db）は使わない
+            async with AsyncSessionLocal() as session:
+                advice, created = await services.dialogue_advice(session, user, partner, inputs)
+            if created:
+                # 同じユーザーの他の端末にも新しいアドバイスを通知する
+                await event_hub.publish([user.user_id], "dialogue_advice", {
+                    "advice": advice["advice"],
+                    "created_at": datetime.utcnow().isoformat(),
+                })
+            return advice
+
+        with billed_to(user.user_id, user.couple_id):
+            return await conditional_response(request, inputs[0], generate_advice)
 
+    except HTTPException:
+        raise
     except Exception as e:
-            db.rollback()
+            await db.rollback()
             raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
@@ -0,0 +1,465 @@
+# 役割：DBスキーマのバージョン管理を行う
+# schema_migrationsテーブルに適用済みのバージョンを記録し、未適用のマイグレーションを番号順に適用する
+# 各マイグレーションは既存DB（create_allで作成済み）と新規DBのどちらに適用しても結果が同じになるよう冪等に書く
+# 使い方: python migrations.py upgrade / python migrations.py current
+import json
+import logging
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, String, Table, inspect, select, text)
+from db import engine
+
+logger = logging.getLogger(__name__)
+
+# (バージョン, 説明, 適用関数) のリスト
+MIGRATIONS = []
+
+# データを書き換えるマイグレーションで1回に処理する行数
+BATCH_SIZE = 1000
+# 適用中に保持する名前付きロック（MySQL）と、その取得を待つ秒数
+LOCK_NAME = "futari_schema_migrations"
+LOCK_TIMEOUT = int(os.getenv("MIGRATION_LOCK_TIMEOUT", "600"))
+
+_version_table = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def migration(version: int, description: str):
+    """マイグレーション関数を登録するデコレータ"""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+
+# --- 冪等に書くためのヘルパー ---
+
+def has_index(conn, table_name: str, index_name: str) -> bool:
+    return any(ix["name"] == index_name for ix in inspect(conn).get_indexes(table_name))
+
+
+def has_column(conn, table_name: str, column_name: str) -> bool:
+    return any(col["name"] == column_name for col in inspect(conn).get_columns(table_name))
+
+
+def _column_nullable(conn, table_name: str, column_name: str) -> bool:
+    return next(col["nullable"] for col in inspect(conn).get_columns(table_name) if col["name"] == column_name)
+
+
+def create_index(conn, index_name: str, table_name: str, *column_names: str) -> None:
+    if has_index(conn, table_name, index_name):
+        return
+    table = Table(table_name, MetaData(), autoload_with=conn)
+    Index(index_name, *(table.c[name] for name in column_names)).create(conn)
+    logger.info(f"[migration] index作成: {index_name} ON {table_name}({', '.join(column_names)})")
+
+
+# --- マイグレーション定義 ---
+
+def _baseline_ddl(dialect: str) -> list:
+    """
+    マイグレーション導入前のスキーマ（バージョン1）のCREATE TABLE文。
+    models.pyの変更で結果が変わらないよう、当時のテーブル定義をDDLとして固定しておく
+    """
+    mysql = dialect == "mysql"
+    auto_increment = " AUTO_INCREMENT" if mysql else ""
+    gender = "ENUM('男','女','その他')" if mysql else "VARCHAR(3)"
+
+    def comment(text_: str) -> str:
+        return f" COMMENT '{text_}'" if mysql else ""
+
+    return [
+        f"""CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER NOT NULL{auto_increment},
+            name VARCHAR(50),
+            gender {gender} NOT NULL,
+            birthday DATE,
+            personality VARCHAR(10),
+            couple_id VARCHAR(50),
+            PRIMARY KEY (user_id)
+        )""",
+        f"""CREATE TABLE IF NOT EXISTS user_answers (
+            id INTEGER NOT NULL{auto_increment},
+            user_id INTEGER NOT NULL,
+            session_id VARCHAR(50) NOT NULL,
+            round_number INTEGER NOT NULL,
+            user_question TEXT,
+            PRIMARY KEY (id)
+        )""",
+        f"""CREATE TABLE IF NOT EXISTS conversation_history (
+            id INTEGER NOT NULL{auto_increment},
+            user_id INTEGER NOT NULL,
+            session_id VARCHAR(50) NOT NULL,
+            chat_history TEXT NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id)
+        )""",
+        f"""CREATE TABLE IF NOT EXISTS structured_answers (
+            id INTEGER NOT NULL{auto_increment},
+            user_id INTEGER NOT NULL,
+            conversation_history_id INTEGER NOT NULL,
+            answer_summary TEXT NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES users (user_id),
+            FOREIGN KEY(conversation_history_id) REFERENCES conversation_history (id)
+        )""",
+        f"""CREATE TABLE IF NOT EXISTS vector_summaries (
+            id INTEGER NOT NULL{auto_increment},
+            user_id INTEGER NOT NULL,
+            query_key TEXT NOT NULL,
+            summary_text TEXT NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES users (user_id)
+        )""",
+        f"""CREATE TABLE IF NOT EXISTS emotion_alerts (
+            id INTEGER NOT NULL{auto_increment},
+            conversation_history_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            most_negative_mention TEXT NOT NULL,
+            score FLOAT NOT NULL,
+            magnitude FLOAT NOT NULL,
+            label VARCHAR(50) NOT NULL,
+            emoji VARCHAR(10) NOT NULL,
+            message TEXT NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(conversation_history_id) REFERENCES conversation_history (id),
+            FOREIGN KEY(user_id) REFERENCES users (user_id)
+        )""",
+        f"""CREATE TABLE IF NOT EXISTS reflections (
+            reflection_id VARCHAR(36) NOT NULL,
+            user_id TEXT NOT NULL{comment('メールアドレスなどユーザーID')},
+            future_plans TEXT NOT NULL{comment('これからやろうと思うこと')},
+            want_to_discuss TEXT NOT NULL{comment('まだ話足りないこと')},
+            created_at DATETIME NOT NULL,
+            PRIMARY KEY (reflection_id)
+        )""",
+        f"""CREATE TABLE IF NOT EXISTS dialogue_advice (
+            id INTEGER NOT NULL{auto_increment},
+            couple_id VARCHAR(50) NOT NULL,
+            user_id INTEGER NOT NULL,
+            advice_text TEXT NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id)
+        )""",
+    ]
+
+
+@migration(1, "ベースライン（マイグレーション導入前のテーブルを作成）")
+def _baseline(conn):
+    for ddl in _baseline_ddl(conn.dialect.name):
+        conn.execute(text(ddl))
+
+
+@migration(2, "パートナー検索と期間検索用のインデックス追加、reflections.user_idをインデックス可能な型に変更")
+def _hot_query_indexes(conn):
+    if conn.dialect.name == "mysql":
+        conn.execute(text(
+            "ALTER TABLE reflections MODIFY user_id VARCHAR(255) NOT NULL COMMENT 'メールアドレスなどユーザーID'"
+        ))
+    create_index(conn, "ix_users_couple_id", "users", "couple_id")
+    create_index(conn, "ix_structured_answers_user_created", "structured_answers", "user_id", "created_at")
+    create_index(conn, "ix_vector_summaries_user_created", "vector_summaries", "user_id", "created_at")
+    create_index(conn, "ix_emotion_alerts_user_created", "emotion_alerts", "user_id", "created_at")
+    create_index(conn, "ix_conversation_history_user_created", "conversation_history", "user_id", "created_at")
+    create_index(conn, "ix_dialogue_advice_user_created", "dialogue_advice", "user_id", "created_at")
+    create_index(conn, "ix_reflections_user_created", "reflections", "user_id", "created_at")
+
+
+@migration(3, "structured_answers.answer_summaryをJSON型に変更し、集計用のsatisfaction_score列を追加")
+def _structured_answer_json(conn):
+    from structured_parser import parse_satisfaction_score
+
+    if conn.dialect.name == "mysql":
+        conn.execute(text("ALTER TABLE structured_answers MODIFY answer_summary JSON NOT NULL"))
+    if not has_column(conn, "structured_answers", "satisfaction_score"):
+        conn.execute(text("ALTER TABLE structured_answers ADD COLUMN satisfaction_score FLOAT NULL"))
+
+    # 既存行の満足度をidの昇順にBATCH_SIZE件ずつ埋める（バッチごとにコミットして長時間のロックを避ける）
+    table = Table("structured_answers", MetaData(), autoload_with=conn)
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(table.c.id, table.c.answer_summary)
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        for row_id, summary in rows:
+            if isinstance(summary, str):
+                summary = json.loads(summary)
+            score = parse_satisfaction_score((summary or {}).get("satisfaction_score"))
+            if score is not None:
+                conn.execute(table.update().where(table.c.id == row_id).values(satisfaction_score=score))
+        last_id = rows[-1][0]
+        conn.commit()
+    create_index(conn, "ix_structured_answers_user_created_score", "structured_answers",
+                 "user_id", "created_at", "satisfaction_score")
+
+
+@migration(4, "conversation_historyに圧縮したターン列(chat_turns)を追加し、既存のテキストを移行")
+def _compressed_history(conn):
+    from history_codec import LazyHistory
+
+    if not has_column(conn, "conversation_history", "chat_turns"):
+        blob_type = "MEDIUMBLOB" if conn.dialect.name == "mysql" else "BLOB"
+        conn.execute(text(f"ALTER TABLE conversation_history ADD COLUMN chat_turns {blob_type} NULL"))
+    if conn.dialect.name == "mysql":
+        conn.execute(text("ALTER TABLE conversation_history MODIFY chat_history TEXT NULL"))
+    elif not _column_nullable(conn, "conversation_history", "chat_history"):
+        # SQLiteは列の変更ができないため、NULLを許すテーブルを作ってコピーし、置き換える
+        conn.execute(text("""CREATE TABLE _conversation_history_new (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            session_id VARCHAR(50) NOT NULL,
+            chat_history TEXT,
+            created_at DATETIME,
+            chat_turns BLOB,
+            PRIMARY KEY (id)
+        )"""))
+        conn.execute(text(
+            "INSERT INTO _conversation_history_new (id, user_id, session_id, chat_history, created_at, chat_turns) "
+            "SELECT id, user_id, session_id, chat_history, created_at, chat_turns FROM conversation_history"
+        ))
+        conn.execute(text("DROP TABLE conversation_history"))
+        conn.execute(text("ALTER TABLE _conversation_history_new RENAME TO conversation_history"))
+        create_index(conn, "ix_conversation_history_user_created", "conversation_history", "user_id", "created_at")
+
+    # 旧形式の行を圧縮形式に移し、テキストは消して容量を空ける（話者情報は残っていないため1ターンとして保存）
+    table = Table("conversation_history", MetaData(), autoload_with=conn)
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(table.c.id, table.c.chat_history)
+            .where(table.c.id > last_id, table.c.chat_turns.is_(None), table.c.chat_history.is_not(None))
+            .order_by(table.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        for row_id, chat_history in rows:
+            conn.execute(table.update().where(table.c.id == row_id).values(
+                chat_turns=LazyHistory(legacy_text=chat_history).encode(),
+                chat_history=None,
+            ))
+        last_id = rows[-1][0]
+        conn.commit()
+
+
+def _auto_increment(conn) -> str:
+    return " AUTO_INCREMENT" if conn.dialect.name == "mysql" else ""
+
+
+# バージョン5以降で作成するテーブルも、models.pyの変更で結果が変わらないよう当時の定義をDDLで固定しておく
+@migration(5, "user_answersにcreated_atを追加し、保持期間を過ぎた行の移動先archive_batchesを作成")
+def _retention_archive(conn):
+    if not has_column(conn, "user_answers", "created_at"):
+        # MySQLでは既存行に適用時刻が入るため、既存の回答は適用日から保持期間が数えられる
+        default = " DEFAULT CURRENT_TIMESTAMP" if conn.dialect.name == "mysql" else ""
+        conn.execute(text(f"ALTER TABLE user_answers ADD COLUMN created_at DATETIME NULL{default}"))
+    create_index(conn, "ix_user_answers_created_at", "user_answers", "created_at")
+    blob_type = "MEDIUMBLOB" if conn.dialect.name == "mysql" else "BLOB"
+    conn.execute(text(f"""CREATE TABLE IF NOT EXISTS archive_batches (
+        id INTEGER NOT NULL{_auto_increment(conn)},
+        source_table VARCHAR(64) NOT NULL,
+        min_id INTEGER NOT NULL,
+        max_id INTEGER NOT NULL,
+        min_created_at DATETIME,
+        max_created_at DATETIME,
+        row_count INTEGER NOT NULL,
+        payload {blob_type} NOT NULL,
+        archived_at DATETIME,
+        PRIMARY KEY (id)
+    )"""))
+    create_index(conn, "ix_archive_batches_source_created", "archive_batches", "source_table", "max_created_at")
+
+
+@migration(6, "感情アラートの日別・週別集計テーブル(emotion_trend_buckets)を作成し、既存のアラートから集計")
+def _emotion_trend_buckets(conn):
+    import emotion_trend
+
+    conn.execute(text(f"""CREATE TABLE IF NOT EXISTS emotion_trend_buckets (
+        id INTEGER NOT NULL{_auto_increment(conn)},
+        user_id INTEGER NOT NULL,
+        granularity VARCHAR(10) NOT NULL,
+        bucket_start DATE NOT NULL,
+        alert_count INTEGER NOT NULL,
+        weight_sum FLOAT NOT NULL,
+        weighted_score_sum FLOAT NOT NULL,
+        score_sum FLOAT NOT NULL,
+        max_magnitude FLOAT NOT NULL,
+        label_counts JSON NOT NULL,
+        updated_at DATETIME,
+        PRIMARY KEY (id),
+        CONSTRAINT uq_emotion_trend_bucket UNIQUE (user_id, granularity, bucket_start)
+    )"""))
+    emotion_trend.backfill(conn, batch_size=BATCH_SIZE)
+
+
+@migration(7, "事前計算の結果を再利用するため、dialogue_advice.input_etagとreminder_reportsを追加")
+def _precomputed_results(conn):
+    if not has_column(conn, "dialogue_advice", "input_etag"):
+        conn.execute(text("ALTER TABLE dialogue_advice ADD COLUMN input_etag VARCHAR(64) NULL"))
+    conn.execute(text(f"""CREATE TABLE IF NOT EXISTS reminder_reports (
+        id INTEGER NOT NULL{_auto_increment(conn)},
+        user_id INTEGER NOT NULL,
+        input_etag VARCHAR(64) NOT NULL,
+        goodthing_remind TEXT NOT NULL,
+        badthing_remind TEXT NOT NULL,
+        created_at DATETIME,
+        PRIMARY KEY (id)
+    )"""))
+    create_index(conn, "ix_reminder_reports_user_etag", "reminder_reports", "user_id", "input_etag")
+
+
+@migration(8, "LLMの利用量の日別集計テーブル（llm_usage_daily）を追加")
+def _llm_usage_daily(conn):
+    conn.execute(text(f"""CREATE TABLE IF NOT EXISTS llm_usage_daily (
+        id INTEGER NOT NULL{_auto_increment(conn)},
+        day DATE NOT NULL,
+        user_id INTEGER NOT NULL,
+        couple_id VARCHAR(255),
+        site VARCHAR(32) NOT NULL,
+        calls INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        completion_tokens INTEGER NOT NULL,
+        cost_usd FLOAT NOT NULL,
+        created_at DATETIME,
+        updated_at DATETIME,
+        PRIMARY KEY (id),
+        CONSTRAINT uq_llm_usage_daily UNIQUE (day, user_id, site)
+    )"""))
+    create_index(conn, "ix_llm_usage_daily_couple_day", "llm_usage_daily", "couple_id", "day")
+
+
+@migration(9, "ワーカー間でSSEイベントを配送するeventsテーブルを追加")
+def _events(conn):
+    # SQLiteでも削除したidを再利用しないよう、AUTOINCREMENT付きの主キーにする
+    if conn.dialect.name == "mysql":
+        id_column = "id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY"
+    else:
+        id_column = "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT"
+    conn.execute(text(f"""CREATE TABLE IF NOT EXISTS events (
+        {id_column},
+        channel VARCHAR(64) NOT NULL,
+        payload BLOB NOT NULL,
+        created_at DATETIME
+    )"""))
+    create_index(conn, "ix_events_channel_id", "events", "channel", "id")
+    create_index(conn, "ix_events_created_at", "events", "created_at")
+
+
+@migration(10, "保持期間ジョブがcreated_atの範囲で対象行を探せるよう、対象テーブルにcreated_atのインデックスを追加")
+def _retention_created_at_indexes(conn):
+    for table_name in ("conversation_history", "vector_summaries", "dialogue_advice", "emotion_alerts",
+                       "reminder_reports", "llm_usage_daily"):
+        create_index(conn, f"ix_{table_name}_created_at", table_name, "created_at")
+
+
+@migration(11, "要約の入力が同じなら再利用できるよう、vector_summaries.input_etagを追加")
+def _vector_summary_etag(conn):
+    if not has_column(conn, "vector_summaries", "input_etag"):
+        conn.execute(text("ALTER TABLE vector_summaries ADD COLUMN input_etag VARCHAR(64) NULL"))
+    create_index(conn, "ix_vector_summaries_user_etag", "vector_summaries", "user_id", "input_etag")
+
+
+@migration(12, "保持期間の判定に使うcreated_atがNULLの行に適用時刻を入れる（NULLの行は保持期間ジョブの対象にならないため）")
+def _backfill_created_at(conn):
+    # バージョン5と同じく、作成日時の分からない既存の行は適用日から保持期間を数える
+    now = datetime.utcnow()
+    for table_name in ("user_answers", "conversation_history", "vector_summaries", "dialogue_advice", "emotion_alerts",
+                       "reminder_reports", "llm_usage_daily"):
+        table = Table(table_name, MetaData(), autoload_with=conn)
+        while True:
+            ids = conn.execute(
+                select(table.c.id).where(table.c.created_at.is_(None)).limit(BATCH_SIZE)
+            ).scalars().all()
+            if not ids:
+                break
+            conn.execute(table.update().where(table.c.id.in_(ids)).values(created_at=now))
+            conn.commit()
+
+
+# --- 実行 ---
+
+def applied_versions(bind=engine) -> set:
+    with bind.begin() as conn:
+        _version_table.create(conn, checkfirst=True)
+        return set(conn.execute(select(_version_table.c.version)).scalars())
+
+
+def current_version(bind=engine) -> int:
+    return max(applied_versions(bind), default=0)
+
+
+def pending_versions(bind=engine) -> list:
+    """未適用のマイグレーションのバージョン（起動時のスキーマ確認に使う）"""
+    applied = applied_versions(bind)
+    return [version for version, _, _ in MIGRATIONS if version not in applied]
+
+
+@contextmanager
+def migration_lock(bind=engine):
+    """
+    複数のプロセス（ワーカーやデプロイのジョブ）が同時にupgradeしないよう、適用中はDBのロックを保持する。
+    MySQLではGET_LOCKの名前付きロックを使い、LOCK_TIMEOUT秒待っても取れなければエラーにする。
+    SQLiteは同一ホストのファイルで書き込みがDB全体で直列化されるため、ロックは取らない
+    """
+    if bind.dialect.name != "mysql":
+        yield
+        return
+    with bind.connect() as lock_conn:
+        acquired = lock_conn.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                                     {"name": LOCK_NAME, "timeout": LOCK_TIMEOUT}).scalar()
+        if acquired != 1:
+            raise RuntimeError(f"マイグレーションのロック（{LOCK_NAME}）を{LOCK_TIMEOUT}秒以内に取得できませんでした")
+        try:
+            yield
+        finally:
+            lock_conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": LOCK_NAME})
+
+
+def upgrade(bind=engine, target: int = None) -> list:
+    """未適用のマイグレーションを番号順に適用し、適用したバージョンのリストを返す"""
+    with migration_lock(bind):
+        # ロックを待つ間に他のプロセスが適用した分は飛ばすため、取得してから適用済みのバージョンを読む
+        applied = applied_versions(bind)
+        newly_applied = []
+        for version, description, func in MIGRATIONS:
+            if version in applied or (target is not None and version > target):
+                continue
+            logger.info(f"[migration] {version}: {description}")
+            # 大きなテーブルを書き換えるマイグレーションは途中でconn.commit()してよい
+            with bind.connect() as conn:
+                func(conn)
+                conn.execute(_version_table.insert().values(
+                    version=version, description=description, applied_at=datetime.utcnow()
+                ))
+                conn.commit()
+            newly_applied.append(version)
+    return newly_applied
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    if command == "upgrade":
+        target = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        print(f"applied: {upgrade(target=target)}")
+    elif command == "current":
+        print(f"current version: {current_version()}, pending: {pending_versions()}")
+    else:
+        print("usage: python migrations.py [upgrade [version] | current]")
+        sys.exit(1)
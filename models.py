@@ -1,7 +1,9 @@
 ### models.py ###
 import enum
-from sqlalchemy import Column, String, Date, Integer, DateTime, Text, Float, Enum, ForeignKey
+import uuid
+from sqlalchemy import Column, String, Date, Integer, DateTime, Text, Float, Enum, ForeignKey, Index, JSON, LargeBinary, UniqueConstraint
 from datetime import datetime
+from sqlalchemy.dialects.mysql import MEDIUMBLOB
 from db import Base
 from sqlalchemy.orm import Mapped, mapped_column
 
@@ -18,7 +20,7 @@ class User(Base):
     gender = Column(Enum(GenderEnum), nullable=False)  # 性別：男, 女, その他
     birthday = Column(Date)   # 誕生日
     personality = Column(String(10))      # 性格(MBTI)
-    couple_id = Column(String(50))    # 夫婦id
+    couple_id = Column(String(50), index=True)    # 夫婦id（パートナー検索に使うためインデックスを張る）
 
 
 class UserAnswer(Base):
@@ -28,23 +30,32 @@ class UserAnswer(Base):
     session_id = Column(String(50), nullable=False)       # 会話 session id
     round_number = Column(Integer, nullable=False)        # ラウンド番号
     user_question = Column(Text, nullable=True)           # ユーザーの質問または回答
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # 保持期間の判定に使う
 
 
 class ConversationHistory(Base):
     __tablename__ = "conversation_history"
+    __table_args__ = (Index("ix_conversation_history_user_created", "user_id", "created_at"),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, nullable=False)
     session_id = Column(String(50), nullable=False)
-    chat_history = Column(Text, nullable=False)  ## 会話の全履歴（LLM のメモリにある内容を結合するなど）
-    created_at = Column(DateTime, default=datetime.utcnow)
+    chat_history = Column(Text, nullable=True)  ## 旧形式の会話履歴（メッセージを結合したテキスト）。新しい行では使わない
+    chat_turns = Column(LargeBinary().with_variant(MEDIUMBLOB(), "mysql"), nullable=True)  ## 話者付きのターン列をzstdで圧縮したもの（history_codecで読み書き）
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # 保持期間の判定に使う
 
 
 class StructuredAnswer(Base):
     __tablename__ = "structured_answers"
+    __table_args__ = (
+        Index("ix_structured_answers_user_created", "user_id", "created_at"),
+        # 満足度の推移をインデックスだけで集計するためのカバリングインデックス
+        Index("ix_structured_answers_user_created_score", "user_id", "created_at", "satisfaction_score"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)  # 追加
     conversation_history_id = Column(Integer, ForeignKey("conversation_history.id"), nullable=False)
-    answer_summary = Column(Text, nullable=False)  # JSON形式などでまとめた構造化データを保存
+    answer_summary = Column(JSON, nullable=False)  # 抽出した構造化データ（ネイティブのJSON型で保存）
+    satisfaction_score = Column(Float, nullable=True)  # answer_summaryの満足度を数値化したもの（集計用）
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class VectorSummary(Base):
@@ -52,14 +63,21 @@ class VectorSummary(Base):
     ベクトル検索結果を要約したものを保存するテーブルの例
     """
     __tablename__ = "vector_summaries"
+    __table_args__ = (
+        Index("ix_vector_summaries_user_created", "user_id", "created_at"),
+        Index("ix_vector_summaries_user_etag", "user_id", "input_etag"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
     query_key = Column(Text, nullable=False)
     summary_text = Column(Text, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # 要約の元にした構造化データ（idの一覧）の検証子。入力が同じなら要約を作り直さずに再利用する
+    input_etag = Column(String(64), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # 保持期間の判定に使う
 
 class EmotionAlert(Base):
     __tablename__ = "emotion_alerts"
+    __table_args__ = (Index("ix_emotion_alerts_user_created", "user_id", "created_at"),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     # このアラートがどの会話履歴に紐付くか
     conversation_history_id = Column(Integer, ForeignKey("conversation_history.id"), nullable=False)
@@ -77,22 +95,111 @@ class EmotionAlert(Base):
     emoji = Column(String(10), nullable=False)
     # 定型のアラート文
     message = Column(Text, nullable=False)
-    # 生成日時（何日前の感情かを示すため）
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # 生成日時（何日前の感情かを示すため。保持期間の判定にも使う）
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
 class UserReflections(Base):
     __tablename__ = 'reflections'
+    __table_args__ = (Index("ix_reflections_user_created", "user_id", "created_at"),)
     
     reflection_id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id: Mapped[str] = mapped_column(Text, comment="メールアドレスなどユーザーID")
+    user_id: Mapped[str] = mapped_column(String(255), comment="メールアドレスなどユーザーID")
     future_plans: Mapped[str] = mapped_column(Text, comment="これからやろうと思うこと")
     want_to_discuss: Mapped[str] = mapped_column(Text, comment="まだ話足りないこと")
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
 
 class DialogueAdvice(Base):
     __tablename__ = "dialogue_advice"
+    __table_args__ = (Index("ix_dialogue_advice_user_created", "user_id", "created_at"),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     couple_id = Column(String(50), nullable=False)
     user_id = Column(Integer, nullable=False)  # 誰がこのアドバイスを見たか
     advice_text = Column(Text, nullable=False)
+    # 生成に使った入力（要約とプロフィール）の検証子。同じ入力のアドバイスを再利用するために使う
+    input_etag = Column(String(64), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # 保持期間の判定に使う
+
+
+# パートナーの直近レポートから作ったリマインド（Good/Bad）。同じレポートに対する分析はLLMを呼ばずにここから返す
+class ReminderReport(Base):
+    __tablename__ = "reminder_reports"
+    __table_args__ = (Index("ix_reminder_reports_user_etag", "user_id", "input_etag"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, nullable=False)           # レポートの持ち主（リマインドを見るのはそのパートナー）
+    input_etag = Column(String(64), nullable=False)     # 元にしたレポートのidから作った検証子
+    goodthing_remind = Column(Text, nullable=False)
+    badthing_remind = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # 保持期間の判定に使う
+
+
+# 感情アラートのユーザー別・期間別の集計（emotion_trend.pyがアラートの保存と同じトランザクションで更新する）
+# 平均スコアは weighted_score_sum / weight_sum（重みは各アラートの感情強度）で求める
+class EmotionTrendBucket(Base):
+    __tablename__ = "emotion_trend_buckets"
+    __table_args__ = (
+        UniqueConstraint("user_id", "granularity", "bucket_start", name="uq_emotion_trend_bucket"),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, nullable=False)         # アラートを受信したユーザーID
+    granularity = Column(String(10), nullable=False)  # "day" または "week"（週は月曜始まり）
+    bucket_start = Column(Date, nullable=False)       # 期間の開始日（UTC）
+    alert_count = Column(Integer, nullable=False, default=0)
+    weight_sum = Column(Float, nullable=False, default=0.0)
+    weighted_score_sum = Column(Float, nullable=False, default=0.0)
+    score_sum = Column(Float, nullable=False, default=0.0)  # 重みがすべて0のときの単純平均用
+    max_magnitude = Column(Float, nullable=False, default=0.0)
+    label_counts = Column(JSON, nullable=False)       # {感情ラベル: 件数}
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# 保持期間を過ぎてホットテーブルから移した行（retention.pyが書き込む）
+# 元テーブルの行をバッチ単位でまとめ、orjson + zstdで圧縮して保存する
+class ArchiveBatch(Base):
+    __tablename__ = "archive_batches"
+    __table_args__ = (Index("ix_archive_batches_source_created", "source_table", "max_created_at"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source_table = Column(String(64), nullable=False)   # 移動元のテーブル名
+    min_id = Column(Integer, nullable=False)            # バッチに含まれる元の行idの範囲
+    max_id = Column(Integer, nullable=False)
+    min_created_at = Column(DateTime)
+    max_created_at = Column(DateTime)
+    row_count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary().with_variant(MEDIUMBLOB(), "mysql"), nullable=False)  # zstd圧縮した行のJSON配列
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+
+# LLMの利用量の日別集計（usage_ledger.pyが書き込む）
+# 呼び出しごとには保存せず、(日付, ユーザー, 呼び出し元)ごとの1行にトークン数と推定コストを加算する
+class LlmUsageDaily(Base):
+    __tablename__ = "llm_usage_daily"
+    __table_args__ = (
+        UniqueConstraint("day", "user_id", "site", name="uq_llm_usage_daily"),
+        Index("ix_llm_usage_daily_couple_day", "couple_id", "day"),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    day = Column(Date, nullable=False)                   # 集計日（UTC）
+    user_id = Column(Integer, nullable=False)            # 利用したユーザーID（特定できない呼び出しは0）
+    couple_id = Column(String(255), nullable=True)
+    site = Column(String(32), nullable=False)            # 呼び出し元（chat・summary・adviceなど）
+    calls = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    cost_usd = Column(Float, nullable=False, default=0.0)  # 単価から計算した推定コスト（USD）
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # 保持期間の判定に使う
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# ワーカー間で配送するSSEイベント（event_hub.DatabasePubSubが書き込み、各ワーカーがポーリングして読む）
+# 自動採番のidを全ワーカー共通のイベントIDとして使うため、Last-Event-IDでの再送はどのワーカーに再接続しても成り立つ
+class EventLog(Base):
+    __tablename__ = "events"
+    __table_args__ = (
+        Index("ix_events_channel_id", "channel", "id"),
+        Index("ix_events_created_at", "created_at"),
+        # SQLiteでも削除したidを再利用せず、単調増加にする
+        {"sqlite_autoincrement": True},
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    channel = Column(String(64), nullable=False)
+    payload = Column(LargeBinary, nullable=False)       # orjsonでシリアライズしたイベント（idを除く）
     created_at = Column(DateTime, default=datetime.utcnow)
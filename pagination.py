@@ -0,0 +1,53 @@
+# 履歴系の一覧エンドポイントで使うキーセットページネーション
+# (created_at, id) の降順に並べ、前ページ最後の行の値をカーソルとして次ページを取得する
+# OFFSETを使わないため、ページが深くなってもインデックスを辿るだけで済む
+import base64
+from datetime import datetime
+import orjson
+from sqlalchemy import and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created_at: datetime, row_id) -> str:
+    payload = orjson.dumps([created_at.isoformat() if created_at else None, row_id])
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = orjson.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), row_id
+    except Exception as e:
+        raise InvalidCursor(f"不正なカーソルです: {cursor}") from e
+
+
+async def fetch_page(session: AsyncSession, stmt, created_col, id_col, limit: int, cursor: str = None) -> dict:
+    """
+    stmt（SELECT文）を (created_at, id) の降順でlimit件取得し、
+    {"items": [...], "next_cursor": 次ページのカーソルまたはNone} を返す。
+    stmtにはcreated_colとid_colが含まれている必要がある。
+    """
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        stmt = stmt.where(or_(
+            created_col < created_at,
+            and_(created_col == created_at, id_col < row_id),
+        ))
+    # 次ページの有無を判定するため1件多く取得する
+    stmt = stmt.order_by(created_col.desc(), id_col.desc()).limit(limit + 1)
+    rows = [dict(row._mapping) for row in (await session.execute(stmt)).all()]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last[created_col.key], last[id_col.key])
+    return {"items": rows, "next_cursor": next_cursor}
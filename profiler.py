@@ -0,0 +1,244 @@
+# リクエスト単位のサンプリングプロファイラ
+# 署名付きのX-Profileヘッダー（PROFILE_SECRET）を付けたリクエストと、PROFILE_SAMPLE_RATEの割合で選んだリクエストについて、
+# 処理中に別スレッドからイベントループのスタックを一定間隔で取得し、flamegraph.pl・speedscopeで読める
+# collapsed形式（"関数;関数;関数 サンプル数"）でPROFILE_DIRに保存する。ルートとuser_idはメタデータ（.json）に残す。
+# リクエストがawaitで待っている間は、待っている箇所のコルーチンの呼び出し列に[await]を付けて記録する
+# （asyncio.to_threadで実行中の同期処理は、そのto_threadを待っている箇所として現れる）。
+# どちらも設定しなければミドルウェアは何もせずに次へ渡す
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as StackCounter
+from datetime import datetime
+from urllib.parse import parse_qs
+import orjson
+from metrics import Counter
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+# X-Profileヘッダーの署名に使う秘密鍵。未設定ならヘッダーによるプロファイルは行わない
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+# ヘッダーがなくてもプロファイルするリクエストの割合（0〜1）
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# 保存しておくプロファイルの数（古いものから削除する）
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+# 管理用エンドポイント（/admin/profiles）のトークン。未設定なら管理用エンドポイントは404を返す
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+PROFILE_HEADER = b"x-profile"
+AWAIT_FRAME = "[await]"
+
+profiles_written = Counter("profiles_written_total", "保存したリクエストのプロファイル数", ("route", "trigger"))
+
+
+def sign_profile_request(expires_at: int, secret: str = PROFILE_SECRET) -> str:
+    """X-Profileヘッダーの値（"<有効期限のUNIX秒>.<HMAC-SHA256>"）を作る"""
+    digest = hmac.new(secret.encode(), str(expires_at).encode(), hashlib.sha256).hexdigest()
+    return f"{expires_at}.{digest}"
+
+
+def verify_profile_header(value: str, secret: str = PROFILE_SECRET) -> bool:
+    if not secret:
+        return False
+    expires_at, _, _ = value.partition(".")
+    if not expires_at.isdigit() or int(expires_at) < time.time():
+        return False
+    return hmac.compare_digest(value, sign_profile_request(int(expires_at), secret))
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _running_stack(frame, root) -> list:
+    """ループスレッドのスタックのうちrootより内側のフレーム（外側から順）。rootを含まなければNone"""
+    frames = []
+    while frame is not None:
+        if frame is root:
+            return frames[::-1]
+        frames.append(frame)
+        frame = frame.f_back
+    return None
+
+
+def _awaiting_stack(task, root) -> list:
+    """待機中のタスクのコルーチンをcr_awaitでたどり、rootより内側のフレームを外側から順に返す"""
+    frames = []
+    coro = task.get_coro()
+    inside = False
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        if inside:
+            frames.append(frame)
+        elif frame is root:
+            inside = True
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return frames
+
+
+class RequestProfile:
+    """1リクエスト分のサンプリング。start()からstop()まで別スレッドでスタックを取得する"""
+
+    def __init__(self, root_frame, task, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.root_frame = root_frame
+        self.task = task
+        self.interval = interval
+        self.samples = StackCounter()
+        self._loop_thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = _running_stack(frame, self.root_frame)
+            if stack is None:
+                stack = _awaiting_stack(self.task, self.root_frame)
+                labels = [_label(f) for f in stack] + [AWAIT_FRAME]
+            else:
+                labels = [_label(f) for f in stack]
+            del frame, stack
+            if labels:
+                self.samples[";".join(labels)] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def collapsed(self) -> bytes:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common()).encode()
+
+
+def _profile_path(profile_id: str, suffix: str) -> str:
+    return os.path.join(PROFILE_DIR, f"{profile_id}{suffix}")
+
+
+def _write_profile(profile_id: str, collapsed: bytes, meta: dict) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(_profile_path(profile_id, ".collapsed"), "wb") as f:
+        f.write(collapsed)
+    with open(_profile_path(profile_id, ".json"), "wb") as f:
+        f.write(orjson.dumps(meta))
+    # 古いプロファイルを削除する
+    for old in list_profiles()[PROFILE_MAX_FILES:]:
+        for suffix in (".collapsed", ".json"):
+            try:
+                os.remove(_profile_path(old["id"], suffix))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles() -> list:
+    """保存済みのプロファイルのメタデータ（新しい順）"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILE_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name), "rb") as f:
+                profiles.append(orjson.loads(f.read()))
+        except (OSError, orjson.JSONDecodeError):
+            continue
+    return sorted(profiles, key=lambda p: p["created_at"], reverse=True)
+
+
+_PROFILE_ID = re.compile(r"^[0-9A-Za-z_-]+$")
+
+
+def profile_file(profile_id: str):
+    """collapsed形式のファイルのパス。存在しない・不正なidならNone"""
+    if not _PROFILE_ID.match(profile_id):
+        return None
+    path = _profile_path(profile_id, ".collapsed")
+    return path if os.path.exists(path) else None
+
+
+def is_admin(token: str) -> bool:
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+def _trigger(scope) -> str:
+    """プロファイルする理由（"header" / "sample"）。対象外ならNone"""
+    if PROFILE_SECRET:
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                if verify_profile_header(value.decode("latin-1")):
+                    return "header"
+                break
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sample"
+    return None
+
+
+class ProfilingMiddleware:
+    """対象のリクエストだけサンプリングプロファイラを動かし、終了後にプロファイルをPROFILE_DIRへ書き出すASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (PROFILE_SECRET or PROFILE_SAMPLE_RATE > 0):
+            await self.app(scope, receive, send)
+            return
+        trigger = _trigger(scope)
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        profile = RequestProfile(sys._getframe(), asyncio.current_task())
+        started = time.perf_counter()
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            profile.stop()
+            duration = time.perf_counter() - started
+            route = telemetry.route_template(scope)
+            user_id = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("user_id", [None])[0]
+            created_at = datetime.utcnow()
+            profile_id = f"{created_at:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+            meta = {
+                "id": profile_id,
+                "created_at": created_at.isoformat(),
+                "method": scope["method"],
+                "route": route,
+                "path": scope["path"],
+                "user_id": user_id,
+                "status": status["code"],
+                "trigger": trigger,
+                "duration_ms": round(duration * 1000, 1),
+                "interval_ms": profile.interval * 1000,
+                "samples": sum(profile.samples.values()),
+            }
+            try:
+                await asyncio.to_thread(_write_profile, profile_id, profile.collapsed(), meta)
+                profiles_written.inc(route=route, trigger=trigger)
+                logger.info(f"[profiler] {profile_id} {scope['method']} {route} {meta['duration_ms']}ms")
+            except OSError as e:
+                logger.warning(f"[profiler] プロファイルの保存に失敗: {e}")
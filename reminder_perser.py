@@ -1,42 +1,47 @@
 ### structured_parser.py ###
-from langchain.output_parsers import StructuredOutputParser , ResponseSchema
 import logging
 import json
-from conversation_chain import llm
+from functools import lru_cache
+from conversation_chain import get_llm
+from telemetry import stage
+from token_budget import fit
 
 logger = logging.getLogger(__name__)
 
-# 各質問に対応する情報を抽出するためのスキーマ定義
-response_schemas = [
-    ResponseSchema(
-        name="Goodthing_remind", 
-        description="今回のレポートの内容で「ポジティブな事柄」を最大100文字程度出力してください"
-    ),
-    ResponseSchema(
-        name="Badthing_remind", 
-        description="今回のレポートの内容で「ネガティブな事柄」を最大100文字程度で抽出して出力してください"
-    )
+# 各質問に対応する情報を抽出するためのスキーマ定義（フィールド名, 説明）
+RESPONSE_SCHEMAS = [
+    ("Goodthing_remind", "今回のレポートの内容で「ポジティブな事柄」を最大100文字程度出力してください"),
+    ("Badthing_remind", "今回のレポートの内容で「ネガティブな事柄」を最大100文字程度で抽出して出力してください"),
 ]
 
-# StructuredOutputParserの初期化
-parser = StructuredOutputParser.from_response_schemas(response_schemas)
-output_format = parser.get_format_instructions()
+
+@lru_cache(maxsize=None)
+def output_parser():
+    """StructuredOutputParserを生成する（LangChainは初回呼び出し時に読み込む）"""
+    from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+    return StructuredOutputParser.from_response_schemas(
+        [ResponseSchema(name=name, description=description) for name, description in RESPONSE_SCHEMAS]
+    )
 
 def extract_structured_data_reminder(chat_history: str) -> dict:
     """
     レポートの内容で「ポジティブな事柄」と「ネガティブな事柄」を最大100文字程度で抽出して出力します。
     
     """
+    parser = output_parser()
+    # レポートをつなげたものがトークン予算を超える場合は先に要約する
+    chat_history = fit(chat_history, "reminder", "ポジティブな事柄とネガティブな事柄がそれぞれわかるように要約してください。")
     prompt = (
         "以下のレポートから、ユーザーが気にしているであろうことを抽出してください"
         "出力は次のJSON形式に従ってください。\n\n"
-        f"{output_format}\n\n"
+        f"{parser.get_format_instructions()}\n\n"
         f"チャット履歴:\n{chat_history}"
     )
 
     try:
         # LLMからの出力を取得
-        llm_output = llm.invoke(prompt)
+        with stage("llm", "reminder"):
+            llm_output = get_llm().invoke(prompt)
         # もし戻り値が AIMessage オブジェクトであれば、.content を取り出す
         if hasattr(llm_output,"content"):
             llm_output=llm_output.content
@@ -0,0 +1,255 @@
+# 役割：増え続けるテーブルから保持期間を過ぎた行をarchive_batchesへ移し、ホットテーブルを小さく保つ
+# 読み出し側のエンドポイントは直近数日分か最新N件しか見ないため、古い行は圧縮してまとめて退避する
+# 行は(created_at, id)の昇順にRETENTION_BATCH_SIZE件ずつ処理し、バッチごとにコミットして長時間のロックを避ける
+# 使い方: python retention.py run [--dry-run] [--table emotion_alerts]
+#         python retention.py stats
+import argparse
+import asyncio
+import base64
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import orjson
+import zstandard
+from sqlalchemy import and_, delete, func, insert, or_, select, text, update
+from db import engine
+from models import (UserAnswer, ConversationHistory, VectorSummary, DialogueAdvice, EmotionAlert, ReminderReport,
+                    LlmUsageDaily, ArchiveBatch)
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+# バッチ間の待ち時間（秒）。本番のクエリにロックやI/Oを譲るため
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.1"))
+# アプリ内でテーブルサイズのメトリクスを更新する間隔（秒）。0なら更新しない
+TABLE_STATS_INTERVAL = float(os.getenv("TABLE_STATS_INTERVAL", "300"))
+COMPRESSION_LEVEL = 10
+
+archived_rows = Counter("retention_archived_rows_total", "archive_batchesへ移した行数", ("table",))
+archive_bytes = Counter("retention_archive_bytes_total", "archive_batchesに書き込んだ圧縮後のバイト数", ("table",))
+last_run = Gauge("retention_last_run_timestamp_seconds", "保持期間ジョブが最後に完了した時刻（UNIX秒）")
+hot_table_rows = Gauge("hot_table_rows", "ホットテーブルの行数（MySQLでは統計情報による概算）", ("table",))
+hot_table_bytes = Gauge("hot_table_bytes", "ホットテーブルのデータ＋インデックスのサイズ（MySQLのみ）", ("table",))
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    model: object
+    # 保持する日数（環境変数 RETENTION_<TABLE>_DAYS で上書きできる）
+    days: int
+    # ユーザーごとに期間に関係なく残す最新の件数（最新N件を読むエンドポイント向け）
+    keep_latest: int = 0
+    # 行を削除せずに退避する列（他テーブルから外部キーで参照される行は本体を残し、大きい列だけ退避して空にする）
+    payload_columns: tuple = ()
+
+    @property
+    def table(self):
+        return self.model.__table__
+
+    @property
+    def retention_days(self) -> int:
+        return int(os.getenv(f"RETENTION_{self.table.name.upper()}_DAYS", str(self.days)))
+
+
+POLICIES = [
+    RetentionPolicy(UserAnswer, days=30),
+    # structured_answers / emotion_alertsから参照されるため、行は残して会話本文だけ退避する
+    RetentionPolicy(ConversationHistory, days=180, payload_columns=("chat_turns", "chat_history")),
+    # report_remindingは最新3件の要約を読む
+    RetentionPolicy(VectorSummary, days=60, keep_latest=3),
+    RetentionPolicy(DialogueAdvice, days=30),
+    # emotion_alert/latestは最新1件を読む
+    RetentionPolicy(EmotionAlert, days=180, keep_latest=1),
+    # 再利用されるのは直近のレポートに対するリマインドだけ
+    RetentionPolicy(ReminderReport, days=30, keep_latest=1),
+    # LLMの利用量の日別集計は、前年同月と比べられるよう1年強残す
+    RetentionPolicy(LlmUsageDaily, days=400),
+]
+
+
+def _default(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    raise TypeError
+
+
+def encode_rows(rows: list[dict]) -> bytes:
+    """退避する行のリストをorjson + zstdで圧縮する（bytes列はbase64文字列にする）"""
+    payload = orjson.dumps(rows, default=_default)
+    return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(payload)
+
+
+def decode_rows(blob: bytes) -> list[dict]:
+    return orjson.loads(zstandard.ZstdDecompressor().decompress(blob))
+
+
+def _protected_ids(conn, policy: RetentionPolicy, user_ids: set) -> set:
+    """ユーザーごとの最新keep_latest件のid（ユーザーごとの順位をウィンドウ関数で付け、1回のクエリで取得する）"""
+    table = policy.table
+    ranked = select(
+        table.c.id,
+        func.row_number().over(
+            partition_by=table.c.user_id, order_by=(table.c.created_at.desc(), table.c.id.desc())
+        ).label("rank"),
+    ).where(table.c.user_id.in_(user_ids)).subquery()
+    return set(conn.execute(select(ranked.c.id).where(ranked.c.rank <= policy.keep_latest)).scalars())
+
+
+def _resume_from(conn, policy: RetentionPolicy):
+    """
+    前回までの実行で走査を終えたcreated_at（最後に書き込んだバッチの最大値）。それより前の行は退避済みか退避する列が空のため読み直さない。
+    keep_latestのテーブルは、保護していた行がユーザーの新しい行の追加で後から対象になるため先頭から走査する（残っているのは保護した行だけ）
+    """
+    if policy.keep_latest:
+        return None
+    return conn.execute(
+        select(func.max(ArchiveBatch.max_created_at)).where(ArchiveBatch.source_table == policy.table.name)
+    ).scalar()
+
+
+def archive_table(conn, policy: RetentionPolicy, now: datetime = None, dry_run: bool = False) -> int:
+    """
+    policyのテーブルから保持期間を過ぎた行をarchive_batchesへ移し、移した行数を返す。
+    created_atのインデックスで保持期間を過ぎた範囲だけを(created_at, id)の順に読み、id・user_id・created_atで対象を判定して、
+    対象行だけを全列取得して退避する（1回の走査・書き込みはRETENTION_BATCH_SIZE件に収まる）。
+    """
+    table = policy.table
+    cutoff = (now or datetime.utcnow()) - timedelta(days=policy.retention_days)
+    resume_from = _resume_from(conn, policy)
+    position = None  # 最後に読んだ行の(created_at, id)
+    moved = 0
+    while True:
+        stmt = select(table.c.id, table.c.user_id, table.c.created_at).where(table.c.created_at < cutoff)
+        if position is not None:
+            stmt = stmt.where(or_(
+                table.c.created_at > position[0], and_(table.c.created_at == position[0], table.c.id > position[1])
+            ))
+        elif resume_from is not None:
+            stmt = stmt.where(table.c.created_at >= resume_from)
+        rows = conn.execute(stmt.order_by(table.c.created_at, table.c.id).limit(RETENTION_BATCH_SIZE)).all()
+        if not rows:
+            break
+        position = (rows[-1].created_at, rows[-1].id)
+        expired = list(rows)
+        if policy.keep_latest:
+            protected = _protected_ids(conn, policy, {row.user_id for row in expired})
+            expired = [row for row in expired if row.id not in protected]
+        if not expired:
+            continue
+
+        ids = [row.id for row in expired]
+        if policy.payload_columns:
+            columns = [table.c.id, table.c.user_id, table.c.created_at] + [table.c[col] for col in policy.payload_columns]
+            stmt = select(*columns).where(
+                table.c.id.in_(ids), or_(*(table.c[col].is_not(None) for col in policy.payload_columns))
+            )
+        else:
+            stmt = select(table).where(table.c.id.in_(ids))
+        archived = [dict(row._mapping) for row in conn.execute(stmt.order_by(table.c.id))]
+        if not archived:
+            continue
+        moved += len(archived)
+        if dry_run:
+            continue
+
+        ids = [row["id"] for row in archived]
+        blob = encode_rows(archived)
+        conn.execute(insert(ArchiveBatch).values(
+            source_table=table.name,
+            min_id=ids[0],
+            max_id=ids[-1],
+            min_created_at=min(row["created_at"] for row in archived),
+            max_created_at=max(row["created_at"] for row in archived),
+            row_count=len(archived),
+            payload=blob,
+            archived_at=datetime.utcnow(),
+        ))
+        if policy.payload_columns:
+            conn.execute(update(table).where(table.c.id.in_(ids))
+                         .values({col: None for col in policy.payload_columns}))
+        else:
+            conn.execute(delete(table).where(table.c.id.in_(ids)))
+        conn.commit()
+        archived_rows.inc(len(ids), table=table.name)
+        archive_bytes.inc(len(blob), table=table.name)
+        time.sleep(RETENTION_BATCH_PAUSE)
+    # 読み取りだけで終わった場合もトランザクションを閉じる
+    conn.commit()
+    return moved
+
+
+def table_stats(conn) -> dict:
+    """{テーブル名: (行数, バイト数またはNone)} を返し、ホットテーブルのゲージを更新する"""
+    names = [policy.table.name for policy in POLICIES]
+    stats = {}
+    if conn.dialect.name == "mysql":
+        # COUNT(*)は大きなテーブルで重いため、information_schemaの統計値を使う
+        result = conn.execute(text(
+            "SELECT table_name, table_rows, data_length + index_length FROM information_schema.tables "
+            "WHERE table_schema = DATABASE()"
+        ))
+        stats = {name: (rows or 0, size or 0) for name, rows, size in result if name in names}
+    else:
+        for policy in POLICIES:
+            count = conn.execute(select(func.count()).select_from(policy.table)).scalar_one()
+            stats[policy.table.name] = (count, None)
+    for name, (rows, size) in stats.items():
+        hot_table_rows.set(rows, table=name)
+        if size is not None:
+            hot_table_bytes.set(size, table=name)
+    return stats
+
+
+def run(bind=engine, tables: list = None, dry_run: bool = False) -> dict:
+    """すべて（またはtablesで指定した）テーブルに保持期間を適用し、{テーブル名: 移した行数} を返す"""
+    now = datetime.utcnow()
+    result = {}
+    for policy in POLICIES:
+        if tables and policy.table.name not in tables:
+            continue
+        with bind.connect() as conn:
+            started = time.perf_counter()
+            result[policy.table.name] = archive_table(conn, policy, now=now, dry_run=dry_run)
+            logger.info(f"[retention] {policy.table.name}: {result[policy.table.name]}行 "
+                        f"({policy.retention_days}日より前, {time.perf_counter() - started:.1f}s)")
+    with bind.connect() as conn:
+        table_stats(conn)
+    if not dry_run:
+        last_run.set(time.time())
+    return result
+
+
+async def monitor_table_sizes(bind=engine, interval: float = TABLE_STATS_INTERVAL):
+    """アプリ内でホットテーブルのサイズのゲージを定期的に更新する"""
+    def refresh():
+        with bind.connect() as conn:
+            table_stats(conn)
+
+    while True:
+        try:
+            await asyncio.to_thread(refresh)
+        except Exception as e:
+            logger.warning(f"[retention] テーブルサイズの取得に失敗: {e}")
+        await asyncio.sleep(interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="保持期間を過ぎた行をarchive_batchesへ移す")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run")
+    run_parser.add_argument("--dry-run", action="store_true", help="移動対象の行数だけを数える")
+    run_parser.add_argument("--table", action="append", help="対象のテーブル（複数指定可）")
+    sub.add_parser("stats")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        for name, count in run(tables=args.table, dry_run=args.dry_run).items():
+            print(f"{name}: {count}")
+    else:
+        with engine.connect() as conn:
+            for name, (rows, size) in table_stats(conn).items():
+                print(f"{name}: rows={rows} bytes={size if size is not None else '-'}")
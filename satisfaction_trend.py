@@ -0,0 +1,87 @@
+# 満足度（StructuredAnswer.satisfaction_score）の推移を集計する
+# 日ごとの合計・件数はSQLのGROUP BYで求め、移動平均は取得した小さな配列に対してNumPyで計算する
+# ORMオブジェクトやanswer_summaryのJSONは読み込まない
+from datetime import date, datetime, timedelta
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import StructuredAnswer
+
+
+async def fetch_daily_scores(session: AsyncSession, user_ids: list[int], since: datetime) -> list:
+    """(user_id, 日付, 満足度の合計, 件数) の行を返す（日付はUTC基準）"""
+    day = func.date(StructuredAnswer.created_at).label("day")
+    stmt = (
+        select(
+            StructuredAnswer.user_id,
+            day,
+            func.sum(StructuredAnswer.satisfaction_score),
+            func.count(StructuredAnswer.satisfaction_score),
+        )
+        .where(
+            StructuredAnswer.user_id.in_(user_ids),
+            StructuredAnswer.created_at >= since,
+            StructuredAnswer.satisfaction_score.is_not(None),
+        )
+        .group_by(StructuredAnswer.user_id, day)
+    )
+    return (await session.execute(stmt)).all()
+
+
+def rolling_average(sums: np.ndarray, counts: np.ndarray, window: int) -> np.ndarray:
+    """直近window日分の合計 / 件数 で移動平均を求める（回答のない日しかない区間はNaN）"""
+    cum_sums = np.concatenate(([0.0], np.cumsum(sums)))
+    cum_counts = np.concatenate(([0.0], np.cumsum(counts)))
+    idx = np.arange(len(sums))
+    lower = np.maximum(0, idx - window + 1)
+    window_sums = cum_sums[idx + 1] - cum_sums[lower]
+    window_counts = cum_counts[idx + 1] - cum_counts[lower]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(window_counts > 0, window_sums / window_counts, np.nan)
+
+
+def _series(days: list[date], sums: np.ndarray, counts: np.ndarray, window: int) -> list[dict]:
+    rolling = rolling_average(sums, counts, window)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        daily = np.where(counts > 0, sums / counts, np.nan)
+    return [
+        {
+            "date": d.isoformat(),
+            "daily_average": None if np.isnan(avg) else round(float(avg), 2),
+            "count": int(c),
+            "rolling_average": None if np.isnan(r) else round(float(r), 2),
+        }
+        for d, avg, c, r in zip(days, daily, counts, rolling)
+    ]
+
+
+async def satisfaction_trend(session: AsyncSession, user_ids: list[int], days: int, window: int) -> dict:
+    """
+    指定したユーザーごとの日別満足度と移動平均、および全員を合わせた推移を返す。
+    戻り値: {"users": {user_id: [...]}, "combined": [...]}
+    """
+    today = datetime.utcnow().date()
+    start = today - timedelta(days=days - 1)
+    day_list = [start + timedelta(days=i) for i in range(days)]
+    positions = {d: i for i, d in enumerate(day_list)}
+
+    sums = np.zeros((len(user_ids), days))
+    counts = np.zeros((len(user_ids), days))
+    rows_index = {uid: i for i, uid in enumerate(user_ids)}
+    rows = await fetch_daily_scores(session, user_ids, datetime.combine(start, datetime.min.time()))
+    for user_id, day, total, count in rows:
+        # MySQLはdate型、SQLiteは文字列で返るため揃える
+        day = day if isinstance(day, date) else date.fromisoformat(str(day))
+        pos = positions.get(day)
+        if pos is None:
+            continue
+        sums[rows_index[user_id], pos] = float(total or 0.0)
+        counts[rows_index[user_id], pos] = count
+
+    return {
+        "users": {
+            uid: _series(day_list, sums[i], counts[i], window)
+            for uid, i in rows_index.items()
+        },
+        "combined": _series(day_list, sums.sum(axis=0), counts.sum(axis=0), window),
+    }
@@ -0,0 +1,467 @@
+# 役割：個別のエンドポイント・夫婦ダッシュボード・夜間の事前計算（batch_precompute.py）で共有する処理
+# ダッシュボードは夫婦を1回だけ解決し、各セクションを別々のセッションで並行に取得する。
+# セクションごとにタイムアウトを持ち、間に合わなかったセクションは"timeout"として残りだけを返す（部分レスポンス）
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+import orjson
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud
+from db import AsyncSessionLocal, ReadSessionLocal
+from models import EmotionAlert, VectorSummary, DialogueAdvice, ReminderReport, StructuredAnswer
+from http_cache import make_validator, response_cache
+from metrics import Histogram
+from reminder_perser import extract_structured_data_reminder
+from structured_vector import build_structured_vector_store, search_all_predefined_queries, PREDEFINED_QUERIES
+from summarizer import summarize_multiple_docs, generate_couple_conversation_advice
+import telemetry
+from usage_ledger import billed_to, quota_exceeded, usage_ledger
+
+logger = logging.getLogger(__name__)
+
+NO_INFORMATION = "該当する情報がありません"
+# report_remindingで分析するパートナーのレポート数
+REMINDER_SUMMARY_COUNT = 3
+# fixed_allとdialogue_adviceが対象にする期間
+RECENT_DAYS = 4
+
+# ダッシュボードのセクションごとのタイムアウト（秒）。LLMを呼ぶ可能性があるセクションは長めにする
+DASHBOARD_DB_TIMEOUT = float(os.getenv("DASHBOARD_DB_TIMEOUT", "2.0"))
+DASHBOARD_LLM_TIMEOUT = float(os.getenv("DASHBOARD_LLM_TIMEOUT", "8.0"))
+DASHBOARD_REFLECTIONS_LIMIT = int(os.getenv("DASHBOARD_REFLECTIONS_LIMIT", "10"))
+
+dashboard_section_seconds = Histogram(
+    "dashboard_section_seconds", "ダッシュボードの各セクションの取得時間（秒）", ("section", "status")
+)
+
+
+# --- 感情アラート ---
+
+def emotion_alert_payload(alert: EmotionAlert) -> dict:
+    return {
+        "label": alert.label,
+        "emoji": alert.emoji,
+        "message": alert.message,
+        "score": alert.score,
+        "magnitude": alert.magnitude,
+        "created_at": alert.created_at.isoformat()
+    }
+
+
+async def latest_emotion_alert(session: AsyncSession, user_id: int):
+    return (await session.execute(
+        select(EmotionAlert)
+        .filter(EmotionAlert.user_id == user_id)
+        .order_by(EmotionAlert.created_at.desc())
+        .limit(1)
+    )).scalars().first()
+
+
+# --- リマインド（パートナーの直近レポートのGood/Bad） ---
+
+async def recent_summary_versions(session: AsyncSession, user_id: int, limit: int = REMINDER_SUMMARY_COUNT) -> list:
+    """直近のレポートのidと作成日時（リマインドの検証子に使う）"""
+    return (await session.execute(
+        select(VectorSummary.id, VectorSummary.created_at)
+        .filter(VectorSummary.user_id == user_id)
+        .order_by(VectorSummary.created_at.desc())
+        .limit(limit)
+    )).all()
+
+
+def reminder_validator(target_user_id: int, versions: list):
+    return make_validator("report_reminding", target_user_id, [row.id for row in versions],
+                          last_modified=versions[0].created_at if versions else None)
+
+
+async def build_reminder(session: AsyncSession, versions: list) -> dict:
+    """versionsのレポートをまとめてLLMで分析し、Goodthing_remindとBadthing_remindを返す"""
+    empty = {"Goodthing_remind": NO_INFORMATION, "Badthing_remind": NO_INFORMATION}
+    if not versions:
+        return empty
+    recent_summaries = (await session.execute(
+        select(VectorSummary)
+        .filter(VectorSummary.id.in_([row.id for row in versions]))
+        .order_by(VectorSummary.created_at.desc())
+    )).scalars().all()
+
+    # 有効な要約テキストを結合
+    combined_text = "\n\n".join([s.summary_text for s in recent_summaries if s.summary_text])
+    if not combined_text:
+        return empty
+
+    # 全レポートをまとめて分析
+    analysis_results = await asyncio.to_thread(extract_structured_data_reminder, combined_text)
+    return {
+        "Goodthing_remind": analysis_results.get("Goodthing_remind", NO_INFORMATION),
+        "Badthing_remind": analysis_results.get("Badthing_remind", NO_INFORMATION)
+    }
+
+
+async def stored_reminder(session: AsyncSession, target_user_id: int, etag: str = None):
+    """保存済みのリマインド（etagを指定しなければ検証子によらず最新のもの）。なければNone"""
+    query = select(ReminderReport.goodthing_remind, ReminderReport.badthing_remind).filter(
+        ReminderReport.user_id == target_user_id
+    )
+    if etag is not None:
+        query = query.filter(ReminderReport.input_etag == etag)
+    stored = (await session.execute(query.order_by(ReminderReport.id.desc()).limit(1))).first()
+    if not stored:
+        return None
+    return {"Goodthing_remind": stored.goodthing_remind, "Badthing_remind": stored.badthing_remind}
+
+
+async def reminder_quota_fallback(session: AsyncSession, viewer, target_user_id: int, etag: str) -> tuple:
+    """
+    (利用上限により生成を控えるか, 代わりに返す保存済みの最新のリマインド) を返す。
+    viewerが上限を超えていても、同じ検証子のリマインドがキャッシュかDBにあれば生成は不要なので控えない。
+    """
+    if not await usage_ledger.over_quota(viewer.user_id, viewer.couple_id):
+        return False, None
+    if response_cache.get(etag) is not None or await stored_reminder(session, target_user_id, etag) is not None:
+        return False, None
+    return True, await stored_reminder(session, target_user_id)
+
+
+async def reminder_for(session: AsyncSession, target_user_id: int, versions: list, etag: str) -> dict:
+    """
+    保存済みのリマインド（夜間の事前計算や他のワーカーが作ったもの）が同じ検証子であればそれを返し、
+    なければLLMで分析して保存する。sessionは読み取り専用でもよい（保存は書き込み用のセッションで行う）。
+    """
+    stored = await stored_reminder(session, target_user_id, etag)
+    if stored:
+        return stored
+
+    result = await build_reminder(session, versions)
+    if versions:
+        async with AsyncSessionLocal() as write_session:
+            write_session.add(ReminderReport(
+                user_id=target_user_id,
+                input_etag=etag,
+                goodthing_remind=result["Goodthing_remind"],
+                badthing_remind=result["Badthing_remind"],
+            ))
+            await write_session.commit()
+    return result
+
+
+async def reminder_in_own_session(target_user_id: int, versions: list, etag: str) -> dict:
+    """
+    レスポンスキャッシュ（response_cache）の作成処理から呼ぶreminder_for。
+    作成処理は最初のリクエストが切断されても続くため、リクエストのセッションではなく専用のセッションを使う
+    """
+    async with ReadSessionLocal() as session:
+        return await reminder_for(session, target_user_id, versions, etag)
+
+
+async def cached_reminder(session: AsyncSession, viewer, target_user_id: int) -> tuple:
+    """
+    viewerに見せる(リマインド, 元レポートの最新作成日時) を返す。LLMの利用はviewerに計上する。
+    /report_remindingと同じ検証子でレスポンスキャッシュを共有するため、同じレポートに対してLLMは1回しか呼ばない。
+    viewerが利用上限を超えていれば生成せずに保存済みの最新のリマインド（なければNone）を返す。
+    """
+    versions = await recent_summary_versions(session, target_user_id)
+    validator = reminder_validator(target_user_id, versions)
+    degraded, fallback = await reminder_quota_fallback(session, viewer, target_user_id, validator.etag)
+    if degraded:
+        quota_exceeded.inc(route=telemetry.current_route.get())
+        return fallback, None
+    with billed_to(viewer.user_id, viewer.couple_id):
+        body, _ = await response_cache.get_or_create(
+            validator.etag, lambda: reminder_in_own_session(target_user_id, versions, validator.etag)
+        )
+    return orjson.loads(body), validator.last_modified
+
+
+# --- ベクトル要約（fixed_all） ---
+
+async def stored_vector_summaries(session: AsyncSession, target_user_id: int, etag: str):
+    """同じ入力（検証子）で保存済みの全クエリ分の要約。揃っていなければNone"""
+    rows = (await session.execute(
+        select(VectorSummary.query_key, VectorSummary.summary_text)
+        .filter(VectorSummary.user_id == target_user_id, VectorSummary.input_etag == etag)
+        .order_by(VectorSummary.id.desc())
+    )).all()
+    latest = {}
+    for row in rows:
+        latest.setdefault(row.query_key, row.summary_text)
+    if set(latest) != set(PREDEFINED_QUERIES):
+        return None
+    # 保存済みの要約は検索結果の原文を残していないため、merged_documentsはNoneにする
+    return [{"query_key": key, "merged_documents": None, "summay_text": latest[key]} for key in PREDEFINED_QUERIES]
+
+
+async def compute_vector_summaries(session: AsyncSession, target_user_id: int) -> tuple:
+    """
+    直近RECENT_DAYS日分の構造化データをベクトル検索し、PREDEFINED_QUERIESごとに要約して保存する。
+    (要約のリスト, 新しく作成したかどうか) を返し、構造化データがなければ(None, False)を返す。
+    構造化データのidの一覧が前回と同じなら（夜間の事前計算で作成済みなど）、保存済みの要約をそのまま返して行を追加しない
+    （要約の行が増えるとリマインド・対話アドバイスの検証子が変わり、作成済みの結果を使えなくなるため）。
+    """
+    cutoff_date = datetime.utcnow() - timedelta(days=RECENT_DAYS)
+    # JSON列の構造化データだけを取得する（JSON型なのでそのまま辞書として読み込まれる）
+    rows = (await session.execute(
+        select(StructuredAnswer.id, StructuredAnswer.answer_summary)
+        .filter(StructuredAnswer.user_id == target_user_id)
+        .filter(StructuredAnswer.created_at >= cutoff_date)
+        .order_by(StructuredAnswer.id)
+    )).all()
+    if not rows:
+        return None, False
+    etag = make_validator("vector_summaries", target_user_id, [row.id for row in rows]).etag
+    stored = await stored_vector_summaries(session, target_user_id, etag)
+    if stored is not None:
+        return stored, False
+    structured_data_list = [row.answer_summary for row in rows]
+
+    # ベクトルストアを構築（埋め込みAPIの呼び出しを含むためスレッドで実行）
+    vector_store = await asyncio.to_thread(build_structured_vector_store, structured_data_list)
+
+    # 全クエリ一括検索
+    all_results = await asyncio.to_thread(search_all_predefined_queries, vector_store, 3)
+
+    saved_summaries =[]
+    for query_key, doc_texts in all_results.items():
+        #doc_textsは要約前のベクトルストアから検索したn件のテキスト
+        #これを1つの文字列にまとめる
+        merged_text = "\n\n".join(doc_texts)
+
+        #LLMに要約
+        summary_text = await summarize_multiple_docs([merged_text])
+
+        #DBに保存
+        session.add(VectorSummary(
+            user_id=target_user_id,
+            query_key = query_key,
+            summary_text=summary_text,
+            input_etag=etag
+        ))
+        saved_summaries.append({
+            "query_key": query_key,
+            "merged_documents": merged_text,
+            "summay_text": summary_text
+        })
+    await session.commit()
+    return saved_summaries, True
+
+
+# --- 対話アドバイス ---
+
+async def _summary_versions_since(session: AsyncSession, user_id: int, cutoff: datetime) -> list:
+    return (await session.execute(
+        select(VectorSummary.id, VectorSummary.created_at)
+        .filter(VectorSummary.user_id == user_id)
+        .filter(VectorSummary.created_at >= cutoff)
+        .order_by(VectorSummary.id)
+    )).all()
+
+
+async def dialogue_advice_inputs(session: AsyncSession, user, partner) -> tuple:
+    """
+    アドバイスの入力（直近の要約のidとプロフィール）と、それから作った検証子を返す。
+    戻り値: (validator, ユーザーの要約のidと作成日時, パートナーの要約のidと作成日時)
+    """
+    cutoff_date = datetime.utcnow() - timedelta(days=RECENT_DAYS)
+    user_versions = await _summary_versions_since(session, user.user_id, cutoff_date)
+    partner_versions = await _summary_versions_since(session, partner.user_id, cutoff_date) if partner else []
+    timestamps = [row.created_at for row in user_versions + partner_versions if row.created_at]
+    validator = make_validator(
+        "dialogue_advice", user.user_id,
+        [row.id for row in user_versions], [row.id for row in partner_versions],
+        user.personality, partner.personality if partner else "不明",
+        user.name, partner.name if partner else "不明",
+        last_modified=max(timestamps) if timestamps else None,
+    )
+    return validator, user_versions, partner_versions
+
+
+async def _summary_blocks(session: AsyncSession, versions: list) -> list:
+    if not versions:
+        return []
+    summaries = (await session.execute(
+        select(VectorSummary).filter(VectorSummary.id.in_([row.id for row in versions]))
+    )).scalars().all()
+    return [{"query_key": s.query_key, "summay_text": s.summary_text} for s in summaries]
+
+
+async def stored_dialogue_advice(session: AsyncSession, user_id: int, etag: str):
+    """同じ入力（検証子）で保存済みの対話アドバイスの本文。なければNone"""
+    return (await session.execute(
+        select(DialogueAdvice.advice_text)
+        .filter(DialogueAdvice.user_id == user_id, DialogueAdvice.input_etag == etag)
+        .order_by(DialogueAdvice.created_at.desc())
+        .limit(1)
+    )).scalar()
+
+
+async def dialogue_advice(session: AsyncSession, user, partner, inputs: tuple) -> tuple:
+    """
+    (アドバイス, 新しく生成したかどうか) を返す。
+    同じ入力のアドバイスが保存済み（夜間の事前計算など）であればLLMを呼ばずにそれを返す。sessionは書き込み用。
+    """
+    validator, user_versions, partner_versions = inputs
+    stored = await stored_dialogue_advice(session, user.user_id, validator.etag)
+    if stored is not None:
+        return {"advice": stored}, False
+
+    # 対話アドバイスを生成
+    advice_text = await generate_couple_conversation_advice(
+        user_summary_blocks=await _summary_blocks(session, user_versions),
+        partner_summary_blocks=await _summary_blocks(session, partner_versions),
+        user_mbti=user.personality,
+        partner_mbti=partner.personality if partner else "不明",
+        user_name=user.name,
+        partner_name=partner.name if partner else "不明"
+    )
+    logger.debug(f"対話アドバイスのLLM出力: {advice_text}")
+    # 対話アドバイスをDBに保存
+    session.add(DialogueAdvice(
+        couple_id = user.couple_id,
+        user_id = user.user_id,
+        advice_text=advice_text,
+        input_etag=validator.etag
+    ))
+    await session.commit()
+    return {"advice": advice_text}, True
+
+
+# --- 対話アドバイス・要約 ---
+
+async def latest_dialogue_advice(session: AsyncSession, user_id: int):
+    """保存済みの最新の対話アドバイス（ここでは生成しない）"""
+    advice = (await session.execute(
+        select(DialogueAdvice.advice_text, DialogueAdvice.created_at)
+        .filter(DialogueAdvice.user_id == user_id)
+        .order_by(DialogueAdvice.created_at.desc())
+        .limit(1)
+    )).first()
+    if not advice:
+        return None
+    return {"advice": advice.advice_text, "created_at": advice.created_at}
+
+
+async def latest_vector_summaries(session: AsyncSession, user_id: int) -> list:
+    """直近のfixed_allで保存された要約（クエリ数ぶんの最新行）"""
+    rows = (await session.execute(
+        select(VectorSummary.query_key, VectorSummary.summary_text, VectorSummary.created_at)
+        .filter(VectorSummary.user_id == user_id)
+        .order_by(VectorSummary.created_at.desc())
+        .limit(len(PREDEFINED_QUERIES))
+    )).all()
+    return [{"query_key": row.query_key, "summay_text": row.summary_text, "created_at": row.created_at}
+            for row in rows]
+
+
+# --- 夫婦ダッシュボード ---
+
+async def _with_session(func, *args):
+    # AsyncSessionは並行して使えないため、セクションごとに読み取り用のセッションを開く
+    async with ReadSessionLocal() as session:
+        return await func(session, *args)
+
+
+def _latest(timestamps) -> datetime:
+    timestamps = [ts for ts in timestamps if ts is not None]
+    return max(timestamps) if timestamps else None
+
+
+async def _emotion_alerts_section(members: list) -> tuple:
+    alerts = await asyncio.gather(*(_with_session(latest_emotion_alert, m.user_id) for m in members))
+    data = {str(m.user_id): emotion_alert_payload(a) if a else None for m, a in zip(members, alerts)}
+    return data, _latest(a.created_at for a in alerts if a)
+
+
+async def _reminders_section(members: list) -> tuple:
+    # 各メンバーには、相手のレポートから作ったリマインドを返す（/report_remindingと同じ）
+    targets = [(m, next((p for p in members if p.user_id != m.user_id), None)) for m in members]
+    results = await asyncio.gather(*(
+        _with_session(cached_reminder, member, partner.user_id) for member, partner in targets if partner
+    ))
+    data, timestamps = {}, []
+    found = iter(results)
+    for member, partner in targets:
+        if partner is None:
+            data[str(member.user_id)] = None
+            continue
+        reminder, updated_at = next(found)
+        data[str(member.user_id)] = reminder
+        timestamps.append(updated_at)
+    return data, _latest(timestamps)
+
+
+async def _dialogue_advice_section(members: list) -> tuple:
+    advices = await asyncio.gather(*(_with_session(latest_dialogue_advice, m.user_id) for m in members))
+    data = {str(m.user_id): advice for m, advice in zip(members, advices)}
+    return data, _latest(a["created_at"] for a in advices if a)
+
+
+async def _reflections_section(members: list) -> tuple:
+    lists = await asyncio.gather(*(
+        _with_session(crud.list_reflections, m.user_id, DASHBOARD_REFLECTIONS_LIMIT) for m in members
+    ))
+    data = {str(m.user_id): rows for m, rows in zip(members, lists)}
+    return data, _latest(row.created_at for rows in lists for row in rows)
+
+
+async def _vector_summaries_section(members: list) -> tuple:
+    lists = await asyncio.gather(*(_with_session(latest_vector_summaries, m.user_id) for m in members))
+    data = {str(m.user_id): rows for m, rows in zip(members, lists)}
+    return data, _latest(row["created_at"] for rows in lists for row in rows)
+
+
+# (セクション名, 取得関数, タイムアウト, タイムアウト後も処理を続けるか)
+# リマインドはタイムアウトしてもLLMの結果をキャッシュに残し、次回の表示で返せるようにする
+DASHBOARD_SECTIONS = (
+    ("emotion_alerts", _emotion_alerts_section, DASHBOARD_DB_TIMEOUT, False),
+    ("reminders", _reminders_section, DASHBOARD_LLM_TIMEOUT, True),
+    ("dialogue_advice", _dialogue_advice_section, DASHBOARD_DB_TIMEOUT, False),
+    ("reflections", _reflections_section, DASHBOARD_DB_TIMEOUT, False),
+    ("vector_summaries", _vector_summaries_section, DASHBOARD_DB_TIMEOUT, False),
+)
+
+
+def _consume_result(task: asyncio.Task) -> None:
+    # 待つのをやめたタスクの例外が「取得されなかった」警告にならないようにする
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"[dashboard] バックグラウンドで続けたセクションが失敗: {task.exception()}")
+
+
+async def _run_section(name: str, fetch, members: list, timeout: float, keep_running: bool) -> dict:
+    started = time.perf_counter()
+    task = asyncio.create_task(fetch(members))
+    if keep_running:
+        task.add_done_callback(_consume_result)
+    status, data, updated_at = "ok", None, None
+    try:
+        data, updated_at = await asyncio.wait_for(asyncio.shield(task) if keep_running else task, timeout)
+    except asyncio.TimeoutError:
+        status = "timeout"
+    except Exception:
+        logger.exception(f"[dashboard] セクションの取得に失敗: {name}")
+        status = "error"
+    dashboard_section_seconds.observe(time.perf_counter() - started, section=name, status=status)
+    return {
+        "status": status,
+        "data": data,
+        # セクションの元データのうち最も新しい行の作成日時
+        "updated_at": updated_at,
+    }
+
+
+async def couple_dashboard(couple_id: str, members: list, timeout_scale: float = 1.0) -> dict:
+    """夫婦のダッシュボードの全セクションを並行に取得する。timeout_scaleで各セクションのタイムアウトを伸縮できる"""
+    results = await asyncio.gather(*(
+        _run_section(name, fetch, members, timeout * timeout_scale, keep_running)
+        for name, fetch, timeout, keep_running in DASHBOARD_SECTIONS
+    ))
+    sections = {name: result for (name, *_), result in zip(DASHBOARD_SECTIONS, results)}
+    return {
+        "couple_id": couple_id,
+        "members": [{"user_id": m.user_id, "name": m.name} for m in members],
+        "generated_at": datetime.utcnow(),
+        "partial": any(section["status"] != "ok" for section in sections.values()),
+        "sections": sections,
+    }
@@ -1,58 +1,106 @@
 ### structured_parser.py ###
-from langchain.output_parsers import StructuredOutputParser , ResponseSchema
 import logging
 import json
-from conversation_chain import llm
+import re
+from functools import lru_cache
+from conversation_chain import get_llm, QUESTION_LIST
+from telemetry import stage
+from token_budget import fit
 
 logger = logging.getLogger(__name__)
 
-# 各質問に対応する情報を抽出するためのスキーマ定義
-response_schemas = [
-    ResponseSchema(
-        name="satisfaction_score", 
-        description="今日の満足度を10点満点中で数値のみ抽出してください。"
-    ),
-    ResponseSchema(
-        name="satisfaction_context", 
-        description="今日の満足度に影響した具体的な状況や背景を説明してください。"
-    ),
-    ResponseSchema(
-        name="positive_events", 
-        description="パートナーとの関係で嬉しかった出来事の概要を記述してください。"
-    ),
-    ResponseSchema(
-        name="hidden_thoughts", 
-        description="パートナーに伝えにくかった本音や、言えなかったことを記述してください。"
-    ),
-    ResponseSchema(
-        name="next_week_improvement", 
-        description="来週の満足度を上げるための改善アイデアを記述してください。"
-    ),
-    ResponseSchema(
-        name="theme", 
-        description="最近話すべきだと感じたテーマや気がかりなことを記述してください。"
-    )
+# 各質問に対応する情報を抽出するためのスキーマ定義（フィールド名, 説明）
+RESPONSE_SCHEMAS = [
+    ("satisfaction_score", "今日の満足度を10点満点中で数値のみ抽出してください。"),
+    ("satisfaction_context", "今日の満足度に影響した具体的な状況や背景を説明してください。"),
+    ("positive_events", "パートナーとの関係で嬉しかった出来事の概要を記述してください。"),
+    ("hidden_thoughts", "パートナーに伝えにくかった本音や、言えなかったことを記述してください。"),
+    ("next_week_improvement", "来週の満足度を上げるための改善アイデアを記述してください。"),
+    ("theme", "最近話すべきだと感じたテーマや気がかりなことを記述してください。"),
+]
+
+
+@lru_cache(maxsize=None)
+def output_parser():
+    """
+    StructuredOutputParserを生成する。
+    LangChainは初回呼び出し時に読み込み、生成したパーサーは使い回す。
+    """
+    from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+    schemas = [ResponseSchema(name=name, description=description) for name, description in RESPONSE_SCHEMAS]
+    return StructuredOutputParser.from_response_schemas(schemas)
+
+# 質問の番号（conversation_chain.QUESTIONSの順、1始まり）と、その回答から抽出するフィールド
+QUESTION_FIELDS = {
+    1: ("satisfaction_score", "satisfaction_context"),
+    2: ("hidden_thoughts",),
+    3: ("theme",),
+    4: ("positive_events",),
+    5: ("next_week_improvement",),
+}
+
+# 1ラウンド分の回答から抽出する項目（どの質問への回答かと、その質問に対する回答だけ）
+ROUND_SCHEMAS = [
+    ("question_number", "コーチの発言がどの質問（その質問の深掘りを含む）についてのものか、質問の番号（1〜5）を数値のみで記述してください。"),
+    ("answer", "その質問に対するユーザーの回答内容を記述してください。スキップなどで回答していない場合は空文字にしてください。"),
+    ("satisfaction_score", "質問1の場合のみ、回答に含まれる今日の満足度を10点満点中で数値のみ抽出してください。含まれない場合は空文字にしてください。"),
 ]
 
-# StructuredOutputParserの初期化
-parser = StructuredOutputParser.from_response_schemas(response_schemas)
-output_format = parser.get_format_instructions()
+
+@lru_cache(maxsize=None)
+def round_output_parser():
+    """1ラウンド分の抽出（extract_round_answer）に使うStructuredOutputParser"""
+    from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+    schemas = [ResponseSchema(name=name, description=description) for name, description in ROUND_SCHEMAS]
+    return StructuredOutputParser.from_response_schemas(schemas)
+
+# 会話履歴がトークン予算を超えた場合の要約の指示（抽出する回答内容を残す）
+CONDENSE_INSTRUCTION = (
+    "「コーチ:」「ユーザー:」の話者ラベルを保ったまま、ユーザーの回答内容"
+    "（満足度の点数、嬉しかった出来事、言えなかった本音、話したいテーマ、改善のアイデア）を省略せずに要約してください。"
+)
+
+# 全フィールド名（スキーマ定義順）
+FIELD_NAMES = [name for name, _ in RESPONSE_SCHEMAS]
+
+def parse_satisfaction_score(value) -> float:
+    """
+    抽出した満足度（"7"、"7点"、"10点満点中6点"など）を数値に変換する。
+    数値が読み取れない場合はNoneを返す。
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        score = float(value)
+    else:
+        text = str(value)
+        # 「10点満点中」の10を満足度として拾わないよう取り除く
+        text = re.sub(r"10\s*点\s*満点\s*中?", "", text)
+        match = re.search(r"\d+(?:\.\d+)?", text)
+        if not match:
+            return None
+        score = float(match.group())
+    return score if 0 <= score <= 10 else None
 
 def extract_structured_data(chat_history: str) -> dict:
     """
     チャット履歴から各質問に対するユーザーからの回答内容を抽出し、構造化データ（json）として返します。
     
     """
+    parser = output_parser()
+    # 長いセッションはトークン予算に収まるよう先に要約する
+    chat_history = fit(chat_history, "structured_extraction", CONDENSE_INSTRUCTION)
     prompt = (
         "以下のチャット履歴から、各質問に対するユーザーからの回答内容を抽出してください。"
         "出力は次のJSON形式に従ってください。\n\n"
-        f"{output_format}\n\n"
+        f"{parser.get_format_instructions()}\n\n"
         f"チャット履歴:\n{chat_history}"
     )
 
     try:
         # LLMからの出力を取得
-        llm_output = llm.invoke(prompt)
+        with stage("llm", "structured_extraction"):
+            llm_output = get_llm().invoke(prompt)
         # もし戻り値が AIMessage オブジェクトであれば、.content を取り出す
         if hasattr(llm_output,"content"):
             llm_output=llm_output.content
@@ -63,4 +111,49 @@ def extract_structured_data(chat_history: str) -> dict:
         logger.error(f"Error during parsing structured data: {e}")
         structured_data = {}
 
-    return structured_data
\ No newline at end of file
+    return structured_data
+
+def extract_round_answer(question: str, answer: str):
+    """
+    1ラウンド分のコーチの発言とユーザーの回答から、どの質問への回答かを判定し、
+    その質問に対応するフィールド（QUESTION_FIELDS）だけを抽出して (質問の番号, {フィールド名: 値}) を返します。
+    質問の判定はコーチの言い回しではなく発言の内容からLLMが行います（深掘り・言い換えも元の質問に対応づける）。
+    対話中に回答が届くたびに呼び出し、構造化データを少しずつ埋めるために使用します。
+    抽出に失敗した場合と質問の番号が読み取れない場合はNoneを返します。
+    """
+    parser = round_output_parser()
+    prompt = (
+        "コーチは次の5つの質問を順番に行い、回答が十分でない場合は同じ質問について深掘りします。\n\n"
+        f"{QUESTION_LIST.replace('{partner_name}', 'パートナー')}\n\n"
+        "以下のコーチの発言がどの質問についてのものかを判定し、その質問に対するユーザーの回答内容を抽出してください。"
+        "回答に含まれない内容は推測しないでください。"
+        "出力は次のJSON形式に従ってください。\n\n"
+        f"{parser.get_format_instructions()}\n\n"
+        f"コーチ: {question}\n"
+        f"ユーザー: {answer}"
+    )
+
+    try:
+        with stage("llm", "structured_extraction"):
+            llm_output = get_llm().invoke(prompt)
+        if hasattr(llm_output,"content"):
+            llm_output=llm_output.content
+        logger.debug(f"LLM output:{llm_output}")
+        parsed = parser.parse(llm_output)
+        match = re.search(r"[1-5]", str(parsed.get("question_number", "")))
+        if not match:
+            raise ValueError(f"質問の番号を読み取れません: {parsed.get('question_number')}")
+    except Exception as e:
+        logger.error(f"Error during parsing round answer: {e}")
+        return None
+
+    question_number = int(match.group())
+    text = str(parsed.get("answer") or "").strip()
+    if question_number == 1:
+        fields = {
+            "satisfaction_score": str(parsed.get("satisfaction_score") or "").strip(),
+            "satisfaction_context": text,
+        }
+    else:
+        fields = {QUESTION_FIELDS[question_number][0]: text}
+    return question_number, fields
@@ -1,8 +1,12 @@
 # ベクトルストアの生成とクエリのベクトルストアへの検索を定義
-from langchain_community.embeddings import OpenAIEmbeddings
-from langchain.docstore.document import Document
-from langchain_community.vectorstores import FAISS
+# FAISSと埋め込みモデル（langchain_community）は読み込みが重いため、初回のベクトルストア生成時にimportする
 import json
+import os
+from functools import lru_cache
+from telemetry import stage
+
+# "fake"の場合はOpenAIの埋め込みAPIを呼ばず、fake_backendsの決定的なベクトルを使う
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "openai")
 
 # 下記のクエリでベクトルストアを検索する
 PREDEFINED_QUERIES = {
@@ -11,18 +15,31 @@ PREDEFINED_QUERIES = {
     "夫婦で話し合いたいこと": "夫婦で話し合いたいと思っていること",
 }
 
+@lru_cache(maxsize=None)
+def get_embeddings():
+    """埋め込みモデル（初回呼び出し時に生成し、以降は使い回す）"""
+    if EMBEDDINGS_BACKEND == "fake":
+        from fake_backends import FakeEmbeddings
+        return FakeEmbeddings()
+    from langchain_community.embeddings import OpenAIEmbeddings
+    return OpenAIEmbeddings()
+
 # JSONの各フィールドを別々のDocumentにして格納
 def build_structured_vector_store(structured_data_list:list[dict]):
     """
     構造化データのリストを受け取り、FAISSベクトルストアを生成して返す。
     """
+    from langchain.docstore.document import Document
+    from langchain_community.vectorstores import FAISS
+
     documents = [
         Document(page_content=json.dumps(item, ensure_ascii=False))
         for item in structured_data_list
     ]
 
-    embeddings = OpenAIEmbeddings()
-    vector_store = FAISS.from_documents(documents,embeddings)
+    embeddings = get_embeddings()
+    with stage("embeddings", "vector_store"):
+        vector_store = FAISS.from_documents(documents,embeddings)
     return vector_store
 
 
@@ -35,7 +52,9 @@ def search_all_predefined_queries(vector_store, k=3):
     """
     results = {}
     for query_key, query_text in PREDEFINED_QUERIES.items():
-        docs = vector_store.similarity_search(query_text, k=k)
+        # クエリの埋め込みも含めた検索時間を記録する
+        with stage("vector_search", query_key):
+            docs = vector_store.similarity_search(query_text, k=k)
         # page_contentだけ取り出しておく
         results[query_key] = [doc.page_content for doc in docs]
     return results
@@ -1,25 +1,40 @@
 ### summarizer.py ###
 # ユーザーから送信された回答をGPTのモデルを使用して要約するための処理を実装
-import openai
 from dotenv import load_dotenv # type: ignore
 import os
 import asyncio
+from functools import lru_cache
 from dotenv import load_dotenv
+from conversation_chain import LLM_BACKEND
+from telemetry import record_openai_usage, stage
+from token_budget import afit, budget_for
 
 # 環境変数の読み込み
 load_dotenv() 
-# OpenAIクライアントのインスタンスを作成
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
-async def gpt4o_mini_call(prompt: str, system_prompt:str=None) -> str:
+@lru_cache(maxsize=None)
+def get_openai():
+    """openaiモジュールを返す（読み込みが重いため初回呼び出し時にimportし、APIキーを設定する）"""
+    if LLM_BACKEND == "fake":
+        from fake_backends import fake_openai
+        return fake_openai
+    import openai
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    return openai
+
+async def gpt4o_mini_call(prompt: str, system_prompt:str=None, site: str = "summary") -> str:
+    """siteは呼び出しの用途（メトリクスのラベル。要約はsummary、対話アドバイスはadvice）"""
     try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system","content":system_prompt},
-                {"role": "user","content":  prompt}
-            ]
-        )
+        openai = get_openai()
+        with stage("llm", site):
+            response = await openai.ChatCompletion.acreate(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system","content":system_prompt},
+                    {"role": "user","content":  prompt}
+                ]
+            )
+        record_openai_usage(response, site)
         return response.choices[0].message.content.strip()
     except Exception as e:
         return f"Effor:{e}"
@@ -27,7 +42,8 @@ async def gpt4o_mini_call(prompt: str, system_prompt:str=None) -> str:
 # 複数のドキュメントを結合して要約する
 async def summarize_multiple_docs(doc_texts:list[str]) -> str:
     """複数のドキュメントテキストを結合してまとめて要約する簡易関数"""
-    combined_text = "\n\n".join(doc_texts)
+    # 検索結果が多い・長い場合はトークン予算に収まるよう分割して要約してからまとめる
+    combined_text = await afit("\n\n".join(doc_texts), "summary", "夫婦関係に関する出来事や気持ちを具体的に残して要約してください。")
     prompt = f"以下の複数テキストをまとめて要約してください:\n{combined_text}"
     system_prompt = """
     このGPTは、夫婦関係コーチングを専門とするコーチとして機能し、ユーザーの1週間の振り返り内容をもとに、パートナーへ向けた簡潔な報告を第三者の視点で作成します。ユーザー自身ではなく、あくまでコーチとして客観的に状況を共有する形で表現します。
@@ -60,8 +76,12 @@ async def generate_couple_conversation_advice(
              f"{name}の「{b['query_key']}」に関する要約:\n{b['summay_text']}"
              for b in blocks
          )
-     user_text = format_block(user_summary_blocks,"ユーザー")
-     partner_text = format_block(partner_summary_blocks,"パートナー")
+     # 夫婦それぞれの要約が予算の半分ずつに収まるようにする
+     instruction = "「〜に関する要約」の見出しごとに、要点を残して短くしてください。"
+     user_text, partner_text = await asyncio.gather(
+         afit(format_block(user_summary_blocks,"ユーザー"), "advice", instruction, budget_for("advice") // 2),
+         afit(format_block(partner_summary_blocks,"パートナー"), "advice", instruction, budget_for("advice") // 2),
+     )
 
      prompt = (
          "あなたはMBTI（性格タイプ）にも精通した夫婦向けコーチです。\n"
@@ -86,7 +106,7 @@ async def generate_couple_conversation_advice(
      アドバイスは夫婦どちらに対しても平等にアドバイスをし、どちらに対してのアドバイスかわかるように主語を明確に名前で呼ぶ
      日本語で対応し、丁寧で安心感のあるトーンを保つ。必要に応じて、感情的負担が軽減されるようなリフレーミングや気持ちの整理のサポートも行う。
      """
-     return await gpt4o_mini_call(prompt, system_prompt)
+     return await gpt4o_mini_call(prompt, system_prompt, site="advice")
 
 # 受け取った回答テキストに対して要約プロンプトを生成し、APIを呼び出して要約結果を返す
 # 複数のデータに分割してDBに格納する
@@ -2,23 +2,25 @@
 # RAGを用いて蓄積された回答の要約情報からレポートとアドバイスを生成する処理
 # DBから取得した各回答の要約をDocumentに変換し、FAISSを利用してベクトル化、検索できるようにしている（ベクトルストアを作成）
 # LangchainのRetrivalQAチェーンを使ってレポート＋アドバイスの生成を行う=>ベクトルストアとチェーンを組み合わせることでより関連性の高い情報を参照しながら生成する仕組み
+# LangChain・FAISSは読み込みが重いため、関数の呼び出し時にimportする
 import asyncio
 from typing import Tuple
-from langchain.docstore.document import Document
-from langchain_community.embeddings import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.chains import RetrievalQA
-from gpt4omini_llm import GPT4oMiniLLM
 
 async def generate_report_with_rag(answers: list) -> Tuple[str, str, str]:
     """
     answers: DBから取得したAnswerオブジェクトのリスト。各オブジェクトは .summary を持つとする。
     """
+    from langchain.docstore.document import Document
+    from langchain_community.vectorstores import FAISS
+    from langchain.chains import RetrievalQA
+    from gpt4omini_llm import GPT4oMiniLLM
+    from structured_vector import get_embeddings
+
     # DBから取得した各回答の要約をDocumentリストへ変換
     docs = [Document(page_content=ans.summary) for ans in answers]
     
     # 埋め込みモデルの初期化
-    embeddings = OpenAIEmbeddings()  
+    embeddings = get_embeddings()
     
     # FAISSベクトルストアの構築
     vector_store = FAISS.from_documents(docs, embeddings)
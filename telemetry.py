@@ -0,0 +1,115 @@
+# リクエスト・処理段階ごとのレイテンシと、OpenAIのトークン数の計測
+# ルートごとのレイテンシはRequestMetricsMiddlewareで、DB・LLM・埋め込み・NLP・ベクトル検索の所要時間はstage()で記録する。
+# LLMを呼ぶ処理はstage("llm", 呼び出し元)で囲み、その間に発生したトークン数を呼び出し元ごとに数える
+# （LangChain経由の呼び出しはllm_callbacks.TokenUsageHandler、openaiの直接呼び出しはrecord_openai_usageで集計する）
+# 集計結果は/metricsでPrometheusのテキスト形式として出力する
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from metrics import Counter, Gauge, Histogram
+
+# 処理段階（stageのラベル）と、そのうち外部サービスを呼ぶもの
+STAGES = ("db", "llm", "embeddings", "nlp", "vector_search")
+EXTERNAL_STAGES = ("llm", "embeddings", "nlp")
+# レイテンシを記録しないルート（長時間接続するSSEは接続数のゲージで見る）
+UNTRACKED_ROUTES = ("/events/stream",)
+
+request_seconds = Histogram("http_request_seconds", "ルートごとのリクエストの処理時間（秒）", ("method", "route", "status"))
+requests_in_flight = Gauge("http_requests_in_flight", "処理中のリクエスト数")
+stage_seconds = Histogram(
+    "stage_seconds", "処理段階ごとの所要時間（秒）。siteはLLMなどでは用途、DBではルート", ("stage", "site")
+)
+external_calls_in_flight = Gauge("external_calls_in_flight", "実行中の外部呼び出し（LLM・埋め込み・NLP）の数", ("stage",))
+llm_tokens = Counter("llm_tokens_total", "OpenAIのトークン数", ("site", "kind"))
+live_sessions = Gauge("chat_live_sessions", "メモリ上に保持している対話セッション数")
+
+# 処理中のリクエストのルート（DBのクエリ時間をルートごとに集計するため）
+current_route = ContextVar("current_route", default="background")
+# 実行中のLLM呼び出しの用途（chat・structured_extraction・mentions・reminder・summary・advice）
+current_site = ContextVar("current_llm_site", default="unknown")
+# トークン数を記録するたびに呼ぶ関数 (site, prompt_tokens, completion_tokens)（usage_ledgerが登録する）
+token_listeners = []
+
+
+@contextmanager
+def stage(name: str, site: str = None):
+    """
+    withブロックの所要時間を処理段階nameとして記録する。
+    siteを指定した場合はブロック内の呼び出し元として設定し、トークン数の集計にも使う。
+    """
+    token = current_site.set(site) if site is not None else None
+    external = name in EXTERNAL_STAGES
+    if external:
+        external_calls_in_flight.inc(stage=name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=name, site=site or current_route.get())
+        if external:
+            external_calls_in_flight.dec(stage=name)
+        if token is not None:
+            current_site.reset(token)
+
+
+def record_tokens(prompt_tokens: int, completion_tokens: int, site: str = None) -> None:
+    site = site or current_site.get()
+    if prompt_tokens:
+        llm_tokens.inc(prompt_tokens, site=site, kind="prompt")
+    if completion_tokens:
+        llm_tokens.inc(completion_tokens, site=site, kind="completion")
+    for listener in token_listeners:
+        listener(site, prompt_tokens, completion_tokens)
+
+
+def record_openai_usage(response, site: str = None) -> None:
+    """openai.ChatCompletionの応答のusageからトークン数を記録する"""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record_tokens(getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0, site)
+
+
+def route_template(scope) -> str:
+    """リクエストに一致するルートのパス（/couple/{couple_id}/dashboardなど、ラベルの種類が増えない形）"""
+    from starlette.routing import Match
+
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """ルートごとのレイテンシと処理中のリクエスト数を記録するASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = route_template(scope)
+        if route in UNTRACKED_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        token = current_route.set(route)
+        requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_seconds.observe(time.perf_counter() - started, method=scope["method"], route=route,
+                                    status=status["code"])
+            requests_in_flight.dec()
+            current_route.reset(token)
@@ -0,0 +1,56 @@
+# AnswerWriteBuffer.flush の再試行とデッドレターのテスト
+import asyncio
+from sqlalchemy.exc import IntegrityError, OperationalError
+import answer_buffer
+from answer_buffer import AnswerWriteBuffer
+
+
+def make_buffer(monkeypatch, fail):
+    """fail(rows) が例外を返した書き込みは失敗させ、成功した行をwrittenに記録する"""
+    written = []
+
+    async def write(rows):
+        error = fail(rows)
+        if error:
+            raise error
+        written.extend(rows)
+
+    buffer = AnswerWriteBuffer()
+    monkeypatch.setattr(buffer, "_write", write)
+    return buffer, written
+
+
+def test_bad_row_is_dead_lettered_without_blocking_others(monkeypatch):
+    monkeypatch.setattr(answer_buffer, "ANSWER_BUFFER_MAX_ATTEMPTS", 2)
+    bad = IntegrityError("INSERT", {}, Exception("bad row"))
+    buffer, written = make_buffer(monkeypatch, lambda rows: bad if any(r["round_number"] == 2 for r in rows) else None)
+
+    async def scenario():
+        for round_number in (1, 2, 3):
+            buffer.add(round_number=round_number)
+        first = await buffer.flush()
+        buffer.add(round_number=4)
+        second = await buffer.flush()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert (first, second) == (2, 1)
+    assert [row["round_number"] for row in written] == [1, 3, 4]
+    # 2回失敗した行はバッファから取り除かれている
+    assert buffer._rows == []
+
+
+def test_connection_error_keeps_rows_without_counting(monkeypatch):
+    monkeypatch.setattr(answer_buffer, "ANSWER_BUFFER_MAX_ATTEMPTS", 1)
+    down = OperationalError("INSERT", {}, Exception("server has gone away"))
+    state = {"down": True}
+    buffer, written = make_buffer(monkeypatch, lambda rows: down if state["down"] else None)
+
+    async def scenario():
+        buffer.add(round_number=1)
+        failed = await buffer.flush()
+        state["down"] = False
+        return failed, await buffer.flush()
+
+    assert asyncio.run(scenario()) == (0, 1)
+    assert written == [{"round_number": 1}]
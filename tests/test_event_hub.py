@@ -0,0 +1,70 @@
+# DatabasePubSub.subscribe のidの欠番の扱いのテスト
+import asyncio
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+from db import Base
+from event_hub import DatabasePubSub
+from models import EventLog
+
+
+async def make_pubsub(rows):
+    """rows: (id, 作成からの経過秒数) のリスト"""
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(EventLog.__table__.create)
+    session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with session_factory() as session:
+        now = datetime.utcnow()
+        for row_id, age in rows:
+            session.add(EventLog(id=row_id, channel="c", payload=b"x", created_at=now - timedelta(seconds=age)))
+        await session.commit()
+    return DatabasePubSub(session_factory), engine
+
+
+async def first_ids(pubsub, count):
+    received = []
+    async for event_id, _ in pubsub.subscribe("c"):
+        received.append(event_id)
+        if len(received) == count:
+            return received
+
+
+def test_old_gap_is_skipped_immediately():
+    async def scenario():
+        pubsub, engine = await make_pubsub([(1, 30), (3, 30)])
+        started = time.monotonic()
+        ids = await asyncio.wait_for(first_ids(pubsub, 2), timeout=5)
+        await engine.dispose()
+        return ids, time.monotonic() - started
+
+    ids, elapsed = asyncio.run(scenario())
+    assert ids == [1, 3]
+    assert elapsed < 0.5
+
+
+def test_recent_gap_waits_for_the_missing_row():
+    async def scenario():
+        pubsub, engine = await make_pubsub([(1, 30), (3, 0)])
+        received = []
+
+        async def consume():
+            async for event_id, _ in pubsub.subscribe("c"):
+                received.append(event_id)
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.2)
+        before = list(received)
+        # 先に採番された行が遅れてコミットされた
+        async with pubsub._session_factory() as session:
+            session.add(EventLog(id=2, channel="c", payload=b"x", created_at=datetime.utcnow()))
+            await session.commit()
+        await asyncio.sleep(0.8)
+        task.cancel()
+        await engine.dispose()
+        return before, received
+
+    before, received = asyncio.run(scenario())
+    assert before == [1]
+    assert received == [1, 2, 3]
@@ -0,0 +1,51 @@
+# ResponseCache.get_or_create の同時リクエストの扱いのテスト
+import asyncio
+from http_cache import ResponseCache
+
+
+def test_cancelled_first_waiter_does_not_cancel_followers():
+    async def scenario():
+        cache = ResponseCache()
+        calls = []
+        release = asyncio.Event()
+
+        async def produce():
+            calls.append(1)
+            await release.wait()
+            return {"advice": "ok"}
+
+        first = asyncio.create_task(cache.get_or_create("etag", produce))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get_or_create("etag", produce))
+        await asyncio.sleep(0)
+
+        # 最初のリクエストが切断された（FastAPIがタスクをキャンセルした）
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        body, hit = await second
+        assert first.cancelled()
+        assert body == b'{"advice":"ok"}'
+        assert hit is True
+        assert len(calls) == 1
+        assert cache.get("etag") == body
+
+    asyncio.run(scenario())
+
+
+def test_failure_is_not_cached_and_reaches_waiters():
+    async def scenario():
+        cache = ResponseCache()
+
+        async def produce():
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(
+            cache.get_or_create("etag", produce), cache.get_or_create("etag", produce), return_exceptions=True
+        )
+        assert all(isinstance(r, ValueError) for r in results)
+        assert cache.get("etag") is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,64 @@
+# IncrementalExtraction の質問ごとのまとめ方と、一括抽出に切り替える条件のテスト
+import asyncio
+import incremental_extractor
+from conversation_chain import MAX_ROUNDS
+
+
+def run_session(monkeypatch, rounds, mentions=("言及",)):
+    """rounds: ラウンドごとの (質問の番号, 抽出結果, 回答)"""
+    results = {answer: (number, fields) for number, fields, answer in rounds}
+    monkeypatch.setattr(incremental_extractor, "extract_round_answer", lambda question, answer: results[answer])
+    monkeypatch.setattr(incremental_extractor, "extract_partner_mentions_llm", lambda *args: list(mentions))
+
+    async def scenario():
+        extraction = incremental_extractor.IncrementalExtraction("パートナー")
+        for round_number, (_, _, answer) in enumerate(rounds, start=1):
+            extraction.schedule(round_number, "コーチの発言", answer)
+        return extraction, await extraction.wait()
+
+    return asyncio.run(scenario())
+
+
+def full_rounds(score_rounds=(("7", "仕事が順調"),)):
+    rounds = [(1, {"satisfaction_score": score, "satisfaction_context": context}, f"q1-{i}")
+              for i, (score, context) in enumerate(score_rounds)]
+    rounds += [
+        (2, {"hidden_thoughts": "本音"}, "q2"),
+        (3, {"theme": "家計"}, "q3"),
+        (4, {"positive_events": "家事を手伝ってくれた"}, "q4"),
+        (5, {"next_week_improvement": "早く寝る"}, "q5"),
+    ]
+    while len(rounds) < MAX_ROUNDS:
+        rounds.append((5, {"next_week_improvement": f"追加{len(rounds)}"}, f"extra{len(rounds)}"))
+    return rounds
+
+
+def test_fields_are_merged_per_question(monkeypatch):
+    extraction, complete = run_session(monkeypatch, full_rounds((("7", "仕事が順調"), ("", "夕食も美味しかった"))))
+    assert complete
+    data = extraction.structured_data()
+    assert data["satisfaction_score"] == "7"
+    assert data["satisfaction_context"] == "仕事が順調\n夕食も美味しかった"
+    assert data["theme"] == "家計"
+    assert extraction.mentions() == ["言及"]
+
+
+def test_skipped_question_does_not_force_fallback(monkeypatch):
+    rounds = full_rounds()
+    rounds[2] = (3, {"theme": ""}, "スキップ")
+    extraction, complete = run_session(monkeypatch, rounds)
+    assert complete
+    assert extraction.structured_data()["theme"] == ""
+
+
+def test_unanswered_question_falls_back(monkeypatch):
+    rounds = full_rounds()
+    rounds[2] = (3, {"theme": ""}, "うーん")
+    _, complete = run_session(monkeypatch, rounds)
+    assert not complete
+
+
+def test_conflicting_scores_fall_back(monkeypatch):
+    extraction, complete = run_session(monkeypatch, full_rounds((("7", "仕事が順調"), ("5点", "やっぱり疲れた"))))
+    assert not complete
+    assert extraction.structured_data()["satisfaction_score"] == ""
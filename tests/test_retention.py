@@ -0,0 +1,26 @@
+# 保持期間ジョブの対象行の選び方のテスト
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, insert, select
+import retention
+from models import ArchiveBatch, VectorSummary
+
+
+def test_keep_latest_rows_per_user_are_protected(monkeypatch):
+    monkeypatch.setattr(retention, "RETENTION_BATCH_PAUSE", 0)
+    engine = create_engine("sqlite://")
+    table = VectorSummary.__table__
+    with engine.begin() as conn:
+        # SQLiteは外部キーを検査しないため、参照先のusersは作らない
+        table.create(conn)
+        ArchiveBatch.__table__.create(conn)
+        old = datetime.utcnow() - timedelta(days=365)
+        conn.execute(insert(table), [
+            {"id": i, "user_id": user_id, "query_key": "q", "summary_text": "s", "created_at": old + timedelta(hours=i)}
+            for i, user_id in enumerate([1, 1, 1, 1, 2, 2], start=1)
+        ])
+    policy = next(p for p in retention.POLICIES if p.model is VectorSummary)
+    with engine.connect() as conn:
+        assert retention.archive_table(conn, policy) == 1
+        remaining = set(conn.execute(select(table.c.id)).scalars())
+    # user 1は最新3件（2, 3, 4）を残し、user 2は3件未満のためすべて残る
+    assert remaining == {2, 3, 4, 5, 6}
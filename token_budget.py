@@ -0,0 +1,173 @@
+# プロンプトのトークン数の計測と、呼び出し元ごとのトークン予算
+# 会話履歴・検索結果・レポートなど長さに上限のない入力は、LLMに送る前にfit()/afit()でトークン数を数え、
+# 呼び出し元の予算（TOKEN_BUDGET_<呼び出し元>）を超えていれば分割して並行に要約し（map）、
+# 要約をつなげたものがまだ予算を超えていれば同じ処理を繰り返す（reduce）。
+# 規定回数で収まらない場合と要約に失敗した場合だけ、予算の長さで切り詰める
+import logging
+import os
+from functools import lru_cache
+from conversation_chain import LLM_BACKEND, get_llm
+from metrics import Counter, Histogram
+from telemetry import stage
+
+logger = logging.getLogger(__name__)
+
+LLM_MODEL = "gpt-4o-mini"
+# 呼び出し元ごとの入力のトークン予算（環境変数 TOKEN_BUDGET_<呼び出し元> で上書きできる）
+DEFAULT_BUDGETS = {
+    "structured_extraction": 6000,
+    "mentions": 6000,
+    "reminder": 4000,
+    "summary": 4000,
+    "advice": 4000,
+}
+DEFAULT_BUDGET = 4000
+# mapで1回に要約する入力のトークン数
+CONDENSE_CHUNK_TOKENS = int(os.getenv("CONDENSE_CHUNK_TOKENS", "2000"))
+# 要約の出力の下限（分割数が多くても要約として意味のある長さを残す）
+CONDENSE_MIN_OUTPUT_TOKENS = 200
+# mapの同時実行数
+CONDENSE_CONCURRENCY = int(os.getenv("CONDENSE_CONCURRENCY", "4"))
+# reduceを繰り返す回数の上限
+CONDENSE_MAX_ROUNDS = 3
+
+input_tokens = Histogram(
+    "llm_input_tokens", "LLMに送る前の入力のトークン数", ("site",),
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+condensed_inputs = Counter("token_budget_condensed_total", "予算を超えたため要約してから送った入力の数", ("site",))
+truncated_inputs = Counter("token_budget_truncated_total", "要約しても収まらず切り詰めた入力の数", ("site",))
+
+
+def budget_for(site: str) -> int:
+    return int(os.getenv(f"TOKEN_BUDGET_{site.upper()}", str(DEFAULT_BUDGETS.get(site, DEFAULT_BUDGET))))
+
+
+@lru_cache(maxsize=None)
+def load_encoding():
+    """
+    モデルのトークナイザー（初回はtiktokenがエンコーディングのファイルを取得するため、ウォームアップで読み込む）。
+    fakeのLLMを使う場合と読み込めない場合はNoneを返し、1文字1トークンで概算する
+    """
+    if LLM_BACKEND == "fake":
+        return None
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(LLM_MODEL)
+    except Exception as e:
+        logger.warning(f"[token_budget] トークナイザーを読み込めないため文字数で概算します: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = load_encoding()
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    encoding = load_encoding()
+    if encoding is None:
+        return text[:max_tokens]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+def _split_long_line(line: str, max_tokens: int) -> list:
+    encoding = load_encoding()
+    if encoding is None:
+        return [line[i:i + max_tokens] for i in range(0, len(line), max_tokens)]
+    tokens = encoding.encode(line, disallowed_special=())
+    return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+
+def split_chunks(text: str, chunk_tokens: int = CONDENSE_CHUNK_TOKENS) -> list:
+    """行の区切りを保ったまま、1つあたりchunk_tokens以下のまとまりに分ける（長すぎる行はトークン単位で分ける）"""
+    chunks, current, size = [], [], 0
+    for line in text.splitlines():
+        tokens = count_tokens(line) + 1
+        if size + tokens > chunk_tokens and current:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        if tokens > chunk_tokens:
+            chunks.extend(_split_long_line(line, chunk_tokens))
+            continue
+        current.append(line)
+        size += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _map_prompts(text: str, budget: int, instruction: str) -> tuple:
+    chunks = split_chunks(text)
+    # 要約をつなげて予算に収まるよう、1つあたりの出力の長さを決める
+    target = max(CONDENSE_MIN_OUTPUT_TOKENS, budget // len(chunks))
+    return [
+        (
+            f"以下は長いテキストの一部（{i}/{len(chunks)}）です。{instruction}\n"
+            f"{target}トークン（日本語でおよそ{target}文字）以内で、前置きや説明を付けずに出力してください。\n\n"
+            f"テキスト:\n{chunk}"
+        )
+        for i, chunk in enumerate(chunks, start=1)
+    ], target
+
+
+def _joined(results) -> str:
+    return "\n".join(r.content if hasattr(r, "content") else str(r) for r in results)
+
+
+def _measure(text: str, site: str, budget: int) -> bool:
+    """入力のトークン数を記録し、予算に収まっていればTrue"""
+    tokens = count_tokens(text)
+    input_tokens.observe(tokens, site=site)
+    if tokens <= budget:
+        return True
+    condensed_inputs.inc(site=site)
+    logger.info(f"[token_budget] {site}: {tokens}トークンが予算{budget}を超えたため要約します")
+    return False
+
+
+def _give_up(text: str, site: str, budget: int) -> str:
+    truncated_inputs.inc(site=site)
+    logger.warning(f"[token_budget] {site}: 要約しても予算{budget}に収まらないため切り詰めます")
+    return truncate(text, budget)
+
+
+def fit(text: str, site: str, instruction: str, budget: int = None) -> str:
+    """
+    textがsiteの予算に収まればそのまま返し、超えていれば分割して並行に要約したものを返す（同期版。スレッドから呼ぶ）。
+    instructionは要約で残すべき内容の指示。要約のLLM利用は「<site>_condense」として計上する
+    """
+    budget = budget or budget_for(site)
+    if _measure(text, site, budget):
+        return text
+    try:
+        for _ in range(CONDENSE_MAX_ROUNDS):
+            prompts, target = _map_prompts(text, budget, instruction)
+            llm = get_llm().bind(max_tokens=target * 2)
+            with stage("llm", f"{site}_condense"):
+                text = _joined(llm.batch(prompts, config={"max_concurrency": CONDENSE_CONCURRENCY}))
+            if count_tokens(text) <= budget:
+                return text
+    except Exception as e:
+        logger.error(f"[token_budget] {site}: 要約に失敗しました: {e}")
+    return _give_up(text, site, budget)
+
+
+async def afit(text: str, site: str, instruction: str, budget: int = None) -> str:
+    """fit()の非同期版"""
+    budget = budget or budget_for(site)
+    if _measure(text, site, budget):
+        return text
+    try:
+        for _ in range(CONDENSE_MAX_ROUNDS):
+            prompts, target = _map_prompts(text, budget, instruction)
+            llm = get_llm().bind(max_tokens=target * 2)
+            with stage("llm", f"{site}_condense"):
+                text = _joined(await llm.abatch(prompts, config={"max_concurrency": CONDENSE_CONCURRENCY}))
+            if count_tokens(text) <= budget:
+                return text
+    except Exception as e:
+        logger.error(f"[token_budget] {site}: 要約に失敗しました: {e}")
+    return _give_up(text, site, budget)
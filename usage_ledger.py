@@ -0,0 +1,239 @@
+# LLMの利用量（トークン数・推定コスト）のユーザー別・夫婦別・呼び出し元別の台帳と、1日あたりの利用上限
+# telemetry.record_tokensに記録されたトークン数を、billed_to()で指定した利用者に計上する。
+# 呼び出しごとにはDBへ書かず、メモリ上で(日付, ユーザー, 呼び出し元)ごとに合算してから定期的にllm_usage_dailyへ加算する。
+# 上限（LLM_DAILY_QUOTA_USER_USD / LLM_DAILY_QUOTA_COUPLE_USD）を超えた利用者には、
+# 新しく生成せずに保存済みの結果を返す（エンドポイント側でover_quota()を確認する）
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime
+from sqlalchemy import func, select
+from db import AsyncSessionLocal, ReadSessionLocal, upsert
+from metrics import Counter, Gauge
+from models import LlmUsageDaily, User
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+# gpt-4o-miniの単価（USD / 100万トークン）
+LLM_PRICE_PROMPT_PER_1M = float(os.getenv("LLM_PRICE_PROMPT_PER_1M", "0.15"))
+LLM_PRICE_COMPLETION_PER_1M = float(os.getenv("LLM_PRICE_COMPLETION_PER_1M", "0.60"))
+# 1日（UTC）あたりの利用上限（USD）。0以下なら上限なし
+LLM_DAILY_QUOTA_USER_USD = float(os.getenv("LLM_DAILY_QUOTA_USER_USD", "0"))
+LLM_DAILY_QUOTA_COUPLE_USD = float(os.getenv("LLM_DAILY_QUOTA_COUPLE_USD", "0"))
+USAGE_LEDGER_FLUSH_INTERVAL = float(os.getenv("USAGE_LEDGER_FLUSH_INTERVAL", "10"))
+# DBから読んだ当日の利用額を使い回す秒数（他のワーカーの利用分はこの間隔で反映される）
+USAGE_TOTALS_TTL = float(os.getenv("USAGE_TOTALS_TTL", "30"))
+# 利用者を特定できない呼び出しを計上するuser_id
+UNATTRIBUTED_USER_ID = 0
+
+llm_cost = Counter("llm_cost_usd_total", "LLMの推定コスト（USD）", ("site",))
+quota_exceeded = Counter("llm_quota_exceeded_total", "利用上限により保存済みの結果を返した回数", ("route",))
+pending_entries = Gauge("usage_ledger_pending_entries", "DBに未反映の利用量の集計行数")
+
+
+@dataclass(frozen=True)
+class Owner:
+    user_id: int
+    couple_id: str = None
+
+
+# 実行中の処理のLLM利用を計上する利用者（asyncio.to_threadやタスクにも引き継がれる）
+current_owner = ContextVar("llm_usage_owner", default=None)
+
+
+@contextmanager
+def billed_to(user_id: int, couple_id: str = None):
+    """withブロック内（とそこから起動したタスク・スレッド）のLLM利用をuser_idに計上する"""
+    token = current_owner.set(Owner(user_id, couple_id))
+    try:
+        yield
+    finally:
+        current_owner.reset(token)
+
+
+def estimate_cost(prompt_tokens: int, completion_tokens: int) -> float:
+    return (prompt_tokens * LLM_PRICE_PROMPT_PER_1M + completion_tokens * LLM_PRICE_COMPLETION_PER_1M) / 1_000_000
+
+
+class UsageLedger:
+    def __init__(self, flush_interval: float = USAGE_LEDGER_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        # (日付, user_id, site) -> {"couple_id", "calls", "prompt_tokens", "completion_tokens", "cost_usd"}
+        self._pending = {}
+        # LLMの呼び出しはスレッドからも記録されるためロックで守る
+        self._lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        # ("user" | "couple", id) -> (読み込んだ時刻, 日付, DB上の当日の利用額)
+        self._totals = {}
+        self._task = None
+
+    def record(self, site: str, prompt_tokens: int, completion_tokens: int) -> None:
+        owner = current_owner.get() or Owner(UNATTRIBUTED_USER_ID)
+        cost = estimate_cost(prompt_tokens, completion_tokens)
+        key = (datetime.utcnow().date(), owner.user_id, site)
+        with self._lock:
+            entry = self._pending.setdefault(key, {
+                "couple_id": owner.couple_id, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0,
+            })
+            entry["couple_id"] = entry["couple_id"] or owner.couple_id
+            entry["calls"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["cost_usd"] += cost
+            pending_entries.set(len(self._pending))
+        llm_cost.inc(cost, site=site)
+
+    # --- 上限の判定 ---
+
+    async def _stored_total(self, scope: str, value) -> float:
+        today = datetime.utcnow().date()
+        cached = self._totals.get((scope, value))
+        if cached is not None and cached[1] == today and time.monotonic() - cached[0] < USAGE_TOTALS_TTL:
+            return cached[2]
+        column = LlmUsageDaily.user_id if scope == "user" else LlmUsageDaily.couple_id
+        async with ReadSessionLocal() as session:
+            total = (await session.execute(
+                select(func.coalesce(func.sum(LlmUsageDaily.cost_usd), 0.0))
+                .where(LlmUsageDaily.day == today, column == value)
+            )).scalar()
+        self._totals[(scope, value)] = (time.monotonic(), today, float(total))
+        return float(total)
+
+    def _pending_total(self, user_id: int = None, couple_id: str = None) -> float:
+        today = datetime.utcnow().date()
+        with self._lock:
+            return sum(
+                entry["cost_usd"] for (day, entry_user_id, _), entry in self._pending.items()
+                if day == today and ((user_id is not None and entry_user_id == user_id)
+                                     or (couple_id is not None and entry["couple_id"] == couple_id))
+            )
+
+    async def usage_today(self, user_id: int, couple_id: str = None) -> dict:
+        """当日の利用額（DBに反映済みの分＋このワーカーの未反映分）"""
+        usage = {"user_usd": await self._stored_total("user", user_id) + self._pending_total(user_id=user_id)}
+        if couple_id:
+            usage["couple_usd"] = await self._stored_total("couple", couple_id) + self._pending_total(couple_id=couple_id)
+        return usage
+
+    async def over_quota(self, user_id: int, couple_id: str = None) -> bool:
+        """ユーザーまたは夫婦の当日の利用額が上限に達していればTrue（上限が設定されていなければ常にFalse）"""
+        if LLM_DAILY_QUOTA_USER_USD <= 0 and LLM_DAILY_QUOTA_COUPLE_USD <= 0:
+            return False
+        usage = await self.usage_today(user_id, couple_id)
+        if LLM_DAILY_QUOTA_USER_USD > 0 and usage["user_usd"] >= LLM_DAILY_QUOTA_USER_USD:
+            return True
+        return LLM_DAILY_QUOTA_COUPLE_USD > 0 and usage.get("couple_usd", 0.0) >= LLM_DAILY_QUOTA_COUPLE_USD
+
+    # --- DBへの反映 ---
+
+    async def flush(self) -> int:
+        """未反映の集計をllm_usage_dailyに加算し、反映した行数を返す"""
+        async with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            try:
+                await self._write(pending)
+            except Exception:
+                # 失敗した分は失わないよう戻し、次回のフラッシュで加算する
+                with self._lock:
+                    for key, entry in pending.items():
+                        current = self._pending.setdefault(key, dict(entry, calls=0, prompt_tokens=0,
+                                                                     completion_tokens=0, cost_usd=0.0))
+                        for field in ("calls", "prompt_tokens", "completion_tokens", "cost_usd"):
+                            current[field] += entry[field]
+                    pending_entries.set(len(self._pending))
+                logger.exception("LLMの利用量の反映に失敗しました")
+                raise
+            with self._lock:
+                pending_entries.set(len(self._pending))
+            # 反映した利用者の当日の利用額は次の判定でDBから読み直す
+            for _, user_id, _ in pending:
+                self._totals.pop(("user", user_id), None)
+            for entry in pending.values():
+                self._totals.pop(("couple", entry["couple_id"]), None)
+            return len(pending)
+
+    @staticmethod
+    async def _write(pending: dict) -> None:
+        async with AsyncSessionLocal() as session:
+            try:
+                # 夫婦が分からないまま計上された分は、usersテーブルから夫婦を補う
+                unknown = {user_id for (_, user_id, _), entry in pending.items() if not entry["couple_id"]}
+                unknown.discard(UNATTRIBUTED_USER_ID)
+                couples = dict((await session.execute(
+                    select(User.user_id, User.couple_id).where(User.user_id.in_(unknown))
+                )).all()) if unknown else {}
+
+                dialect = session.bind.dialect.name
+                table = LlmUsageDaily.__table__
+                now = datetime.utcnow()
+                for (day, user_id, site), entry in pending.items():
+                    values = {
+                        "day": day, "user_id": user_id, "site": site,
+                        "couple_id": entry["couple_id"] or couples.get(user_id),
+                        "calls": entry["calls"], "prompt_tokens": entry["prompt_tokens"],
+                        "completion_tokens": entry["completion_tokens"], "cost_usd": entry["cost_usd"],
+                        "created_at": now, "updated_at": now,
+                    }
+                    # 集計行の作成と加算は1文のupsertで行う（emotion_trendのバケットと同じ方法）
+                    await session.execute(upsert(dialect, table, values, ("day", "user_id", "site"), {
+                        "couple_id": func.coalesce(table.c.couple_id, values["couple_id"]),
+                        "calls": table.c.calls + entry["calls"],
+                        "prompt_tokens": table.c.prompt_tokens + entry["prompt_tokens"],
+                        "completion_tokens": table.c.completion_tokens + entry["completion_tokens"],
+                        "cost_usd": table.c.cost_usd + entry["cost_usd"],
+                        "updated_at": now,
+                    }))
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                # ログはflush内で出力済み。次の周期で再試行する
+                pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+def degraded_response(payload):
+    """
+    利用上限を超えたため、新しく生成せずに保存済みの結果を返すレスポンス。
+    上限が解除されたら最新の結果を取り直せるよう、クライアントにはキャッシュさせない。保存済みの結果もなければ429
+    """
+    from fastapi import HTTPException
+    from fastapi.responses import ORJSONResponse
+
+    quota_exceeded.inc(route=telemetry.current_route.get())
+    if payload is None:
+        raise HTTPException(status_code=429, detail="本日のAI機能の利用上限に達しました。明日以降にお試しください。")
+    return ORJSONResponse(payload, headers={"X-LLM-Quota": "exceeded", "Cache-Control": "no-store"})
+
+
+usage_ledger = UsageLedger()
+telemetry.token_listeners.append(usage_ledger.record)
@@ -0,0 +1,152 @@
+# 起動直後のウォームアップと準備状態（/readyz）の管理
+# main.pyの読み込み時にはDB接続・マイグレーション・LLMクライアントの生成・LangChainなどの重いimportを行わず、
+# 起動後にバックグラウンドで順に実行する。必須の手順（DB接続とスキーマの確認）が終わるまで/readyzは503を返すため、
+# ロードバランサーはウォームアップが済んだワーカーにだけリクエストを振り分けられる
+import asyncio
+import importlib
+import logging
+import os
+import time
+from sqlalchemy import text
+from metrics import Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# trueの場合、ウォームアップの最初に未適用のマイグレーションを適用する。
+# デプロイのワークフローにはマイグレーションの手順がないため既定でtrueにしている。upgradeはDBのロックを取ってから
+# 適用済みのバージョンを読み直すため、複数のワーカーが同時に起動しても適用は1回だけ行われる（他のワーカーはロックを待つ）。
+# デプロイ時に`python migrations.py upgrade`を別に実行する構成ではfalseにし、ワーカーは適用済みかどうかだけを確認する
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "true").lower() == "true"
+# 先に読み込んでおく重いモジュール（初回リクエストでimportの時間がかからないようにする）
+PRELOAD_MODULES = (
+    "langchain.chains",
+    "langchain.memory",
+    "langchain.prompts",
+    "langchain_core.output_parsers",
+    "langchain.docstore.document",
+    "langchain_community.embeddings",
+    "langchain_community.vectorstores",
+)
+
+warmup_step_seconds = Histogram("warmup_step_seconds", "ウォームアップの各手順にかかった時間（秒）", ("step",))
+ready_gauge = Gauge("app_ready", "ウォームアップが完了して準備ができていれば1")
+
+
+def _migrate():
+    import migrations
+    return migrations.upgrade()
+
+
+def _check_schema():
+    import migrations
+    pending = migrations.pending_versions()
+    if pending:
+        raise RuntimeError(f"未適用のマイグレーションがあります: {pending}（python migrations.py upgrade を実行してください）")
+
+
+async def _ping_database():
+    from db import async_engine
+    async with async_engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+
+def _load_llm():
+    from conversation_chain import get_llm
+    get_llm()
+
+
+def _load_parsers():
+    import structured_parser
+    import reminder_perser
+    structured_parser.output_parser()
+    structured_parser.round_output_parser()
+    reminder_perser.output_parser()
+
+
+def _preload_modules():
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+
+
+def _load_tokenizer():
+    from token_budget import load_encoding
+    load_encoding()
+
+
+def _load_language_client():
+    from emotion_analysis import get_language_client
+    get_language_client()
+
+
+class Readiness:
+    """ウォームアップの各手順の状態（pending / ok / error）を保持する"""
+
+    def __init__(self):
+        self.steps = {}
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def ready(self) -> bool:
+        required = [step for step in self.steps.values() if step["required"]]
+        return bool(required) and all(step["status"] == "ok" for step in required)
+
+    def snapshot(self) -> dict:
+        return {
+            "ready": self.ready,
+            "finished": self.finished_at is not None,
+            "steps": {name: {k: v for k, v in step.items() if v is not None} for name, step in self.steps.items()},
+        }
+
+    async def _run_step(self, name: str, func, required: bool) -> None:
+        step = self.steps[name]
+        started = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(func):
+                await func()
+            else:
+                # importやクライアントの生成はブロッキングのためスレッドで行い、イベントループを塞がない
+                await asyncio.to_thread(func)
+            step["status"] = "ok"
+        except Exception as e:
+            step["status"] = "error"
+            step["error"] = f"{type(e).__name__}: {e}"
+            log = logger.error if required else logger.warning
+            log(f"[warmup] {name} に失敗: {e}")
+        elapsed = time.perf_counter() - started
+        step["seconds"] = round(elapsed, 3)
+        warmup_step_seconds.observe(elapsed, step=name)
+
+    async def run(self) -> None:
+        """
+        ウォームアップの手順を順に実行する。必須の手順が失敗した場合は残りの必須手順を行わず、準備未完了のままにする。
+        必須でない手順（LLM・NLPクライアントなど）の失敗は、初回利用時に改めて生成されるため準備状態には影響しない。
+        """
+        steps = []
+        if MIGRATE_ON_STARTUP:
+            steps.append(("migrations", _migrate, True))
+        steps += [
+            ("schema", _check_schema, True),
+            ("database", _ping_database, True),
+            ("llm", _load_llm, False),
+            ("parsers", _load_parsers, False),
+            ("modules", _preload_modules, False),
+            ("tokenizer", _load_tokenizer, False),
+            ("language_client", _load_language_client, False),
+        ]
+        self.steps = {name: {"status": "pending", "required": required, "seconds": None, "error": None}
+                      for name, _, required in steps}
+        self.started_at = time.perf_counter()
+        for name, func, required in steps:
+            if required and any(s["status"] == "error" for s in self.steps.values() if s["required"]):
+                self.steps[name]["status"] = "skipped"
+                continue
+            await self._run_step(name, func, required)
+            if required and self.ready:
+                ready_gauge.set(1)
+        self.finished_at = time.perf_counter()
+        ready_gauge.set(1 if self.ready else 0)
+        logger.info(f"[warmup] 完了 {self.finished_at - self.started_at:.2f}秒 ready={self.ready}")
+
+
+readiness = Readiness()